@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+import argparse
+import subprocess
+import ngrams_api
+import ngrams_async
+import ngrams_telemetry
+import mock_ngrams_server
+
+# Throughput benchmark of the frequency retrieval against a local mock of the ngrams API.
+# Every (mode, size) runs in its own process, so memory peaks and caches do not leak between runs. Each mode only
+# imports what it runs (e.g. retrieval modes do not load pandas), so their peak memory is their own.
+
+MODES = ['serial', 'parallel', 'parallel-cached']
+MERGE_MODE = 'merge'  # Not run by default: merge of HOI and ngrams tables of every combination (no API calls)
+IMPORTS_MODE = 'imports'  # Not run by default: import time of the scripts, checked against IMPORT_BUDGETS (no sizes)
+DEFAULT_SIZES = '10x10,30x20,60x40,117x80'  # verbs x objects (117x80 is HICO-DET)
+
+# Import time (seconds, without the interpreter startup) allowed to every script, and the heavy modules it must not
+# import: those are only imported by the code paths that need them
+IMPORT_BUDGETS = {
+    'get_freq': (0.25, ['numpy', 'pandas', 'aiohttp', 'tqdm', 'multiprocessing', 'matplotlib']),
+    'get_freq_ngrams': (0.5, ['pandas', 'aiohttp', 'tqdm', 'multiprocessing', 'matplotlib']),
+    'merge_shards': (1.0, ['aiohttp', 'tqdm', 'matplotlib']),
+    'merge_datasets': (1.0, ['torch', 'matplotlib', 'seaborn']),
+    'get_interactions': (1.0, ['pandas', 'torch', 'matplotlib']),
+    'hoi_stats': (1.0, ['torch', 'matplotlib']),
+    'hoi_frequency_index': (1.0, ['torch', 'aiohttp', 'matplotlib']),
+    'pipeline': (1.5, ['torch', 'aiohttp', 'tqdm', 'matplotlib']),
+}
+
+
+def synthetic_grid(num_verbs, num_objects):
+    import get_freq_ngrams
+    verbs = ['verb_{}'.format(num_verb) for num_verb in range(num_verbs)]
+    objects = ['object_{}'.format(num_obj) for num_obj in range(num_objects)]
+    return get_freq_ngrams.CombinationGrid(verbs, objects, parse=True)
+
+
+def run_queries(queries, mode, concurrency):
+    # Fetches the queries like execute_plan does. Every request is timed by the telemetry of ngrams_api.
+    import get_freq_ngrams
+    if mode == 'serial':
+        results = map(get_freq_ngrams.fetch_frequency, queries)
+    else:
+        results = ngrams_async.imap_unordered(get_freq_ngrams.fetch_frequency_async, queries, concurrency=concurrency)
+    return sum(1 for _ in results)
+
+
+def synthetic_tables(num_verbs, num_objects, hoi_fraction=0.1, seed=0):
+    # Tables as merge_datasets.py gets them: ngrams of every combination, and a random fraction of them in HOI
+    import numpy as np
+    import pandas as pd
+    rng = np.random.default_rng(seed)
+    verbs = ['verb_{}'.format(num_verb) for num_verb in range(num_verbs)]
+    objects = ['object_{}'.format(num_obj) for num_obj in range(num_objects)]
+    verb_codes = np.repeat(np.arange(num_verbs), num_objects)
+    object_codes = np.tile(np.arange(num_objects), num_verbs)
+
+    def pairs_table(selected, **columns):
+        return pd.DataFrame(dict(Verb=pd.Categorical.from_codes(verb_codes[selected], categories=verbs),
+                                 Object=pd.Categorical.from_codes(object_codes[selected], categories=objects), **columns))
+
+    in_hoi = rng.random(len(verb_codes)) < hoi_fraction
+    ngrams_df = pairs_table(slice(None), Frequency=rng.integers(0, 10 ** 7, len(verb_codes)))
+    database_df = pairs_table(in_hoi, Frequency=rng.integers(1, 1000, int(in_hoi.sum())), IsRare=rng.integers(0, 2, int(in_hoi.sum())))
+
+    def labels_table(label_column, labels, high):
+        return pd.DataFrame({label_column: labels, 'Frequency': rng.integers(1, high, len(labels))})
+
+    return (database_df, ngrams_df, labels_table('Verb', verbs, 10 ** 4), labels_table('Object', objects, 10 ** 4),
+            labels_table('Verb', verbs, 10 ** 8), labels_table('Object', objects, 10 ** 8))
+
+
+def run_merge(args):
+    import merge_datasets
+    num_verbs, num_objects = [int(size) for size in args.size.split('x')]
+    tables = synthetic_tables(num_verbs, num_objects)
+    input_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    start = time.perf_counter()
+    df = merge_datasets.merge_frequencies(*tables, allow_mismatch=True)
+    wall_time = time.perf_counter() - start
+
+    return {
+        'mode': args.mode,
+        'size': args.size,
+        'verbs': num_verbs,
+        'objects': num_objects,
+        'pairs': num_verbs * num_objects,
+        'rows': len(df),
+        'wall_time': wall_time,
+        'rows_per_second': len(df) / wall_time if wall_time > 0 else 0.0,
+        'input_rss_mb': input_rss,  # Peak before the merge (interpreter and input tables)
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def measure_import(module, repeats=3):
+    # Best cumulative import time of the module in fresh interpreters (from python -X importtime), and the modules it imports
+    import_times, imported = [], set()
+    for _ in range(repeats):
+        command = [sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)]
+        output = subprocess.run(command, check=True, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stderr
+        for line in output.splitlines():
+            if line.startswith('import time:') and not line.endswith('package'):
+                _, cumulative, name = line.split('|')
+                imported.add(name.strip())
+                if name.strip() == module:
+                    import_times.append(int(cumulative) / 1e6)
+    return min(import_times), imported
+
+
+def run_imports(repeats=3):
+    results = []
+    for module, (budget, forbidden) in IMPORT_BUDGETS.items():
+        import_time, imported = measure_import(module, repeats)
+        heavy = [name for name in forbidden if name in imported]
+        results.append({'mode': IMPORTS_MODE, 'module': module, 'import_time': import_time, 'budget': budget, 'heavy_imports': heavy,
+                        'within_budget': import_time <= budget and len(heavy) == 0})
+    return results
+
+
+def run_one(args):
+    if args.mode == MERGE_MODE:
+        return run_merge(args)
+
+    import get_freq_ngrams
+    num_verbs, num_objects = [int(size) for size in args.size.split('x')]
+    ngrams_api.BASE_URL = args.api_url
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    start = time.perf_counter()
+    grid = synthetic_grid(num_verbs, num_objects)
+    plan = get_freq_ngrams.plan_queries([], grid.verb_jobs(), grid.object_jobs()) + list(grid.plan_interactions())
+    queries = get_freq_ngrams.unique_queries(plan)
+    planning_time = time.perf_counter() - start
+
+    cache_dir = None
+    if args.mode == 'parallel-cached':
+        # We warm the cache first, and measure a rerun
+        cache_dir = tempfile.mkdtemp(prefix='ngrams_cache_')
+        cache = ngrams_api.NgramCache(cache_dir)
+        ngrams_api.set_cache(cache)
+        run_queries(queries, 'parallel', args.concurrency)
+
+    telemetry = ngrams_telemetry.Telemetry()
+    ngrams_api.set_telemetry(telemetry)
+    start = time.perf_counter()
+    num_results = run_queries(queries, args.mode, args.concurrency)
+    wall_time = time.perf_counter() - start
+    telemetry_summary = telemetry.summary()
+
+    if cache_dir is not None:
+        ngrams_api.get_cache().close()
+        shutil.rmtree(cache_dir)
+
+    return {
+        'mode': args.mode,
+        'size': args.size,
+        'verbs': num_verbs,
+        'objects': num_objects,
+        'pairs': len(grid),
+        'queries': num_results,
+        'concurrency': args.concurrency if args.mode != 'serial' else 1,
+        'planning_time': planning_time,
+        'wall_time': wall_time,
+        'queries_per_second': num_results / wall_time if wall_time > 0 else 0.0,
+        'latency_p50_ms': telemetry_summary.get('latency_p50_ms', 0.0),
+        'latency_p99_ms': telemetry_summary.get('latency_p99_ms', 0.0),
+        'retries': telemetry_summary.get('retries', 0),
+        'utilization': telemetry_summary.get('utilization', 0.0),
+        'cpu_fraction': telemetry_summary.get('cpu_fraction', 0.0),
+        'bound': telemetry_summary.get('bound'),
+        'baseline_rss_mb': baseline_rss,  # Peak after the imports, before planning
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,  # ru_maxrss is in KB on Linux
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the ngram frequency retrieval against a mock API')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='Comma-separated vocabulary sizes as <verbs>x<objects>')
+    parser.add_argument('--modes', default=','.join(MODES), help='Comma-separated execution modes ({}, or {} and {})'.format(', '.join(MODES), MERGE_MODE, IMPORTS_MODE))
+    parser.add_argument('--concurrency', type=int, default=ngrams_async.DEFAULT_CONCURRENCY, help='Concurrency of the parallel modes')
+    parser.add_argument('--latency', type=float, default=0.02, help='Latency of the mock API (seconds)')
+    parser.add_argument('--latency-jitter', type=float, default=0.0, help='Extra random latency of the mock API (seconds)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of mock API requests that fail with 429/503')
+    parser.add_argument('--response-size', type=int, default=1, help='Number of ngrams in each mock API response')
+    parser.add_argument('--serial-max-pairs', type=int, default=2500, help='Skip the serial mode above this number of pairs')
+    parser.add_argument('--output', help='Path to the JSON report')
+    # Internal: runs a single configuration against an already running server and prints its result as JSON
+    parser.add_argument('--run-one', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--mode', help=argparse.SUPPRESS)
+    parser.add_argument('--size', help=argparse.SUPPRESS)
+    parser.add_argument('--api-url', help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.run_one:
+        print(json.dumps(run_one(args)))
+        raise SystemExit
+
+    results = []
+    modes = args.modes.split(',')
+    if IMPORTS_MODE in modes:
+        modes.remove(IMPORTS_MODE)
+        for result in run_imports():
+            results.append(result)
+            print('{:>16} {:>20}: {:7.1f}ms (budget {:6.0f}ms){}'.format(
+                IMPORTS_MODE, result['module'], result['import_time'] * 1000, result['budget'] * 1000,
+                ', imports {}'.format(', '.join(result['heavy_imports'])) if result['heavy_imports'] else ''))
+
+    server = mock_ngrams_server.start_server_thread(latency=args.latency, latency_jitter=args.latency_jitter,
+                                                    error_rate=args.error_rate, response_size=args.response_size)
+    api_url = 'http://{}:{}'.format(*server.server_address)
+
+    for size in args.sizes.split(',') if modes else []:
+        num_verbs, num_objects = [int(value) for value in size.split('x')]
+        for mode in modes:
+            if mode == 'serial' and num_verbs * num_objects > args.serial_max_pairs:
+                print('Skipping {} {} (more than {} pairs)'.format(mode, size, args.serial_max_pairs))
+                continue
+
+            requests_before = server.stats['requests']
+            errors_before = server.stats['errors']
+            command = [sys.executable, os.path.abspath(__file__), '--run-one', '--mode', mode, '--size', size,
+                       '--api-url', api_url, '--concurrency', str(args.concurrency)]
+            output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            result['server_requests'] = server.stats['requests'] - requests_before
+            result['server_errors'] = server.stats['errors'] - errors_before
+            results.append(result)
+
+            if mode == MERGE_MODE:
+                print('{:>16} {:>7}: {:9d} rows in {:7.2f}s ({:10.0f} rows/s), peak RSS {:6.1f}MB ({:6.1f}MB before the merge)'.format(
+                    mode, size, result['rows'], result['wall_time'], result['rows_per_second'], result['peak_rss_mb'], result['input_rss_mb']))
+                continue
+            print('{:>16} {:>7}: {:6d} queries in {:7.2f}s ({:8.1f} q/s), p50 {:7.1f}ms, p99 {:7.1f}ms, {:4.0%} busy, CPU {:4.0%}, peak RSS {:6.1f}MB'.format(
+                mode, size, result['queries'], result['wall_time'], result['queries_per_second'], result['latency_p50_ms'],
+                result['latency_p99_ms'], result['utilization'], result['cpu_fraction'], result['peak_rss_mb']))
+
+    server.shutdown()
+
+    report = {
+        'config': {'latency': args.latency, 'latency_jitter': args.latency_jitter, 'error_rate': args.error_rate,
+                   'response_size': args.response_size, 'concurrency': args.concurrency},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print('Report saved to {}'.format(args.output))
+
+    over_budget = [result['module'] for result in results if result['mode'] == IMPORTS_MODE and not result['within_budget']]
+    if over_budget:
+        print('Over the import budget: {}'.format(', '.join(over_budget)))
+        raise SystemExit(1)
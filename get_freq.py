@@ -2,56 +2,11 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import requests
-
-def call_api(query_text):
-    base_url = "https://api.ngrams.dev"
-    corpus = "eng"
-    endpoint = "search"
-
-    extra_params = "flags=cr"
-    
-    api_url = "{}/{}/{}?query={}&{}".format(base_url, corpus, endpoint, query_text, extra_params)
-    response = requests.get(api_url)
-
-    return response.json()
-
-def querify(text, join_with_star=False):
-    # Takes a text and converts it to a query string
-    # We take into account variatons of the text (right now with ~, but we need to do something more elaborate)
-    
-    verb = text[0]
-    obj = text[1]
-
-    # Verb can have a preposition, so we only augment the first word
-    verb_root = verb.split(' ')[0].strip()
-    verb_root = verb_root + '~'  # We augment the verb.  # TODO: We need to do something more elaborate here (like ask GPT)
-
-    verb_preposition = verb.split(' ')[1:]
-    verb_preposition = [p.strip() for p in verb_preposition]
-
-    verb_query = [verb_root]
-    verb_query.extend(verb_preposition)
-    verb_query = '+'.join(verb_query)
-
-    # For object, we could augment all words. However, it is too many wildcards and the API does not return results.
-    # We, therefore, only augment the last word (i.e. dining table -> dining table~)
-    obj_root = obj.split(' ')[-1].strip()
-    obj_root = obj_root + '~'  # We augment the object.  # TODO: We need to do something more elaborate here (like ask GPT)
-
-    obj_preposition = obj.split(' ')[:-1]
-    obj_preposition = [p.strip() for p in obj_preposition]
-    
-    obj_query = obj_preposition
-    obj_query.append(obj_root)
-    obj_query = '+'.join(obj_query)
-
-    if join_with_star:
-        query = "{}+*+{}".format(verb_query, obj_query)  # We add * to account for articles, adjectives, etc.
-    else:
-        query = "{}+{}".format(verb_query, obj_query)
-
-    return query
+from concurrent.futures import ThreadPoolExecutor
+import ngrams_api
+import ngrams_expand
+from ngrams_api import call_api
+from ngrams_query import querify
 
 def aggregate_freq(api_response):
     # Response looks like this:
@@ -65,12 +20,29 @@ def aggregate_freq(api_response):
 
 
 
-def get_frequency(text):
+def fetch_all(queries):
+    # The queries of a pair are sent at the same time, so a lookup takes a single round trip to the API.
+    # A local index answers without the network, so it gains nothing from threads.
+    if len(queries) == 1 or ngrams_api.get_backend() is not None:
+        return [call_api(query) for query in queries]
+    telemetry = ngrams_api.get_telemetry()
+    if telemetry is not None:
+        telemetry.workers = len(queries)
+    with ThreadPoolExecutor(max_workers=len(queries)) as pool:
+        return list(pool.map(call_api, queries))
+
+
+
+def get_frequency(text, expand=False):
+    if expand:
+        # Only the variants of each template are counted, and they never overlap, so both templates add up
+        queries = ngrams_expand.expand_pair(text[0], text[1])
+        return sum(ngrams_expand.match_variants(query, api_response)[0] for query, api_response in zip(queries, fetch_all(queries)))
+
     text_query = querify(text)
     text_query_wildcard = querify(text, join_with_star=True)
     
-    api_response = call_api(text_query)
-    api_response_wildcard = call_api(text_query_wildcard)
+    api_response, api_response_wildcard = fetch_all([text_query, text_query_wildcard])
     
     freq = aggregate_freq(api_response)
     freq_wildcard = aggregate_freq(api_response_wildcard)
@@ -102,9 +74,14 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Retrieve HOI frequencies')
     parser.add_argument('--file', help='Path to the input file')
     parser.add_argument('--text', help='Input text')
+    ngrams_api.add_api_arguments(parser)
+    ngrams_expand.add_expand_arguments(parser)
 
     args = parser.parse_args()
 
+    ngrams_api.setup_from_args(args)
+    expand = ngrams_expand.expand_from_args(args)
+
     if args.file:
         actions = process_file(args.file)
     elif args.text:
@@ -114,6 +91,8 @@ if __name__ == '__main__':
         raise SystemExit
     
     for action in actions:
-        action_freq = get_frequency(action)
+        action_freq = get_frequency(action, expand=expand)
         print('{}: {}'.format(action, action_freq))
+
+    ngrams_api.teardown()
     
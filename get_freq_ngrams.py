@@ -2,66 +2,23 @@
 # -*- coding: utf-8 -*-
 
 import os
+import json
+import hashlib
+import itertools
 import argparse
-import requests
-import multiprocessing as mp
-import tqdm
-
-def call_api(query_text):
-    base_url = "https://api.ngrams.dev"
-    corpus = "eng"
-    endpoint = "search"
-
-    extra_params = "flags=cr"
-    
-    api_url = "{}/{}/{}?query={}&{}".format(base_url, corpus, endpoint, query_text, extra_params)
-    response = requests.get(api_url)
-
-    return response.json()
-
-def querify(text, join_with_star=False):
-    # Takes a text and converts it to a query string
-    # We take into account variatons of the text (right now with ~, but we need to do something more elaborate)
-    
-    verb = text[0]
-    obj = text[1]
-
-    # Verb can have a preposition, so we only augment the first word
-    verb_root = verb.split(' ')[0].strip()
-    verb_root = verb_root + '~'  # We augment the verb.  # TODO: We need to do something more elaborate here (like ask GPT)
-
-    verb_preposition = verb.split(' ')[1:]
-    verb_preposition = [p.strip() for p in verb_preposition]
-
-    verb_query = [verb_root]
-    verb_query.extend(verb_preposition)
-    verb_query = '+'.join(verb_query)
-
-    # For object, we could augment all words. However, it is too many wildcards and the API does not return results.
-    # We, therefore, only augment the last word (i.e. dining table -> dining table~)
-    obj_root = obj.split(' ')[-1].strip()
-    obj_root = obj_root + '~'  # We augment the object.  # TODO: We need to do something more elaborate here (like ask GPT)
-
-    obj_preposition = obj.split(' ')[:-1]
-    obj_preposition = [p.strip() for p in obj_preposition]
-    
-    obj_query = obj_preposition
-    obj_query.append(obj_root)
-    obj_query = '+'.join(obj_query)
-
-    if join_with_star:
-        query = "{}+*+{}".format(verb_query, obj_query)  # We add * to account for articles, adjectives, etc.
-    else:
-        query = "{}+{}".format(verb_query, obj_query)
-
-    return query
-
-def querify_simple(text):
-    word_list = text.split(' ')
-    word_list = [word.strip() + '~' for word in word_list]
-    query = '+'.join(word_list)
-    return query
-
+import numpy as np
+import hoi_io
+import ngrams_api
+import ngrams_async
+import ngrams_expand
+from ngrams_api import call_api
+from ngrams_query import querify, querify_verb, querify_object, querify_simple, join_query
+
+# Pruned column of the interactions with --prune-below or --top-k (0 for the pairs that were fetched)
+PRUNED_BELOW = 1  # Expected frequency below the bound
+PRUNED_TOP_K = 2  # Cannot enter the top-k of its verb (or object)
+DEFAULT_PRUNE_SAMPLE = 200  # Pairs fetched to fit the expected frequencies
+GRID_BLOCK = 10000  # Lines of a grid planned (and executed) at once
 
 def aggregate_freq(api_response):
     # Response looks like this:
@@ -101,13 +58,17 @@ def get_frequency_simple(text):
 
 
 def process_file(file_path, ignore_header=False):
+    if hoi_io.table_format(file_path) == 'parquet':
+        df = hoi_io.read_table(file_path)
+        return [[str(verb).strip(), str(obj).strip()] for verb, obj in zip(df['Verb'], df['Object'])]
+
     actions = []
     with open(file_path, 'r') as file:
         for num_line, line in enumerate(file):
             if ignore_header and num_line == 0:
                 continue
             line = line.strip()
-            action = line.split(',')
+            action = hoi_io.parse_csv_line(line)
             action = [action[0].strip(), action[1].strip()]  # Verb and object
             actions.append(action)
     return actions
@@ -132,21 +93,433 @@ def parse_underscore(actions):
         new_actions.append(new_action)
     return new_actions
 
-def get_every_combination(actions):
-    new_actions = []
-    verbs = set([action[0] for action in actions])
-    objects = set([action[1] for action in actions])
-    for verb in verbs:
-        for obj in objects:
-            new_actions.append([verb, obj])
-    return new_actions
-
-def worker_function(a):
-    action = a[0]
-    action_name = a[1]
-    action_freq = get_frequency(action)
-    line_contents = '{},{},{}'.format(action_name[0], action_name[1], action_freq)
-    return line_contents
+class CombinationGrid:
+    # Every verb-object combination, represented as two index arrays over the unique (sorted) verbs and objects
+    # instead of a list of [verb, object] lists. Verbs and objects are parsed and turned into query fragments
+    # only once, and pair queries are composed from those fragments.
+
+    def __init__(self, verbs, objects, parse=False):
+        self.verbs = np.array(sorted(set(verbs)), dtype=object)
+        self.objects = np.array(sorted(set(objects)), dtype=object)
+        self.verb_index = {verb: num_verb for num_verb, verb in enumerate(self.verbs)}
+        self.object_index = {obj: num_obj for num_obj, obj in enumerate(self.objects)}
+
+        # Pair i is (verbs[verb_ids[i]], objects[object_ids[i]])
+        self.verb_ids = np.repeat(np.arange(len(self.verbs), dtype=np.int32), len(self.objects))
+        self.object_ids = np.tile(np.arange(len(self.objects), dtype=np.int32), len(self.verbs))
+
+        self.verb_texts = list(self.verbs)
+        self.object_texts = list(self.objects)
+        if parse:
+            self.verb_texts = [action[0] for action in parse_underscore([[verb, ''] for verb in self.verbs])]
+            self.object_texts = [action[1] for action in parse_underscore([['', obj] for obj in self.objects])]
+        self.verb_fragments = [querify_verb(verb) for verb in self.verb_texts]
+        self.object_fragments = [querify_object(obj) for obj in self.object_texts]
+
+    def __len__(self):
+        return len(self.verb_ids)
+
+    def verb_jobs(self):
+        return list(zip(self.verb_texts, self.verbs))
+
+    def object_jobs(self):
+        return list(zip(self.object_texts, self.objects))
+
+    def line(self, verb_id, obj_id):
+        # Same line as plan_queries would produce for the pair, but built from the cached fragments
+        verb_query = self.verb_fragments[verb_id]
+        obj_query = self.object_fragments[obj_id]
+        return ('interaction', (self.verbs[verb_id], self.objects[obj_id]),
+                (join_query(verb_query, obj_query), join_query(verb_query, obj_query, join_with_star=True)))
+
+    def pair_index(self, name):
+        # (verb id, object id) of a pair, or None if it is not in the grid
+        verb_id, obj_id = self.verb_index.get(name[0]), self.object_index.get(name[1])
+        return None if verb_id is None or obj_id is None else (verb_id, obj_id)
+
+    def plan_interactions(self, skip=()):
+        # Lines of the pairs (except the names in skip), only built when they are read
+        pairs = np.arange(len(self), dtype=np.int64)
+        skipped = [self.pair_index(name) for name in skip]
+        skipped = [verb_id * len(self.objects) + obj_id for verb_id, obj_id in filter(None, skipped)]
+        if skipped:
+            pairs = np.delete(pairs, skipped)
+        return GridLines(self, pairs)
+
+    def empty_matrix(self):
+        # Dense |verbs| x |objects| frequency matrix, filled by index as results come. Missing pairs are -1.
+        return np.full((len(self.verbs), len(self.objects)), -1, dtype=np.int64)
+
+    def save_matrix(self, file_path, matrix):
+        # The labels are stored with the matrix, so the file is self-contained
+        np.savez_compressed(file_path, frequency=matrix, verbs=self.verbs.astype(str), objects=self.objects.astype(str))
+
+class GridLines:
+    # Interaction lines of some pairs of a CombinationGrid (pair numbers into its index arrays). Lines are built on
+    # demand, so a plan of every combination only takes the memory of its pair numbers.
+
+    def __init__(self, grid, pairs):
+        self.grid = grid
+        self.pairs = pairs
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __getitem__(self, num_line):
+        if isinstance(num_line, slice):
+            return GridLines(self.grid, self.pairs[num_line])
+        num_pair = self.pairs[num_line]
+        return self.grid.line(self.grid.verb_ids[num_pair], self.grid.object_ids[num_pair])
+
+    def __iter__(self):
+        for start in range(0, len(self.pairs), GRID_BLOCK):
+            pairs = self.pairs[start:start + GRID_BLOCK]
+            for verb_id, obj_id in zip(self.grid.verb_ids[pairs].tolist(), self.grid.object_ids[pairs].tolist()):
+                yield self.grid.line(verb_id, obj_id)
+
+def get_verbs_and_objects(base_actions, parse=False):
+    # Returns the (query text, name) of every unique verb and object
+    verbs = set([action[0] for action in base_actions])
+    base_verbs = verbs
+    if parse:
+        fake_verb_actions = [[verb, ''] for verb in verbs]
+        fake_verb_actions = parse_underscore(fake_verb_actions)
+        verbs = [action[0] for action in fake_verb_actions]
+
+    objects = set([action[1] for action in base_actions])
+    base_objects = objects
+    if parse:
+        fake_obj_actions = [['', obj] for obj in objects]
+        fake_obj_actions = parse_underscore(fake_obj_actions)
+        objects = [action[1] for action in fake_obj_actions]
+
+    return list(zip(verbs, base_verbs)), list(zip(objects, base_objects))
+
+def plan_queries(jobs, verb_jobs=(), object_jobs=(), expand=False):
+    # Lists the queries behind every output line: ('interaction', (verb, object), queries), ('verb', (verb,), queries)...
+    # The frequency of a line is the sum of the frequencies of its queries.
+    # Verbs and objects go first, so they do not become the long tail of the run.
+    # With expand, verbs and objects are only inflected like in the pairs (see ngrams_expand)
+    verb_query = ngrams_expand.expand_verb if expand else querify_simple
+    object_query = ngrams_expand.expand_object if expand else querify_simple
+    plan = []
+    for verb, verb_name in verb_jobs:
+        plan.append(('verb', (verb_name,), (verb_query(verb),)))
+    for obj, obj_name in object_jobs:
+        plan.append(('object', (obj_name,), (object_query(obj),)))
+    for action, action_name in jobs:
+        plan.append(('interaction', tuple(action_name), (querify(action), querify(action, join_with_star=True))))
+    return plan
+
+def unique_queries(plan):
+    # Different names often end up as the same query (e.g. after parse_underscore), so we only keep one of each
+    return list(dict.fromkeys(query for _, _, queries in plan for query in queries))
+
+def fetch_frequency(query_text):
+    api_response = call_api(query_text)
+    return query_text, aggregate_freq(api_response)
+
+async def fetch_frequency_async(fetcher, query_text):
+    api_response = await fetcher.fetch(query_text)
+    return query_text, aggregate_freq(api_response)
+
+def fetch_variants(query_text):
+    # Same as fetch_frequency, but only counting the variants of the query, which are also returned ({variant: frequency})
+    api_response = call_api(query_text)
+    return (query_text,) + ngrams_expand.match_variants(query_text, api_response)
+
+async def fetch_variants_async(fetcher, query_text):
+    api_response = await fetcher.fetch(query_text)
+    return (query_text,) + ngrams_expand.match_variants(query_text, api_response)
+
+def execute_plan(plan, parallel=False, concurrency=ngrams_async.DEFAULT_CONCURRENCY, limit_per_host=None, expand=False, variants=None):
+    # Fetches every unique query exactly once and yields (kind, name, frequency) for each line of the plan
+    # as soon as all of its queries are done. With expand, frequencies only count the variants of the queries
+    # (see ngrams_expand), and if variants is a dict, variants[(kind, name)] = {variant: frequency} is set before each line is yielded.
+    if isinstance(plan, GridLines) and len(plan) > GRID_BLOCK:
+        # Pairs of a grid do not share queries, so they are executed block by block, without planning them all in memory
+        for start in range(0, len(plan), GRID_BLOCK):
+            yield from execute_plan(plan[start:start + GRID_BLOCK], parallel, concurrency, limit_per_host, expand, variants)
+        return
+    plan = list(plan)
+    waiting = {}  # Query -> lines of the plan that need it
+    remaining = []  # Line of the plan -> number of queries still missing
+    for num_line, (_, _, queries) in enumerate(plan):
+        for query in set(queries):
+            waiting.setdefault(query, []).append(num_line)
+        remaining.append(len(set(queries)))
+
+    queries = list(waiting)
+    fetch, fetch_async = (fetch_variants, fetch_variants_async) if expand else (fetch_frequency, fetch_frequency_async)
+    if parallel:
+        # API calls are I/O bound, so we run them concurrently on an event loop (instead of on a process pool)
+        results = ngrams_async.imap_unordered(fetch_async, queries, concurrency=concurrency, limit_per_host=limit_per_host)
+    else:
+        results = map(fetch, queries)
+
+    freqs = {}
+    query_variants = {}
+    for query, freq, *contributions in results:
+        freqs[query] = freq
+        if contributions:
+            query_variants[query] = contributions[0]
+        for num_line in waiting.pop(query):
+            remaining[num_line] -= 1
+            if remaining[num_line] == 0:
+                kind, name, line_queries = plan[num_line]
+                if variants is not None and expand:
+                    # The templates of a line have different lengths, so their variants never overlap
+                    variants[(kind, name)] = {variant: variant_freq for line_query in dict.fromkeys(line_queries)
+                                              for variant, variant_freq in query_variants[line_query].items()}
+                yield kind, name, sum(freqs[line_query] for line_query in line_queries)
+
+def pair_marginals(pair_lines, marginals):
+    # Frequencies of the verb and of the object of every pair, as arrays (0 if missing)
+    verb_freqs = np.array([marginals['verb'].get((name[0],), 0) for _, name, _ in pair_lines], dtype=np.float64)
+    object_freqs = np.array([marginals['object'].get((name[1],), 0) for _, name, _ in pair_lines], dtype=np.float64)
+    return verb_freqs, object_freqs
+
+def execute_pruned(plan, prune_below=None, top_k=None, top_k_by='verb', sample_size=DEFAULT_PRUNE_SAMPLE, done=None, **execute_args):
+    # Same as execute_plan, but the verb and object marginals are fetched first and used to skip pairs, yielding
+    # (kind, name, frequency, pruned): pruned is 0 for fetched lines, and the frequency of pruned lines is None.
+    #  - Every query of a pair matches a subset of the ngrams of the verb query and of the object query, so
+    #    <number of queries> x min(verb, object) is an upper bound of its frequency.
+    #  - The expected frequency of a pair is the one of independent verbs and objects (verb x object x scale), with the
+    #    scale fitted on a (deterministic) sample of pairs, and capped by the bound. Pairs are fetched from the most to the
+    #    least expected (so the unlikely ones are deferred), and with prune_below those expected below it are skipped (PRUNED_BELOW).
+    #  - With top_k, the pairs of every verb (or object, see top_k_by) are fetched in decreasing order of their bound, and
+    #    the rest are skipped (PRUNED_TOP_K) once their bound cannot beat the k-th largest frequency of the group.
+    # done has the frequencies of the lines saved by a previous run ({kind: {name: frequency}}), which are not in the plan
+    # (without its pruned pairs, whose frequency was not observed).
+    done = done or {'interaction': {}, 'verb': {}, 'object': {}}
+    marginals = {'verb': dict(done['verb']), 'object': dict(done['object'])}
+    for kind, name, freq in execute_plan([line for line in plan if line[0] != 'interaction'], **execute_args):
+        marginals[kind][name] = freq
+        yield kind, name, freq, 0
+
+    pair_lines = [line for line in plan if line[0] == 'interaction']
+    if len(pair_lines) == 0:
+        return
+    verb_freqs, object_freqs = pair_marginals(pair_lines, marginals)
+    bounds = np.array([len(queries) for _, _, queries in pair_lines]) * np.minimum(verb_freqs, object_freqs)
+
+    # Calibration of the independence estimate (the pairs saved by a previous run are part of the sample), only needed to prune below a bound
+    sample = []
+    if prune_below is not None:
+        sample = sorted(range(len(pair_lines)), key=lambda num_line: stable_hash(json.dumps(list(pair_lines[num_line][1]))))[:sample_size]
+    observed = {}
+    for kind, name, freq in execute_plan([pair_lines[num_line] for num_line in sample], **execute_args):
+        observed[name] = freq
+        yield kind, name, freq, 0
+    done_lines = [('interaction', name, ()) for name in done['interaction']]
+    done_verb_freqs, done_object_freqs = pair_marginals(done_lines, marginals)
+    product = float(np.dot(verb_freqs[sample], object_freqs[sample]) + np.dot(done_verb_freqs, done_object_freqs))
+    scale = (sum(observed.values()) + sum(done['interaction'].values())) / product if product > 0 else 0.0
+    estimates = np.minimum(verb_freqs * object_freqs * scale, bounds)
+
+    # The sampled pairs are done, the rest go from the most to the least expected
+    sampled = set(sample)
+    remaining = [num_line for num_line in np.argsort(-estimates, kind='stable').tolist() if num_line not in sampled]
+    if prune_below is not None:
+        for num_line in remaining:
+            if estimates[num_line] < prune_below:
+                yield pair_lines[num_line][0], pair_lines[num_line][1], None, PRUNED_BELOW
+        remaining = [num_line for num_line in remaining if estimates[num_line] >= prune_below]
+
+    if top_k is None:
+        for kind, name, freq in execute_plan([pair_lines[num_line] for num_line in remaining], **execute_args):
+            yield kind, name, freq, 0
+        return
+
+    # Top-k: rounds of the next k pairs of every group that can still enter its top-k
+    group_position = 0 if top_k_by == 'verb' else 1
+    group_freqs = {}  # Group -> frequencies of its fetched pairs
+    for name, freq in list(done['interaction'].items()) + list(observed.items()):
+        group_freqs.setdefault(name[group_position], []).append(freq)
+    groups = {}
+    for num_line in sorted(remaining, key=lambda num_line: -bounds[num_line]):
+        groups.setdefault(pair_lines[num_line][1][group_position], []).append(num_line)
+
+    def kth_largest(group):
+        freqs = group_freqs.get(group, [])
+        return sorted(freqs, reverse=True)[top_k - 1] if len(freqs) >= top_k else -1
+
+    while groups:
+        round_lines = []
+        for group in list(groups):
+            num_lines = groups[group]
+            threshold = kth_largest(group)
+            if num_lines and bounds[num_lines[0]] <= threshold:
+                # Sorted by bound, so none of the remaining pairs of the group can enter its top-k either
+                for num_line in num_lines:
+                    yield pair_lines[num_line][0], pair_lines[num_line][1], None, PRUNED_TOP_K
+                num_lines = []
+            round_lines.extend(num_lines[:top_k])
+            if len(num_lines) > top_k:
+                groups[group] = num_lines[top_k:]
+            else:
+                del groups[group]
+        for kind, name, freq in execute_plan([pair_lines[num_line] for num_line in round_lines], **execute_args):
+            group_freqs.setdefault(name[group_position], []).append(freq)
+            yield kind, name, freq, 0
+
+def retrieve_frequencies(actions, parse=False, every_combination=False, parallel=False, concurrency=ngrams_async.DEFAULT_CONCURRENCY,
+                         limit_per_host=None, expand=False):
+    # Same frequencies as the script saves with --save, but kept in memory: {kind: {name: frequency}}
+    if every_combination:
+        grid = CombinationGrid([action[0] for action in actions], [action[1] for action in actions], parse=parse)
+        plan = plan_queries([], grid.verb_jobs(), grid.object_jobs(), expand=expand)
+        grid_lines = grid.plan_interactions()
+    else:
+        base_actions = actions
+        if parse:
+            actions = parse_underscore(actions)
+        verb_jobs, object_jobs = get_verbs_and_objects(base_actions, parse=parse)
+        plan = plan_queries(list(zip(actions, base_actions)), verb_jobs, object_jobs, expand=expand)
+        grid_lines = []
+
+    freqs = {'interaction': {}, 'verb': {}, 'object': {}}
+    execute_args = {'parallel': parallel, 'concurrency': concurrency, 'limit_per_host': limit_per_host, 'expand': expand}
+    for kind, name, freq in itertools.chain(execute_plan(plan, **execute_args), execute_plan(grid_lines, **execute_args)):
+        freqs[kind][name] = freq
+    return freqs
+
+def frequency_tables(freqs):
+    # Tables of retrieve_frequencies, with the same columns as the saved files (rows sorted by name)
+    import pandas as pd
+    def table(kind, columns):
+        return pd.DataFrame([list(name) + [freq] for name, freq in sorted(freqs[kind].items())], columns=columns)
+
+    return {
+        'interactions': table('interaction', ['Verb', 'Object', 'Frequency']),
+        'verbs': table('verb', ['Verb', 'Frequency']),
+        'objects': table('object', ['Object', 'Frequency']),
+    }
+
+def stable_hash(key):
+    # Stable across runs and machines (unlike hash(), which is salted per process)
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+def shard_of(key, num_shards):
+    return stable_hash(key) % num_shards
+
+def shard_plan(plan, shard_index, num_shards):
+    # Lines of the plan fetched by one of num_shards shards. Lines that share a query are kept on the same shard, so every
+    # unique query is fetched by exactly one shard and every shard writes complete lines: lines are grouped with a
+    # union-find over their queries, and each group goes to the shard of its smallest query.
+    parent = {}
+
+    def find(query):
+        root = query
+        while parent.setdefault(root, root) != root:
+            root = parent[root]
+        while parent[query] != root:
+            parent[query], query = root, parent[query]
+        return root
+
+    for _, _, queries in plan:
+        roots = sorted(set(find(query) for query in queries))
+        for root in roots[1:]:
+            parent[root] = roots[0]  # The smallest query is always the root of its group
+
+    return [line for line in plan if shard_of(find(line[2][0]), num_shards) == shard_index]
+
+def names_hash(names):
+    # Order-independent digest of the names of some lines of the plan
+    sha256 = hashlib.sha256()
+    for name in sorted(names):
+        sha256.update(json.dumps(list(name)).encode('utf-8'))
+    return sha256.hexdigest()
+
+def shard_path(file_path, shard_index, num_shards):
+    # hico_ngrams_all.csv -> hico_ngrams_all_shard1of4.csv
+    root, extension = os.path.splitext(file_path)
+    return '{}_shard{}of{}{}'.format(root, shard_index, num_shards, extension)
+
+def write_shard_manifest(file_path, plan, shard, shard_index, num_shards, outputs, expand=False):
+    # Describes the lines a shard has to save, so merge_shards.py can check that the shards cover the whole plan exactly
+    manifest = {
+        'shard_index': shard_index,
+        'num_shards': num_shards,
+        'plan_hash': names_hash((kind,) + tuple(name) for kind, name, _ in plan),
+        'expand': expand,
+        'lines': {kind: sum(1 for line in shard if line[0] == kind) for kind in outputs if kind != 'variants'},
+        'names_hash': {kind: names_hash(name for line_kind, name, _ in shard if line_kind == kind) for kind in outputs if kind != 'variants'},
+        'outputs': outputs,  # Kind -> file of the merged output
+        'shard_outputs': {kind: shard_path(path, shard_index, num_shards) for kind, path in outputs.items()},
+    }
+    with open(file_path, 'w') as file:
+        json.dump(manifest, file, indent=2)
+
+def checkpoint_columns(file_path):
+    # Header of a results file (None if there is none yet)
+    if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
+        return None
+    with open(file_path, 'r') as file:
+        return hoi_io.parse_csv_line(file.readline().rstrip('\n'))
+
+def read_checkpoint(file_path):
+    # Returns {name: frequency} of the lines already saved in a results file, so a resumed run can skip them, and
+    # {name: reason} of the ones that were pruned (their frequency is 0 because they were not fetched).
+    # If the last line was left incomplete by a crash, we cut it off (it will be fetched again).
+    done = {}
+    pruned = {}
+    if not os.path.exists(file_path):
+        return done, pruned
+
+    with open(file_path, 'r+') as file:
+        contents = file.read()
+        if not contents.endswith('\n'):
+            contents = contents[:contents.rfind('\n') + 1]
+            file.seek(0)
+            file.truncate(len(contents.encode()))
+
+    lines = contents.splitlines()
+    if len(lines) == 0:
+        return done, pruned
+    columns = hoi_io.parse_csv_line(lines[0])
+    num_freq = columns.index('Frequency')  # The name is made of the columns before it
+    num_pruned = columns.index('Pruned') if 'Pruned' in columns else None
+    for line in lines[1:]:
+        if not line.strip():
+            continue  # Blank lines (e.g. left by a hand edit) are not results
+        fields = hoi_io.parse_csv_line(line)
+        done[tuple(fields[:num_freq])] = int(fields[num_freq])
+        if num_pruned is not None and int(fields[num_pruned]) > 0:
+            pruned[tuple(fields[:num_freq])] = int(fields[num_pruned])
+    return done, pruned
+
+def trim_variants(file_path, done):
+    # The variants of a line are saved before the line itself, so a run interrupted in between leaves variants of a line
+    # that is not done (and that will be saved again): we only keep the ones of the lines in done ({kind: {name: frequency}})
+    if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
+        return
+    with open(file_path, 'r') as file:
+        lines = file.read().splitlines(keepends=True)
+
+    kept = lines[:1]
+    for line in lines[1:]:
+        fields = hoi_io.parse_csv_line(line.rstrip('\n')) if line.endswith('\n') else []
+        if len(fields) < 4:
+            continue  # Incomplete
+        verb, obj = fields[:2]
+        name = (verb, obj) if verb and obj else (verb or obj,)
+        if name in done['interaction' if verb and obj else 'verb' if verb else 'object']:
+            kept.append(line)
+    if len(kept) < len(lines):
+        temp_path = file_path + '.tmp'
+        with open(temp_path, 'w') as file:
+            file.writelines(kept)
+        os.replace(temp_path, file_path)
+
+def open_checkpoint(file_path, header, resume=False):
+    # Results are appended (and flushed) as soon as they are available, so the file is also the checkpoint
+    if resume and os.path.exists(file_path) and os.path.getsize(file_path) > 0:
+        return open(file_path, 'a')
+    file = open(file_path, 'w')
+    file.write(header + '\n')
+    file.flush()
+    return file
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Retrieve HOI frequencies')
@@ -157,9 +530,25 @@ if __name__ == '__main__':
     parser.add_argument('--get-every-combination', action='store_true', help='Get every verb-object combination')
     parser.add_argument('--save', action='store_true', help='Save the results to a csv file')
     parser.add_argument('--parallel', action='store_true', help='Perform API calls in parallel')
+    parser.add_argument('--resume', action='store_true', help='Skip the interactions already saved by a previous (interrupted) run')
+    parser.add_argument('--dry-run', action='store_true', help='Only report how many API calls would be made')
+    hoi_io.add_format_argument(parser)
+    parser.add_argument('--save-matrix', action='store_true', help='Also save the interaction frequencies as a dense verb x object matrix (.npz)')
+    parser.add_argument('--num-shards', type=int, default=1, help='Split the queries among this many independent runs (see merge_shards.py)')
+    parser.add_argument('--shard-index', type=int, default=0, help='Shard fetched by this run (from 0 to --num-shards - 1)')
+    parser.add_argument('--prune-below', type=float, default=None, help='Skip the pairs whose expected frequency (from the verb and object frequencies) is below this')
+    parser.add_argument('--top-k', type=int, default=None, help='Only fetch the pairs that can be in the k most frequent of their verb (or object)')
+    parser.add_argument('--top-k-by', choices=['verb', 'object'], default='verb', help='Groups of --top-k')
+    parser.add_argument('--prune-sample', type=int, default=DEFAULT_PRUNE_SAMPLE, help='Pairs fetched to fit the expected frequencies of --prune-below')
+    ngrams_api.add_api_arguments(parser)
+    ngrams_async.add_async_arguments(parser)
+    ngrams_expand.add_expand_arguments(parser)
 
     args = parser.parse_args()
 
+    cache = ngrams_api.setup_from_args(args)
+    expand = ngrams_expand.expand_from_args(args)
+
     if args.file:
         actions = process_file(args.file, ignore_header=args.ignore_header)
     elif args.text:
@@ -167,75 +556,187 @@ if __name__ == '__main__':
     else:
         print("Please provide either a file or text as input.")
         raise SystemExit
+
+    sharded = args.num_shards > 1
+    if sharded and not (args.save and 0 <= args.shard_index < args.num_shards):
+        print("Shards need --save and a --shard-index between 0 and {}.".format(args.num_shards - 1))
+        raise SystemExit
+    pruning = args.prune_below is not None or args.top_k is not None
+    if pruning and sharded:
+        # Which pairs are pruned depends on the frequencies of the other pairs, so shards would not be independent
+        print("Pruning (--prune-below, --top-k) cannot be used with shards.")
+        raise SystemExit
     
+    grid = None
     if args.get_every_combination:
-        actions = get_every_combination(actions)
-
-    if args.parse_underscore:
+        # We do not build the list of pairs, the grid generates their queries directly
+        grid = CombinationGrid([action[0] for action in actions], [action[1] for action in actions], parse=args.parse_underscore)
+        base_actions = actions = []
+    elif args.parse_underscore:
         base_actions = actions
         actions = parse_underscore(actions)
     else:
         base_actions = actions
-    
-    
-    if args.parallel:
-        with mp.Pool(mp.cpu_count()) as pool:
-            # We use tqdm to show a progress bar
-            results = list(tqdm.tqdm(pool.imap(worker_function, zip(actions, base_actions)), total=len(actions)))
-    else:
-        results = []
-        for action, action_name in zip(actions, base_actions):
-            line_contents = worker_function((action, action_name))
-            results.append(line_contents)
-            print(line_contents)
-    
-    if args.save:
-        file_name = os.path.splitext(os.path.basename(args.file))[0]
+
+    jobs = list(zip(actions, base_actions))
+    verb_jobs, object_jobs = [], []
+    if args.save or pruning:
+        file_name = os.path.splitext(os.path.basename(args.file or 'text'))[0]
         if args.get_every_combination:
             file_name_freq = '{}_ngrams_all.csv'.format(file_name)
         else:
             file_name_freq = '{}_ngrams.csv'.format(file_name)
-        with open(file_name_freq, 'w') as file:
-            file.write('Verb,Object,Frequency\n')
-            file.write('\n'.join(results))
-
-        # We also get the frequency of the verbs and objects
-        # For verbs:
-        verbs = set([action[0] for action in base_actions])
-        base_verbs = verbs
-        if args.parse_underscore:
-            fake_verb_actions = [[verb, ''] for verb in verbs]
-            fake_verb_actions = parse_underscore(fake_verb_actions)
-            verbs = [action[0] for action in fake_verb_actions]
-        
-        results_verbs = []
-        for verb, verb_name in zip(verbs, base_verbs):
-            verb_freq = get_frequency_simple(verb)
-            line_contents = '{},{}'.format(verb_name, verb_freq)
-            results_verbs.append(line_contents)
-            print(line_contents)
-
         file_name_verbs = '{}_ngrams_verbs.csv'.format(file_name)
-        with open(file_name_verbs, 'w') as file:
-            file.write('Verb,Frequency\n')
-            file.write('\n'.join(results_verbs))
-        
-        # For objects:
-        objects = set([action[1] for action in base_actions])
-        base_objects = objects
-        if args.parse_underscore:
-            fake_obj_actions = [['', obj] for obj in objects]
-            fake_obj_actions = parse_underscore(fake_obj_actions)
-            objects = [action[1] for action in fake_obj_actions]
-
-        results_objects = []
-        for obj, obj_name in zip(objects, base_objects):
-            obj_freq = get_frequency_simple(obj)
-            line_contents = '{},{}'.format(obj_name, obj_freq)
-            results_objects.append(line_contents)
+        file_name_objects = '{}_ngrams_objects.csv'.format(file_name)
+        file_name_variants = '{}_ngrams_variants.csv'.format(file_name)
+
+        # We also get the frequency of the verbs and objects (which pruning needs anyway)
+        if grid is not None:
+            verb_jobs, object_jobs = grid.verb_jobs(), grid.object_jobs()
+        else:
+            verb_jobs, object_jobs = get_verbs_and_objects(base_actions, parse=args.parse_underscore)
+
+    # We plan every query up front, so each unique query is only sent once
+    plan = plan_queries(jobs, verb_jobs, object_jobs, expand=expand)
+    grid_lines = []  # Pairs of the grid, planned lazily when they are not needed all at once
+    if grid is not None:
+        if sharded or pruning:
+            # Shards group the lines by query and pruning sorts the pairs, so both need every line
+            plan.extend(grid.plan_interactions())
+        else:
+            grid_lines = grid.plan_interactions()
+
+    if sharded:
+        # Every shard saves its own files (and a manifest of what they should contain), merged with merge_shards.py
+        outputs = {'interaction': file_name_freq, 'verb': file_name_verbs, 'object': file_name_objects}
+        if expand:
+            outputs['variants'] = file_name_variants
+        shard = shard_plan(plan, args.shard_index, args.num_shards)
+        if not args.dry_run:
+            file_name_manifest = shard_path('{}_ngrams.json'.format(file_name), args.shard_index, args.num_shards)
+            write_shard_manifest(file_name_manifest, plan, shard, args.shard_index, args.num_shards, outputs, expand=expand)
+        print('Shard {} of {}: {} of {} lines'.format(args.shard_index, args.num_shards, len(shard), len(plan)))
+        plan = shard
+        file_name_freq, file_name_verbs, file_name_objects, file_name_variants = [
+            shard_path(path, args.shard_index, args.num_shards) for path in [file_name_freq, file_name_verbs, file_name_objects, file_name_variants]]
+
+    done = {'interaction': {}, 'verb': {}, 'object': {}}
+    pruned_done = {}
+    if args.save and args.resume:
+        columns = checkpoint_columns(file_name_freq)
+        if columns is not None and ('Pruned' in columns) != pruning:
+            # Rows with and without a Pruned column cannot share the file
+            mode = 'with' if 'Pruned' in columns else 'without'
+            print("{} was saved {} pruning, so it can only be resumed {} --prune-below or --top-k.".format(file_name_freq, mode, mode))
+            raise SystemExit
+        done['interaction'], pruned_done = read_checkpoint(file_name_freq)
+        done['verb'], _ = read_checkpoint(file_name_verbs)
+        done['object'], _ = read_checkpoint(file_name_objects)
+        if expand:
+            trim_variants(file_name_variants, done)
+        plan = [line for line in plan if tuple(line[1]) not in done[line[0]]]
+        if len(grid_lines) > 0:
+            grid_lines = grid.plan_interactions(skip=done['interaction'])
+        for kind in ['interaction', 'verb', 'object']:
+            print('Resuming: {} {}s already saved, {} remaining'.format(len(done[kind]), kind,
+                                                                      sum(1 for line in plan if line[0] == kind) + (len(grid_lines) if kind == 'interaction' else 0)))
+
+    # Pruned lines stay saved, but their 0 was never observed: they are left out of the estimates and of the matrix
+    observed_done = dict(done, interaction={name: freq for name, freq in done['interaction'].items() if name not in pruned_done})
+
+    num_interactions = sum(1 for kind, _, _ in plan if kind == 'interaction') + len(grid_lines)
+    num_verbs = sum(1 for kind, _, _ in plan if kind == 'verb')
+    num_objects = sum(1 for kind, _, _ in plan if kind == 'object')
+
+    if args.dry_run:
+        queries = unique_queries(itertools.chain(plan, grid_lines))
+        num_queries = sum(len(line_queries) for _, _, line_queries in itertools.chain(plan, grid_lines))
+        num_cached = sum(1 for query in queries if cache is not None and cache.contains(query))
+        print('{} interactions, {} verbs, {} objects'.format(num_interactions, num_verbs, num_objects))
+        print('{} queries, {} unique, {} cached: {} network calls'.format(num_queries, len(queries), num_cached, len(queries) - num_cached))
+        if expand:
+            print('{} concrete variants'.format(sum(len(ngrams_expand.query_variants(query)) for query in queries)))
+        raise SystemExit
+
+    # Every line is written (and flushed) as soon as it is available
+    output_files = {}
+    if args.save:
+        # Pruned pairs are saved with frequency 0 and the reason why they were pruned (see PRUNED_BELOW and PRUNED_TOP_K)
+        output_files['interaction'] = open_checkpoint(file_name_freq, 'Verb,Object,Frequency' + (',Pruned' if pruning else ''), resume=args.resume)
+        output_files['verb'] = open_checkpoint(file_name_verbs, 'Verb,Frequency', resume=args.resume)
+        output_files['object'] = open_checkpoint(file_name_objects, 'Object,Frequency', resume=args.resume)
+        if expand:
+            # Variants that contributed to every saved frequency (verb lines have no object and object lines no verb)
+            output_files['variants'] = open_checkpoint(file_name_variants, 'Verb,Object,Variant,Frequency', resume=args.resume)
+
+    progress_bars = {}
+    if args.parallel:
+        # We use tqdm to show a progress bar for each output
+        import tqdm
+        for position, (kind, total) in enumerate([('verb', num_verbs), ('object', num_objects), ('interaction', num_interactions)]):
+            if total > 0:
+                progress_bars[kind] = tqdm.tqdm(total=total, desc='{}s'.format(kind.capitalize()), position=position)
+
+    # Interaction frequencies are written by index into the matrix, if we save it
+    matrix = None
+    if args.save_matrix:
+        if grid is None:
+            grid = CombinationGrid([action[0] for action in base_actions], [action[1] for action in base_actions])
+        matrix = grid.empty_matrix()
+        for name, freq in observed_done['interaction'].items():
+            if grid.pair_index(name) is not None:
+                matrix[grid.pair_index(name)] = freq
+    variants = {} if expand else None
+
+    execute_args = {'parallel': args.parallel, 'concurrency': args.concurrency, 'limit_per_host': args.limit_per_host, 'expand': expand, 'variants': variants}
+    if pruning:
+        lines = execute_pruned(plan, prune_below=args.prune_below, top_k=args.top_k, top_k_by=args.top_k_by, sample_size=args.prune_sample,
+                               done=observed_done, **execute_args)
+    else:
+        lines = ((kind, name, freq, 0) for kind, name, freq in itertools.chain(execute_plan(plan, **execute_args), execute_plan(grid_lines, **execute_args)))
+    num_pruned = 0
+
+    for kind, name, freq, pruned in lines:
+        if pruned:
+            num_pruned += 1
+            freq = 0
+        line_contents = '{},{}'.format(','.join(name), freq) + (' (pruned)' if pruned else '')
+        if kind == 'interaction' and matrix is not None and not pruned and grid.pair_index(name) is not None:
+            matrix[grid.pair_index(name)] = freq
+        if variants is not None:
+            line_variants = variants.pop((kind, name), {})
+            if 'variants' in output_files:
+                labels = {'interaction': list(name), 'verb': [name[0], ''], 'object': ['', name[0]]}[kind]
+                for variant, variant_freq in sorted(line_variants.items()):
+                    hoi_io.write_csv_row(output_files['variants'], labels + [variant, variant_freq])
+            elif kind not in progress_bars:
+                line_contents += ' ({})'.format(', '.join('{}: {}'.format(variant, variant_freq) for variant, variant_freq in sorted(line_variants.items())))
+        if kind in output_files:
+            hoi_io.write_csv_row(output_files[kind], list(name) + [freq] + ([pruned] if pruning and kind == 'interaction' else []))
+            output_files[kind].flush()
+        if kind in progress_bars:
+            progress_bars[kind].update(1)
+        else:
             print(line_contents)
 
-        file_name_objects = '{}_ngrams_objects.csv'.format(file_name)
-        with open(file_name_objects, 'w') as file:
-            file.write('Object,Frequency\n')
-            file.write('\n'.join(results_objects))
\ No newline at end of file
+    for progress_bar in progress_bars.values():
+        progress_bar.close()
+    if pruning:
+        print('{} of {} interactions pruned'.format(num_pruned, num_interactions))
+    for output_file in output_files.values():
+        output_file.close()
+
+    if args.save and args.format == 'parquet':
+        # The CSV files are kept, since they are the checkpoints of --resume
+        for file_name_table in [file_name_freq, file_name_verbs, file_name_objects]:
+            file_name_parquet = hoi_io.table_path(os.path.splitext(file_name_table)[0], 'parquet')
+            hoi_io.csv_to_parquet(file_name_table, file_name_parquet)
+            print('Saved {}'.format(file_name_parquet))
+
+    if args.save_matrix:
+        file_name = os.path.splitext(os.path.basename(args.file))[0] if args.file else 'text'
+        file_name_matrix = '{}_ngrams_matrix.npz'.format(file_name)
+        grid.save_matrix(file_name_matrix, matrix)
+        print('Frequency matrix ({} verbs x {} objects) saved to {}'.format(len(grid.verbs), len(grid.objects), file_name_matrix))
+
+    ngrams_api.teardown()
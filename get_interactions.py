@@ -2,40 +2,183 @@
 # -*- coding: utf-8 -*-
 
 import os
+import json
+import hashlib
 import argparse
-import torch
+import hoi_counts
+import hoi_io
 
+# Keys of the annotation file that we actually use
+NEEDED_KEYS = ['objects', 'verbs', 'interactions', 'num_annotations_per_interaction', 'num_annotations_per_verb', 'rare_interaction_ids']
 
-def process_file(file_path):
-    file = torch.load(file_path, weights_only=False)
+
+SIGNATURE_BYTES = 1 << 20  # Bytes hashed at the start and at the end of a file by file_signature
+
+
+def file_signature(file_path):
+    # Identifies a version of a file without reading all of it (checkpoints take GBs): its size, modification time
+    # and a hash of its first and last SIGNATURE_BYTES
+    stat = os.stat(file_path)
+    sha256 = hashlib.sha256('{}:{}'.format(stat.st_size, stat.st_mtime_ns).encode())
+    with open(file_path, 'rb') as file:
+        sha256.update(file.read(SIGNATURE_BYTES))
+        if stat.st_size > SIGNATURE_BYTES:
+            file.seek(max(SIGNATURE_BYTES, stat.st_size - SIGNATURE_BYTES))
+            sha256.update(file.read(SIGNATURE_BYTES))
+    return sha256.hexdigest()
+
+
+def to_plain(value):
+    # Tensors and arrays become (nested) lists, so they can be stored as JSON
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [to_plain(item) for item in value]
+    if isinstance(value, dict):
+        return {key: to_plain(item) for key, item in value.items()}
+    return value
+
+
+def load_checkpoint(file_path, keys=NEEDED_KEYS, annotations_key=None):
+    # torch is only imported when we really have to read the checkpoint
+    import torch
+
+    # With mmap, tensor storages stay on disk until they are accessed (instead of reading the whole file)
+    try:
+        file = torch.load(file_path, weights_only=False, mmap=True, map_location='cpu')
+    except RuntimeError:
+        file = torch.load(file_path, weights_only=False, map_location='cpu')  # Legacy (non-zip) checkpoints cannot be memory-mapped
+
+    # We only keep the keys we need, so everything else can be freed right away
+    data = {key: to_plain(file[key]) for key in keys if key != annotations_key}
+    if annotations_key is not None:
+        # From the per-image annotations we only keep the ids
+        data[annotations_key] = hoi_counts.compact_annotations(file[annotations_key])
+    del file
+    return data
+
+
+def sidecar_path(file_path, sidecar_dir=None):
+    if sidecar_dir is None:
+        sidecar_dir = os.path.dirname(os.path.abspath(file_path))
+    return os.path.join(sidecar_dir, '{}.hoi.json'.format(os.path.basename(file_path)))
+
+
+def load_annotations(file_path, sidecar_dir=None, use_sidecar=True, annotations_key=None):
+    # Returns the NEEDED_KEYS (and the per-image annotations in annotations_key, if given) of the annotation file.
+    # The first time, they are also extracted to a small JSON sidecar (tagged with the signature of the source file),
+    # so later runs do not need torch nor the full load.
+    keys = list(NEEDED_KEYS)
+    if annotations_key is not None:
+        keys.append(annotations_key)
+
+    if not use_sidecar:
+        return load_checkpoint(file_path, keys, annotations_key)
+
+    source_signature = file_signature(file_path)
+    cache_path = sidecar_path(file_path, sidecar_dir)
+    data = {}
+    sidecar = read_sidecar(cache_path)
+    if sidecar is not None and sidecar.get('source_signature') == source_signature:
+        data = sidecar['data']
+        if all(key in data for key in keys):
+            return data
+
+    # The keys already in the sidecar are kept, so it grows with what we need
+    data.update(load_checkpoint(file_path, keys, annotations_key))
+    write_sidecar(cache_path, {'source': os.path.basename(file_path), 'source_signature': source_signature, 'data': data})
+    return data
+
+
+def read_sidecar(cache_path):
+    # An unreadable sidecar (e.g. truncated by an older version) is a miss: it is rebuilt from the checkpoint
+    try:
+        with open(cache_path, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_sidecar(cache_path, sidecar):
+    # The sidecar is only a cache, so a directory we cannot write to (e.g. a read-only dataset) is not an error.
+    # It is written to a temporary file first, so an interrupted run never leaves a truncated sidecar behind.
+    temp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(temp_path, 'w') as file:
+            json.dump(sidecar, file)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        print('Warning: could not write the annotation sidecar {} ({}), use --sidecar-dir to store it elsewhere'.format(cache_path, e))
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def build_hoi_data(objects, verbs, interactions, object_freqs, verb_freqs, interaction_freqs, rare_interaction_ids):
     hoi_data = {}
 
     # We first get the objects and their frequencies
     hoi_data['objects'] = {}
-    objects = file['objects']
-    object_freqs = file['num_annotations_per_verb']
     for obj, freq in zip(objects, object_freqs):
-        hoi_data['objects'][obj[1]] = freq
+        hoi_data['objects'][obj[1]] = int(freq)
     
     # We then get the verbs and their frequencies
     hoi_data['verbs'] = {}
-    verbs = file['verbs']
-    verb_freqs = file['num_annotations_per_verb']
     for verb, freq in zip(verbs, verb_freqs):
-        hoi_data['verbs'][verb[1]] = freq
+        hoi_data['verbs'][verb[1]] = int(freq)
     
     # We then get the interactions and their frequencies
     hoi_data['interactions'] = {}
-    interactions = file['interactions']
-    interaction_freqs = file['num_annotations_per_interaction']
-    interaction_rare = set(file['rare_interaction_ids'])
+    interaction_rare = set(rare_interaction_ids)
     for int_num, (interaction, freq) in enumerate(zip(interactions, interaction_freqs)):
-        interaction_name = '{},{}'.format(interaction[1][1], interaction[1][0])  # <verb>,<object>
+        interaction_name = (interaction[1][1], interaction[1][0])  # (<verb>, <object>)
         is_rare = 1 if int_num in interaction_rare else 0
-        hoi_data['interactions'][interaction_name] = '{},{}'.format(freq, is_rare)  # What kind of data structure is this? Am I stupid?
+        hoi_data['interactions'][interaction_name] = (int(freq), is_rare)
     
     return hoi_data
 
+def process_file(file_path, sidecar_dir=None, use_sidecar=True):
+    file = load_annotations(file_path, sidecar_dir=sidecar_dir, use_sidecar=use_sidecar)
+    return build_hoi_data(file['objects'], file['verbs'], file['interactions'],
+                          file['num_annotations_per_verb'], file['num_annotations_per_verb'], file['num_annotations_per_interaction'],
+                          file['rare_interaction_ids'])
+
+def process_annotations(file_path, annotations_key='annotations', sidecar_dir=None, use_sidecar=True, workers=1, rare_threshold=10):
+    # Counts the frequencies from the raw per-image annotations instead of trusting the precomputed arrays.
+    # Returns {split: hoi_data}. An interaction is rare if it has fewer than rare_threshold annotations in the split.
+    file = load_annotations(file_path, sidecar_dir=sidecar_dir, use_sidecar=use_sidecar, annotations_key=annotations_key)
+    objects, verbs, interactions = file['objects'], file['verbs'], file['interactions']
+    lookup = hoi_counts.pair_lookup(interactions, verbs, objects)
+
+    hoi_data_splits = {}
+    for split, images in hoi_counts.split_annotations(file[annotations_key]).items():
+        interaction_freqs, verb_freqs, object_freqs = hoi_counts.count_annotations(images, len(interactions), len(verbs), len(objects),
+                                                                                   lookup=lookup, workers=workers)
+        rare_interaction_ids = [int(interaction_id) for interaction_id in (interaction_freqs < rare_threshold).nonzero()[0]]
+        hoi_data_splits[split] = build_hoi_data(objects, verbs, interactions, object_freqs.tolist(), verb_freqs.tolist(),
+                                                interaction_freqs.tolist(), rare_interaction_ids)
+    return hoi_data_splits
+
+def hoi_data_tables(hoi_data):
+    # Returns the tables of interactions, objects and verbs (with their frequencies) as DataFrames
+    import pandas as pd
+    rows = [(verb, obj, freq, is_rare) for (verb, obj), (freq, is_rare) in hoi_data['interactions'].items()]
+    return {
+        'interactions': pd.DataFrame(rows, columns=['Verb', 'Object', 'Frequency', 'IsRare']),
+        'objects': pd.DataFrame(list(hoi_data['objects'].items()), columns=['Object', 'Frequency']),
+        'verbs': pd.DataFrame(list(hoi_data['verbs'].items()), columns=['Verb', 'Frequency']),
+    }
+
+def save_hoi_data(hoi_data, file_name, fmt='csv'):
+    # We will save a table with the interactions, one with the objects and one with the verbs (and their frequencies)
+    tables = hoi_data_tables(hoi_data)
+    file_names = []
+    for table in ['interactions', 'objects', 'verbs']:
+        file_names.append(hoi_io.table_path('{}_{}'.format(file_name, table), fmt))
+        hoi_io.write_table(tables[table], file_names[-1])
+
+    print('Files saved as: {}, {}, {}'.format(*file_names))
+
 def process_text(text):
     text = text.strip()
     action = text.split(',')
@@ -46,38 +189,26 @@ def process_text(text):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Retrieve HOI interactions')
     parser.add_argument('--file', help='Path to the input file', required=True)
+    parser.add_argument('--sidecar-dir', default=None, help='Directory of the extracted annotations cache (defaults to the directory of the input file)')
+    parser.add_argument('--no-sidecar', action='store_true', help='Always load the full annotation file')
+    parser.add_argument('--from-annotations', action='store_true', help='Count the frequencies from the raw per-image annotations (one set of files per split)')
+    parser.add_argument('--annotations-key', default='annotations', help='Key of the per-image annotations in the input file')
+    parser.add_argument('--splits', default=None, help='Comma-separated splits to save (defaults to all of them)')
+    parser.add_argument('--workers', type=int, default=1, help='Processes used to count the annotations')
+    hoi_io.add_format_argument(parser)
+    parser.add_argument('--rare-threshold', type=int, default=10, help='Interactions with fewer annotations are rare (with --from-annotations)')
 
     args = parser.parse_args()
 
-    if args.file:
-        hoi_data = process_file(args.file)
-    else:
-        print("Please provide either a file or text as input.")
-        raise SystemExit
-    
-    # We will save csv file with the interactions and their frequencies
     # we get name without extension of file
     file_name = os.path.splitext(os.path.basename(args.file))[0]
-    file_name_interactions = '{}_interactions.csv'.format(file_name)
-    with open(file_name_interactions, 'w') as file:
-        file.write('Verb,Object,Frequency,IsRare\n')
-        for interaction, freq in hoi_data['interactions'].items():
-            verb, obj = interaction.split(',')
-            freq, is_rare = freq.split(',')
-            file.write('{},{},{},{}\n'.format(verb, obj, freq, is_rare))
-    
-    # We will save csv file with the objects and their frequencies
-    file_name_objects = '{}_objects.csv'.format(file_name)
-    with open(file_name_objects, 'w') as file:
-        file.write('Object,Frequency\n')
-        for obj, freq in hoi_data['objects'].items():
-            file.write('{},{}\n'.format(obj, freq))
-    
-    # We will save csv file with the verbs and their frequencies
-    file_name_verbs = '{}_verbs.csv'.format(file_name)
-    with open(file_name_verbs, 'w') as file:
-        file.write('Verb,Frequency\n')
-        for verb, freq in hoi_data['verbs'].items():
-            file.write('{},{}\n'.format(verb, freq))
-
-    print('Files saved as: {}, {}, {}'.format(file_name_interactions, file_name_objects, file_name_verbs))
\ No newline at end of file
+
+    if args.from_annotations:
+        hoi_data_splits = process_annotations(args.file, annotations_key=args.annotations_key, sidecar_dir=args.sidecar_dir,
+                                              use_sidecar=not args.no_sidecar, workers=args.workers, rare_threshold=args.rare_threshold)
+        splits = args.splits.split(',') if args.splits else list(hoi_data_splits)
+        for split in splits:
+            save_hoi_data(hoi_data_splits[split], '{}_{}'.format(file_name, split), fmt=args.format)
+    else:
+        hoi_data = process_file(args.file, sidecar_dir=args.sidecar_dir, use_sidecar=not args.no_sidecar)
+        save_hoi_data(hoi_data, file_name, fmt=args.format)
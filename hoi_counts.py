@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing as mp
+import numpy as np
+
+# Counts interactions, verbs and objects from raw per-image HOI annotations, so frequencies can be computed
+# for any split, subset or dataset (not only for the ones shipping precomputed num_annotations_per_* arrays).
+# Each image is a dict with one entry per annotated pair, e.g. {'hoi': [...], 'verb': [...], 'object': [...]}.
+
+ANNOTATION_FIELDS = ['hoi', 'verb', 'object']
+
+
+def compact_annotations(annotations, fields=ANNOTATION_FIELDS):
+    # Keeps only the id fields of every image (dropping boxes, file names...), as plain lists
+    def compact_image(image):
+        return {field: [int(value) for value in np.asarray(image[field]).reshape(-1)] for field in fields if field in image}
+
+    if isinstance(annotations, dict):
+        return {split: [compact_image(image) for image in images] for split, images in annotations.items()}
+    return [compact_image(image) for image in annotations]
+
+
+def split_annotations(annotations):
+    # Annotations are either {split: [images]} or a single list of images
+    if isinstance(annotations, dict):
+        return annotations
+    return {'all': annotations}
+
+
+def flatten_ids(images, field):
+    # All the ids of a field, for every image, as one flat array
+    arrays = [np.asarray(image[field], dtype=np.int64).reshape(-1) for image in images if field in image]
+    if len(arrays) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(arrays)
+
+
+def pair_lookup(interactions, verbs, objects):
+    # Dense [verb id, object id] -> interaction id table (-1 for pairs that are not an interaction)
+    verb_ids = {verb[1]: verb_id for verb_id, verb in enumerate(verbs)}
+    object_ids = {obj[1]: obj_id for obj_id, obj in enumerate(objects)}
+    lookup = np.full((len(verbs), len(objects)), -1, dtype=np.int64)
+    for interaction_id, interaction in enumerate(interactions):
+        obj, verb = interaction[1]
+        lookup[verb_ids[verb], object_ids[obj]] = interaction_id
+    return lookup
+
+
+def count_shard(images, num_interactions, num_verbs, num_objects, lookup=None):
+    verb_ids = flatten_ids(images, 'verb')
+    object_ids = flatten_ids(images, 'object')
+
+    # The format is decided per image, since a dataset may mix both
+    with_hoi = [image for image in images if 'hoi' in image]
+    without_hoi = [image for image in images if 'hoi' not in image]
+    interaction_ids = flatten_ids(with_hoi, 'hoi')
+    if without_hoi:
+        # Without interaction ids, we derive them from the (verb, object) of each pair
+        if lookup is None:
+            raise ValueError('Some images have no interaction ids, and there is no (verb, object) lookup to derive them')
+        derived_ids = lookup[flatten_ids(without_hoi, 'verb'), flatten_ids(without_hoi, 'object')]
+        interaction_ids = np.concatenate([interaction_ids, derived_ids[derived_ids >= 0]])
+
+    return (np.bincount(interaction_ids, minlength=num_interactions),
+            np.bincount(verb_ids, minlength=num_verbs),
+            np.bincount(object_ids, minlength=num_objects))
+
+
+def _count_shard_star(args):
+    return count_shard(*args)
+
+
+def count_annotations(images, num_interactions, num_verbs, num_objects, lookup=None, workers=1, shard_size=10000):
+    # Returns (interaction counts, verb counts, object counts). With workers > 1, shards of images are counted
+    # in parallel processes and then added up.
+    shards = [images[start:start + shard_size] for start in range(0, len(images), shard_size)] or [[]]
+    jobs = [(shard, num_interactions, num_verbs, num_objects, lookup) for shard in shards]
+
+    if workers > 1 and len(shards) > 1:
+        with mp.Pool(min(workers, len(shards))) as pool:
+            partial_counts = pool.map(_count_shard_star, jobs)
+    else:
+        partial_counts = [_count_shard_star(job) for job in jobs]
+
+    return tuple(np.sum([counts[num_field] for counts in partial_counts], axis=0) for num_field in range(3))
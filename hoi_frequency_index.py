@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import numpy as np
+import pandas as pd
+import hoi_io
+import ngrams_api
+
+# In-process lookups of the frequencies of a merged table (the output of merge_datasets.py), e.g. to reweight rare
+# interactions while training. The table is loaded once into dense verb x object arrays (one per source: the ngrams and
+# every dataset), so batched lookups of verb and object ids are a single vectorized indexing. Ids follow the order of
+# the verbs and objects given to the index (e.g. the ones of the model), or the sorted labels of the table.
+# Pairs missing in the table (or pruned by get_freq_ngrams.py) can be fetched from the ngrams API on first use.
+
+NGRAMS_SOURCE = 'ngrams'
+PRIOR_MODES = ['joint', 'verb', 'object']  # p(verb, object), p(object | verb) and p(verb | object)
+
+
+def to_numpy(ids):
+    # Tensors (e.g. torch) are moved to the CPU, so this does not import torch for numpy inputs
+    if hasattr(ids, 'cpu') and hasattr(ids, 'numpy'):
+        return ids.cpu().numpy()
+    return np.asarray(ids)
+
+
+def like(values, ids):
+    # Result with the type (and device) of the ids it was looked up for
+    if hasattr(ids, 'cpu') and hasattr(ids, 'numpy'):
+        import torch
+        return torch.from_numpy(np.ascontiguousarray(values)).to(ids.device)
+    return values
+
+
+def check_ids(ids, size, kind):
+    # Negative ids (the -1 of unknown labels) would silently wrap around in the lookups, and larger ones fail obscurely
+    if ids.size > 0 and (ids.min() < 0 or ids.max() >= size):
+        raise ValueError('{} ids must be between 0 and {} (unknown labels have id -1)'.format(kind, size - 1))
+    return ids
+
+
+class HOIFrequencyIndex:
+
+    def __init__(self, df, verbs=None, objects=None, fallback=False, parse_underscore=True, parallel=False, expand=False):
+        # df is a merged table (wide layout). With fallback, the ngrams frequency of pairs that are not in it is fetched
+        # (with the queries of get_freq_ngrams.py, parse_underscore and expand as when the table was retrieved).
+        self.verbs = pd.Index(verbs if verbs is not None else sorted(df['Verb'].astype(str).unique()), dtype=str)
+        self.objects = pd.Index(objects if objects is not None else sorted(df['Object'].astype(str).unique()), dtype=str)
+        self.sources = [column[len('Interaction_freq_'):] for column in df.columns if column.startswith('Interaction_freq_')]
+        self.datasets = [source for source in self.sources if source != NGRAMS_SOURCE]
+        self.fallback = fallback
+        self.parse_underscore = parse_underscore
+        self.parallel = parallel
+        self.expand = expand
+
+        # Rows of the table whose verb and object have an id
+        verb_codes = self.verbs.get_indexer(df['Verb'].astype(str))
+        object_codes = self.objects.get_indexer(df['Object'].astype(str))
+        valid = (verb_codes >= 0) & (object_codes >= 0)
+        verb_codes, object_codes = verb_codes[valid], object_codes[valid]
+        shape = (len(self.verbs), len(self.objects))
+
+        self.interaction_freqs, self.verb_freqs, self.object_freqs, self.rare = {}, {}, {}, {}
+        for source in self.sources:
+            freqs = np.zeros(shape, dtype=np.int64)
+            freqs[verb_codes, object_codes] = df['Interaction_freq_' + source].to_numpy()[valid]
+            self.interaction_freqs[source] = freqs
+            # Marginals are repeated on every row of a verb (or object)
+            self.verb_freqs[source] = np.zeros(len(self.verbs), dtype=np.int64)
+            self.verb_freqs[source][verb_codes] = df['Verb_freq_' + source].to_numpy()[valid]
+            self.object_freqs[source] = np.zeros(len(self.objects), dtype=np.int64)
+            self.object_freqs[source][object_codes] = df['Object_freq_' + source].to_numpy()[valid]
+        for dataset in self.datasets:
+            # -1 for the pairs that are not interactions of the dataset
+            self.rare[dataset] = np.full(shape, -1, dtype=np.int8)
+            self.rare[dataset][verb_codes, object_codes] = df['IsRare_' + dataset].to_numpy()[valid]
+
+        # Pairs whose ngrams frequency is known (in the table and not pruned)
+        self.known = np.zeros(shape, dtype=bool)
+        pruned = df['Pruned_' + NGRAMS_SOURCE].to_numpy()[valid] > 0 if 'Pruned_' + NGRAMS_SOURCE in df.columns else False
+        self.known[verb_codes, object_codes] = ~np.asarray(pruned)
+        self._update_totals()
+
+    @classmethod
+    def from_file(cls, file_path, **kwargs):
+        return cls(hoi_io.read_table(file_path), **kwargs)
+
+    def _update_totals(self):
+        # Normalizers of the priors, only recomputed when pairs are fetched
+        self.totals = {source: freqs.sum() for source, freqs in self.interaction_freqs.items()}
+        self.verb_totals = {source: freqs.sum(axis=1) for source, freqs in self.interaction_freqs.items()}
+        self.object_totals = {source: freqs.sum(axis=0) for source, freqs in self.interaction_freqs.items()}
+
+    def verb_ids(self, labels):
+        # Ids of verb labels (-1 if unknown, which the lookups reject)
+        return self.verbs.get_indexer(pd.Index(labels, dtype=str))
+
+    def object_ids(self, labels):
+        return self.objects.get_indexer(pd.Index(labels, dtype=str))
+
+    def fetch_missing(self, verb_ids, object_ids):
+        # Fetches the ngrams frequency of the pairs that are not known yet (each one only once)
+        keys = np.unique(np.ravel_multi_index((verb_ids, object_ids), self.known.shape))
+        keys = keys[~self.known.ravel()[keys]]
+        if len(keys) == 0:
+            return
+
+        # Only needed for the fallback, which most uses of the index never hit
+        import get_freq_ngrams
+        verb_codes, object_codes = np.unravel_index(keys, self.known.shape)
+        base_actions = [[self.verbs[verb_code], self.objects[object_code]] for verb_code, object_code in zip(verb_codes, object_codes)]
+        actions = get_freq_ngrams.parse_underscore(base_actions) if self.parse_underscore else base_actions
+        plan = get_freq_ngrams.plan_queries(list(zip(actions, base_actions)), expand=self.expand)
+        codes = {tuple(action): (verb_code, object_code) for action, verb_code, object_code in zip(base_actions, verb_codes, object_codes)}
+        for _, name, freq in get_freq_ngrams.execute_plan(plan, parallel=self.parallel, expand=self.expand):
+            self.interaction_freqs[NGRAMS_SOURCE][codes[name]] = freq
+            self.known[codes[name]] = True
+        self._update_totals()
+
+    def _verbs(self, verb_ids):
+        return check_ids(to_numpy(verb_ids), len(self.verbs), 'Verb')
+
+    def _objects(self, object_ids):
+        return check_ids(to_numpy(object_ids), len(self.objects), 'Object')
+
+    def _pairs(self, verb_ids, object_ids, source):
+        verb_ids, object_ids = self._verbs(verb_ids), self._objects(object_ids)
+        if self.fallback and source == NGRAMS_SOURCE:
+            self.fetch_missing(verb_ids, object_ids)
+        return verb_ids, object_ids
+
+    def interaction_counts(self, verb_ids, object_ids, source=NGRAMS_SOURCE):
+        # Frequency of every (verb, object) pair of the ids (arrays or tensors of the same shape), 0 if unknown
+        verbs, objects = self._pairs(verb_ids, object_ids, source)
+        return like(self.interaction_freqs[source][verbs, objects], verb_ids)
+
+    def verb_counts(self, verb_ids, source=NGRAMS_SOURCE):
+        return like(self.verb_freqs[source][self._verbs(verb_ids)], verb_ids)
+
+    def object_counts(self, object_ids, source=NGRAMS_SOURCE):
+        return like(self.object_freqs[source][self._objects(object_ids)], object_ids)
+
+    def is_known(self, verb_ids, object_ids):
+        # Whether the ngrams frequency of the pairs was retrieved (False for missing or pruned pairs, without fallback)
+        return like(self.known[self._verbs(verb_ids), self._objects(object_ids)], verb_ids)
+
+    def is_rare(self, verb_ids, object_ids, dataset=None):
+        # IsRare flag of the pairs in a dataset (the first one by default): 1 rare, 0 not rare, -1 not an interaction of it
+        if len(self.datasets) == 0:
+            raise ValueError('The table has no dataset columns (IsRare_<dataset>), so there are no rare flags')
+        dataset = dataset or self.datasets[0]
+        if dataset not in self.rare:
+            raise ValueError('Unknown dataset {} (expected one of {})'.format(dataset, ', '.join(self.datasets)))
+        return like(self.rare[dataset][self._verbs(verb_ids), self._objects(object_ids)], verb_ids)
+
+    def priors(self, verb_ids, object_ids, source=NGRAMS_SOURCE, mode='joint', smoothing=1.0):
+        # Additive smoothed priors of the pairs, from the interaction frequencies of a source: p(verb, object) with mode
+        # 'joint', p(object | verb) with 'verb' and p(verb | object) with 'object'
+        verbs, objects = self._pairs(verb_ids, object_ids, source)
+        freqs = self.interaction_freqs[source][verbs, objects] + smoothing
+        num_verbs, num_objects = self.known.shape
+        if mode == 'joint':
+            priors = freqs / (self.totals[source] + smoothing * num_verbs * num_objects)
+        elif mode == 'verb':
+            priors = freqs / (self.verb_totals[source][verbs] + smoothing * num_objects)
+        elif mode == 'object':
+            priors = freqs / (self.object_totals[source][objects] + smoothing * num_verbs)
+        else:
+            raise ValueError('Unknown prior mode {} (expected one of {})'.format(mode, ', '.join(PRIOR_MODES)))
+        return like(priors, verb_ids)
+
+
+if __name__ == '__main__':
+    # Quick check of the lookups of a merged table
+    parser = argparse.ArgumentParser(description='Frequencies and priors of HOI pairs from a merged table')
+    parser.add_argument('--file', help='Path to the merged table (see merge_datasets.py)', required=True)
+    parser.add_argument('--text', help='Pairs to look up, as verb,object;verb,object...', required=True)
+    parser.add_argument('--fallback', action='store_true', help='Fetch the ngrams frequency of the pairs missing in the table')
+    ngrams_api.add_api_arguments(parser)
+
+    args = parser.parse_args()
+
+    ngrams_api.setup_from_args(args)
+    index = HOIFrequencyIndex.from_file(args.file, fallback=args.fallback)
+    pairs = [[label.strip() for label in pair.split(',')] for pair in args.text.split(';')]
+    verb_ids = index.verb_ids([pair[0] for pair in pairs])
+    object_ids = index.object_ids([pair[1] for pair in pairs])
+    if (verb_ids < 0).any() or (object_ids < 0).any():
+        print('Unknown verbs or objects: {}'.format([pair for pair, verb_id, object_id in zip(pairs, verb_ids, object_ids) if verb_id < 0 or object_id < 0]))
+        raise SystemExit
+
+    for source in index.sources:
+        print('{}: counts {}, p(verb, object) {}, p(object | verb) {}'.format(
+            source, index.interaction_counts(verb_ids, object_ids, source).tolist(),
+            np.round(index.priors(verb_ids, object_ids, source), 6).tolist(), np.round(index.priors(verb_ids, object_ids, source, mode='verb'), 6).tolist()))
+    for dataset in index.datasets:
+        print('{}: rare {}'.format(dataset, index.is_rare(verb_ids, object_ids, dataset).tolist()))
+
+    ngrams_api.teardown()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+import os
+import csv
+
+# Tables exchanged between the scripts. They can be CSV (as always) or Parquet, where label columns are stored
+# as integer-coded categoricals and counts as int64, so loading them needs no parsing and labels may contain commas.
+# pandas is only imported to read tables, so the scripts that only append CSV rows start faster.
+
+FORMATS = ['csv', 'parquet']
+LABEL_COLUMNS = ['Dataset', 'Interaction', 'Verb', 'Object', 'Variant']
+
+
+def table_path(file_name, fmt='csv'):
+    # file_name without extension -> path with the extension of the format
+    return '{}.{}'.format(file_name, fmt)
+
+
+def table_format(file_path):
+    return 'parquet' if os.path.splitext(file_path)[1] in ('.parquet', '.pq') else 'csv'
+
+
+def typed_frame(df):
+    # Label columns become categoricals and every other column int64 (counts and flags)
+    df = df.copy()
+    for column in df.columns:
+        if column in LABEL_COLUMNS:
+            df[column] = df[column].astype(str).astype('category')
+        else:
+            df[column] = df[column].astype('int64')
+    return df
+
+
+def write_table(df, file_path):
+    if table_format(file_path) == 'parquet':
+        typed_frame(df).to_parquet(file_path, index=False)
+    else:
+        df.to_csv(file_path, index=False)
+
+
+def read_table(file_path, columns=None):
+    # Parquet label columns come back as categoricals (CSV ones as strings). With columns, only those are read.
+    import pandas as pd
+    if table_format(file_path) == 'parquet':
+        return pd.read_parquet(file_path, columns=columns)
+    return pd.read_csv(file_path, header=0, usecols=columns)
+
+
+def csv_to_parquet(csv_path, parquet_path):
+    import pandas as pd
+    write_table(pd.read_csv(csv_path, header=0), parquet_path)
+
+
+def write_csv_row(file, row):
+    # Quotes the fields that need it (e.g. labels with commas)
+    csv.writer(file, lineterminator='\n').writerow(row)
+
+
+def parse_csv_line(line):
+    return next(csv.reader([line]))
+
+
+def add_format_argument(parser):
+    parser.add_argument('--format', choices=FORMATS, default='csv', help='Format of the output tables')
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import argparse
+import numpy as np
+import pandas as pd
+import hoi_io
+
+# Correlation statistics of a merged table (see merge_datasets.py), without plotting: Pearson on raw and log1p counts,
+# Spearman and Kendall, with percentile bootstrap confidence intervals. Every bootstrap replicate is a row of a
+# resampling matrix (of counts), and the statistics are computed for all the rows at once (in batches that bound the memory).
+
+METRICS = ['pearson', 'pearson_log1p', 'spearman', 'kendall']
+# (name, ngrams column, HOI column, label column). Verbs and objects have one row per label in the statistics.
+PAIRS = [
+    ('interaction', 'Interaction_freq_ngrams', 'Interaction_freq_hoi', None),
+    ('verb', 'Verb_freq_ngrams', 'Verb_freq_hoi', 'Verb'),
+    ('object', 'Object_freq_ngrams', 'Object_freq_hoi', 'Object'),
+]
+# Rarity groups of the interactions (by IsRare_hoi)
+GROUPS = {'all': None, 'in_hoi': [0, 1], 'not_rare': [0], 'rare': [1]}
+STATS_COLUMNS = ['Verb', 'Object', 'Interaction_freq_ngrams',  'Verb_freq_ngrams', 'Object_freq_ngrams', 'Interaction_freq_hoi', 'Verb_freq_hoi', 'Object_freq_hoi', 'IsRare_hoi']
+
+DEFAULT_BOOTSTRAP = 1000
+DEFAULT_CONFIDENCE = 0.95
+DEFAULT_KENDALL_MAX_ROWS = 3000  # Kendall replicates use n x n matrices of pairs, so larger groups get no Kendall CI
+MAX_BATCH_ELEMENTS = 10 ** 7  # Maximum size of the arrays of a batch of replicates
+
+
+def pearson_weights(weights, x, y):
+    # Pearson correlation of x and y for every row of weights (number of times each element is drawn), NaN if constant.
+    # x and y are (n,) arrays or have one row per row of weights.
+    total = weights.sum(axis=1, keepdims=True)
+    x = x - (weights * x).sum(axis=1, keepdims=True) / total
+    y = y - (weights * y).sum(axis=1, keepdims=True) / total
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (weights * x * y).sum(axis=1) / np.sqrt((weights * x * x).sum(axis=1) * (weights * y * y).sum(axis=1))
+
+
+def weighted_ranks(weights, values):
+    # Average rank of every element in each resample (ties share their average rank), without sorting every resample:
+    # the counts of the unique values are accumulated in the order of the values
+    unique_values, inverse = np.unique(values, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    starts = np.searchsorted(inverse[order], np.arange(len(unique_values)))
+    counts = np.add.reduceat(weights[:, order], starts, axis=1)
+    ranks = np.cumsum(counts, axis=1) - (counts - 1) / 2
+    return ranks[:, inverse]
+
+
+def spearman_weights(weights, x, y):
+    return pearson_weights(weights, weighted_ranks(weights, x), weighted_ranks(weights, y))
+
+
+def kendall_matrices(x, y):
+    # Signs of the differences of every pair of elements: concordance (x and y) and non-ties in x and in y
+    sign_x = np.sign(x[:, None] - x[None, :]).astype(np.float32)
+    sign_y = np.sign(y[:, None] - y[None, :]).astype(np.float32)
+    return sign_x * sign_y, np.abs(sign_x), np.abs(sign_y)
+
+
+def kendall_weights(weights, concordance, untied_x, untied_y):
+    # Kendall tau-b of every row of weights. Each sum over pairs of a resample is the quadratic form w^T M w.
+    weights = weights.astype(np.float32)
+
+    def pair_sum(matrix):
+        return ((weights @ matrix) * weights).sum(axis=1, dtype=np.float64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return pair_sum(concordance) / np.sqrt(pair_sum(untied_x) * pair_sum(untied_y))
+
+
+def estimate(metric, x, y):
+    if metric == 'kendall':
+        # O(n log n), instead of comparing every pair
+        from scipy.stats import kendalltau
+        return float(kendalltau(x, y).statistic)
+    if metric == 'pearson_log1p':
+        x, y = np.log1p(x), np.log1p(y)
+    weights = np.ones((1, len(x)))
+    if metric == 'spearman':
+        return float(spearman_weights(weights, x, y)[0])
+    return float(pearson_weights(weights, x, y)[0])
+
+
+def resample_counts(rng, n, num_samples):
+    # (num_samples, n) matrix of how many times each element is drawn in each resample of n draws
+    draws = rng.integers(0, n, size=(num_samples, n)) + n * np.arange(num_samples)[:, None]
+    return np.bincount(draws.ravel(), minlength=num_samples * n).reshape(num_samples, n).astype(np.float64)
+
+
+def bootstrap(metric, x, y, num_samples, rng):
+    # Statistic of num_samples resamples (with replacement) of the elements, as a (num_samples,) array. Resamples are
+    # the rows of a resampling matrix of counts (how many times each element is drawn), generated in batches.
+    n = len(x)
+    if metric == 'pearson_log1p':
+        x, y = np.log1p(x), np.log1p(y)
+    if metric == 'kendall':
+        matrices = kendall_matrices(x, y)
+    batch_size = max(1, MAX_BATCH_ELEMENTS // n)
+
+    replicates = []
+    for start in range(0, num_samples, batch_size):
+        weights = resample_counts(rng, n, min(batch_size, num_samples - start))
+        if metric == 'kendall':
+            replicates.append(kendall_weights(weights, *matrices))
+        elif metric == 'spearman':
+            replicates.append(spearman_weights(weights, x, y))
+        else:
+            replicates.append(pearson_weights(weights, x, y))
+    return np.concatenate(replicates) if replicates else np.zeros(0)
+
+
+def correlation_stats(x, y, num_samples=DEFAULT_BOOTSTRAP, confidence=DEFAULT_CONFIDENCE, kendall_max_rows=DEFAULT_KENDALL_MAX_ROWS, rng=None):
+    # {metric: (estimate, CI low, CI high)} of two arrays of counts. CIs are NaN if they cannot be computed.
+    rng = rng if rng is not None else np.random.default_rng(0)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    stats = {}
+    for metric in METRICS:
+        ci_low = ci_high = float('nan')
+        if len(x) > 1 and num_samples > 0 and (metric != 'kendall' or len(x) <= kendall_max_rows):
+            replicates = bootstrap(metric, x, y, num_samples, rng)
+            replicates = replicates[~np.isnan(replicates)]
+            if len(replicates) > 0:
+                ci_low, ci_high = np.percentile(replicates, [50 * (1 - confidence), 50 * (1 + confidence)])
+        stats[metric] = (estimate(metric, x, y) if len(x) > 1 else float('nan'), float(ci_low), float(ci_high))
+    return stats
+
+
+def stats_report(df, ignore_no_interaction=False, num_samples=DEFAULT_BOOTSTRAP, confidence=DEFAULT_CONFIDENCE,
+                 kendall_max_rows=DEFAULT_KENDALL_MAX_ROWS, seed=0):
+    # One record per pair (interaction, verb, object), group and metric. Rarity groups only apply to interactions.
+    if ignore_no_interaction:
+        df = df[df['Verb'] != 'no_interaction']
+    rng = np.random.default_rng(seed)
+
+    records = []
+    for pair, ngrams_column, hoi_column, label_column in PAIRS:
+        groups = GROUPS if label_column is None else {'all': None}
+        for group, rarity in groups.items():
+            rows = df if rarity is None else df[df['IsRare_hoi'].isin(rarity)]
+            if label_column is not None:
+                rows = rows.drop_duplicates(label_column)  # Every row of a verb (or object) has the same frequencies
+            stats = correlation_stats(rows[ngrams_column].to_numpy(), rows[hoi_column].to_numpy(), num_samples=num_samples,
+                                      confidence=confidence, kendall_max_rows=kendall_max_rows, rng=rng)
+            for metric, (value, ci_low, ci_high) in stats.items():
+                records.append({'pair': pair, 'group': group, 'n': len(rows), 'metric': metric, 'estimate': value, 'ci_low': ci_low, 'ci_high': ci_high})
+    return records
+
+
+def save_report(records, file_path, config=None):
+    # JSON (with the configuration) if the path ends with .json, CSV otherwise
+    if file_path.endswith('.json'):
+        # NaN is not valid JSON
+        clean = [{key: (None if isinstance(value, float) and np.isnan(value) else value) for key, value in record.items()} for record in records]
+        with open(file_path, 'w') as file:
+            json.dump({'config': config or {}, 'results': clean}, file, indent=2)
+    else:
+        pd.DataFrame(records).to_csv(file_path, index=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Correlation statistics of Database vs Ngrams frequencies')
+    parser.add_argument('--file', help='Path to the merged input file (see merge_datasets.py)', required=True)
+    parser.add_argument('--ignore-no_interaction', action='store_true', help='Removes no_interaction from the interactions')
+    parser.add_argument('--bootstrap', type=int, default=DEFAULT_BOOTSTRAP, help='Number of bootstrap resamples (0 to skip the confidence intervals)')
+    parser.add_argument('--confidence', type=float, default=DEFAULT_CONFIDENCE, help='Level of the confidence intervals')
+    parser.add_argument('--kendall-max-rows', type=int, default=DEFAULT_KENDALL_MAX_ROWS, help='No Kendall confidence interval above this number of rows')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the resampling')
+    parser.add_argument('--output', help='Path to the report (.json, or .csv)')
+
+    args = parser.parse_args()
+
+    df = hoi_io.read_table(args.file, columns=STATS_COLUMNS)
+    records = stats_report(df, ignore_no_interaction=args.ignore_no_interaction, num_samples=args.bootstrap, confidence=args.confidence,
+                           kendall_max_rows=args.kendall_max_rows, seed=args.seed)
+
+    for record in records:
+        print('{pair:>11} {group:>8} (n={n:7d}) {metric:>13}: {estimate:7.3f} [{ci_low:7.3f}, {ci_high:7.3f}]'.format(**record))
+
+    if args.output:
+        config = {'file': args.file, 'ignore_no_interaction': args.ignore_no_interaction, 'bootstrap': args.bootstrap,
+                  'confidence': args.confidence, 'kendall_max_rows': args.kendall_max_rows, 'seed': args.seed}
+        save_report(records, args.output, config)
+        print('Report saved to {}'.format(args.output))
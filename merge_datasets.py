@@ -1,104 +1,196 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
+import json
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 import argparse
+import hoi_io
+
+
+# Columns of every dataset in the merged table (as <column>_<dataset>), next to the shared Interaction, Verb, Object and
+# <column>_ngrams ones. Labels are categoricals and everything else int64.
+DATASET_COLUMNS = ['Interaction_freq', 'Verb_freq', 'Object_freq', 'IsRare']
+NGRAMS_NAME = 'ngrams'
+
+
+def vocabulary(*columns):
+    # Sorted unique labels of several columns (strings or categoricals). Missing values are not labels.
+    labels = [pd.Index(pd.unique(column)).dropna().astype(str) for column in columns]
+    return pd.Index(np.concatenate(labels) if labels else []).unique().sort_values()
+
+
+def label_codes(column, labels):
+    # Position of every value of the column in labels (-1 if it is not there, or missing). Only the unique values are compared as strings.
+    codes, uniques = pd.factorize(column)
+    return np.where(codes < 0, -1, labels.get_indexer(pd.Index(uniques).astype(str))[codes])
+
+
+def lookup_frequencies(freq_df, label_column, labels):
+    # Frequency of every label, from a table with the columns <label_column>, Frequency (0 for the labels missing in it)
+    freqs = np.zeros(len(labels), dtype=np.int64)
+    codes = label_codes(freq_df[label_column], labels)
+    found = codes >= 0
+    freqs[codes[found]] = freq_df['Frequency'].to_numpy()[found]
+    return freqs
+
+
+def key_rows(keys, num_keys):
+    # Dense table of key -> row with that key (-1 for the keys that are not in the table). Rows with key -1 are left out.
+    rows = np.full(num_keys, -1, dtype=np.int32 if len(keys) < 2 ** 31 else np.int64)
+    found = keys >= 0
+    rows[keys[found]] = np.flatnonzero(found)
+    return rows
+
+
+def take(values, rows, fill):
+    # values[rows], with fill where rows is -1
+    return np.where(rows >= 0, values[rows], fill) if len(values) > 0 else np.full(len(rows), fill)
+
+
+def pair_keys(df, verbs, objects):
+    # An interaction is the integer <verb code> * <number of objects> + <object code> (-1 if a label is missing)
+    verb_codes, object_codes = label_codes(df['Verb'], verbs), label_codes(df['Object'], objects)
+    return np.where((verb_codes >= 0) & (object_codes >= 0), verb_codes * len(objects) + object_codes, -1)
+
+
+def merge_multiple_frequencies(ngrams_tables, datasets, allow_mismatch=False, layout='wide'):
+    # Merges the ngrams tables with the tables of several HOI datasets in a single pass. ngrams_tables and every
+    # datasets[name] are (interactions, verbs, objects) tables. The wide layout has one row per interaction and the
+    # DATASET_COLUMNS of every dataset, the long one has one row per interaction and dataset (see long_table).
+    # Verbs and objects are coded against a shared vocabulary, so the tables are joined on integers instead of "verb,object" strings.
+    if NGRAMS_NAME in datasets:
+        raise ValueError("'{}' cannot be the name of a dataset".format(NGRAMS_NAME))
+    ngrams_df, ngrams_freq_verb_df, ngrams_freq_obj_df = ngrams_tables
+    verbs = vocabulary(ngrams_df['Verb'], *[tables[0]['Verb'] for tables in datasets.values()])
+    objects = vocabulary(ngrams_df['Object'], *[tables[0]['Object'] for tables in datasets.values()])
+
+    # Keys go from 0 to |verbs| x |objects|, so rows are matched with dense tables (like the verb x object grid)
+    num_keys = len(verbs) * len(objects)
+    ngrams_rows = key_rows(pair_keys(ngrams_df, verbs, objects), num_keys)
+    dataset_rows = {name: key_rows(pair_keys(tables[0], verbs, objects), num_keys) for name, tables in datasets.items()}
+
+    # Check for mismatches before joining
+    if not allow_mismatch:
+        for name, rows in dataset_rows.items():
+            if not np.array_equal(rows >= 0, ngrams_rows >= 0):
+                raise ValueError("Mismatch between interactions in the ngrams and {} files".format(name))
+
+    # Outer join: every interaction in any of the tables (sorted by verb, then object)
+    present = ngrams_rows >= 0
+    for rows in dataset_rows.values():
+        present |= rows >= 0
+    keys = np.flatnonzero(present)
+    verb_codes, object_codes = np.divmod(keys, len(objects))
+
+    # Interactions missing in a table have frequency 0, and IsRare -1 if they are not in the dataset
+    columns = {
+        # Labels are taken and joined as string arrays (without a Python string per row and side)
+        'Interaction': pd.Series(verbs.take(verb_codes)) + ',' + pd.Series(objects.take(object_codes)),
+        'Verb': pd.Categorical.from_codes(verb_codes, categories=verbs),
+        'Object': pd.Categorical.from_codes(object_codes, categories=objects),
+    }
+    for name, (df, freq_verb_df, freq_obj_df) in [(NGRAMS_NAME, ngrams_tables)] + list(datasets.items()):
+        rows = ngrams_rows[keys] if name == NGRAMS_NAME else dataset_rows[name][keys]
+        columns['Interaction_freq_' + name] = take(df['Frequency'].to_numpy(), rows, 0)
+        # I want to normalize the frequencies of the verbs and objects based on the frequency of the word on the Internet
+        columns['Verb_freq_' + name] = lookup_frequencies(freq_verb_df, 'Verb', verbs)[verb_codes]
+        columns['Object_freq_' + name] = lookup_frequencies(freq_obj_df, 'Object', objects)[object_codes]
+        if name == NGRAMS_NAME and 'Pruned' in df.columns:
+            # Pairs skipped by get_freq_ngrams.py --prune-below/--top-k (their frequency is 0 because it was not fetched)
+            columns['Pruned_' + name] = take(df['Pruned'].to_numpy(), rows, 0)
+        if name != NGRAMS_NAME:
+            columns['IsRare_' + name] = take(df['IsRare'].to_numpy(), rows, -1)
+
+    # Single cast pass, only for the columns that are not int64 already
+    df = pd.DataFrame(columns, copy=False)  # The columns are new arrays already, no need to copy them into a single block
+    df = df.astype({column: 'int64' for column in df.columns[3:] if df[column].dtype != np.int64})
+
+    if layout == 'long':
+        return long_table(df, list(datasets))
+    return df
+
+
+def long_table(df, names):
+    # One row per interaction and dataset, with the columns of merge_frequencies (<column>_hoi for the dataset) and Dataset first
+    dataset_columns = set('{}_{}'.format(column, name) for column in DATASET_COLUMNS for name in names)
+    shared_columns = [column for column in df.columns if column not in dataset_columns]  # Labels and ngrams columns
+    parts = []
+    for num_name, name in enumerate(names):
+        part = df[shared_columns + ['{}_{}'.format(column, name) for column in DATASET_COLUMNS]]
+        part = part.rename(columns={'{}_{}'.format(column, name): '{}_hoi'.format(column) for column in DATASET_COLUMNS})
+        part.insert(0, 'Dataset', pd.Categorical.from_codes(np.full(len(part), num_name), categories=names))
+        parts.append(part)
+    return pd.concat(parts, ignore_index=True)
+
+
+def merge_frequencies(database_df, ngrams_df, database_freq_verb_df, database_freq_obj_df, ngrams_freq_verb_df, ngrams_freq_obj_df,
+                      allow_mismatch=False):
+    # Merges the HOI and ngrams tables (interactions, verbs and objects) into a single table of frequencies, with the columns
+    # Interaction, Verb, Object, <Interaction|Verb|Object>_freq_ngrams, <Interaction|Verb|Object>_freq_hoi and IsRare_hoi
+    return merge_multiple_frequencies((ngrams_df, ngrams_freq_verb_df, ngrams_freq_obj_df),
+                                      {'hoi': (database_df, database_freq_verb_df, database_freq_obj_df)}, allow_mismatch=allow_mismatch)
+
+
+def read_manifest(file_path):
+    # Manifest of a multi-dataset merge (JSON), with the tables of the ngrams and of every dataset:
+    # {"ngrams": {"interactions": ..., "verbs": ..., "objects": ...}, "datasets": {"<name>": {"interactions": ..., "verbs": ..., "objects": ...}}}
+    # Relative paths are relative to the manifest.
+    with open(file_path, 'r') as file:
+        manifest = json.load(file)
+    base_dir = os.path.dirname(os.path.abspath(file_path))
+
+    def table_paths(entry):
+        return tuple(os.path.join(base_dir, entry[table]) for table in ['interactions', 'verbs', 'objects'])
+
+    return table_paths(manifest['ngrams']), {name: table_paths(entry) for name, entry in manifest['datasets'].items()}
+
+
+def read_tables(paths):
+    return tuple(hoi_io.read_table(path) for path in paths)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Merges Database and Ngrams frequencies')
-    parser.add_argument('--file-hoi', help='Path to the HOI input file', required=True)
-    parser.add_argument('--file-ngrams', help='Path to the ngrams input file', required=True)
-    parser.add_argument('--file-verb-hoi', help='Path to the verb frequencies in the HOI database', required=True)
-    parser.add_argument('--file-obj-hoi', help='Path to the object frequencies in the HOI database', required=True)
-    parser.add_argument('--file-verb-ngrams', help='Path to the verb frequencies in the ngrams', required=True)
-    parser.add_argument('--file-obj-ngrams', help='Path to the object frequencies in the ngrams', required=True)
+    parser.add_argument('--file-hoi', help='Path to the HOI input file')
+    parser.add_argument('--file-ngrams', help='Path to the ngrams input file')
+    parser.add_argument('--file-verb-hoi', help='Path to the verb frequencies in the HOI database')
+    parser.add_argument('--file-obj-hoi', help='Path to the object frequencies in the HOI database')
+    parser.add_argument('--file-verb-ngrams', help='Path to the verb frequencies in the ngrams')
+    parser.add_argument('--file-obj-ngrams', help='Path to the object frequencies in the ngrams')
+    parser.add_argument('--manifest', help='Path to a JSON manifest of several HOI datasets to merge with the same ngrams (instead of the --file-* arguments)')
+    parser.add_argument('--layout', choices=['wide', 'long'], default='wide', help='With --manifest, one column per dataset (wide) or one row per dataset (long)')
     parser.add_argument('--output', help='Path to the output file', required=True)
     parser.add_argument('--allow-mismatch', action='store_true', help='Allow mismatch between interactions in the two files')
     
 
     args = parser.parse_args()
 
-    # Load the data from CSV files
-    # Files have a header with the columns: Verb, Object, Frequency
-    database_df = pd.read_csv(args.file_hoi, header=0)
-    ngrams_df = pd.read_csv(args.file_ngrams, header=0)
-
-    # A "verb,object" makes an interaction, so we will join them
-    database_df['Interaction'] = database_df['Verb'] + ',' + database_df['Object']
-    ngrams_df['Interaction'] = ngrams_df['Verb'] + ',' + ngrams_df['Object']
-
-    # We will join the dataframes on the interaction column and ensure there's no mismatch
-    database_df = database_df.set_index('Interaction')
-    ngrams_df = ngrams_df.set_index('Interaction')
-
-    # Check for mismatches before joining
-    if not args.allow_mismatch and not database_df.index.equals(ngrams_df.index):
-        raise ValueError("Mismatch between interactions in the two files")
-
-    df = pd.merge(database_df, ngrams_df, left_index=True, right_index=True, how='outer', suffixes=('_hoi', '_ngrams'))
-    # Now we have a dataframe with the columns: Interaction, Verb_hoi, Object_hoi, Frequency_hoi, IsRare, Verb_ngrams, Object_ngrams, Frequency_ngrams
-    if args.allow_mismatch:
-        # Now we will fill the NaN values with stuff
-        # If Verb_hoi is NaN, we will fill it with Verb_ngrams
-        df['Verb_hoi'] = df['Verb_hoi'].fillna(df['Verb_ngrams'])
-        df['Object_hoi'] = df['Object_hoi'].fillna(df['Object_ngrams'])
-
-        # And vice versa
-        df['Verb_ngrams'] = df['Verb_ngrams'].fillna(df['Verb_hoi'])
-        df['Object_ngrams'] = df['Object_ngrams'].fillna(df['Object_hoi'])
-
-        # We will fill the NaN values in Frequency_hoi and Frequency_ngrams with 0
-        df['Frequency_hoi'] = df['Frequency_hoi'].fillna(0)
-        df['Frequency_ngrams'] = df['Frequency_ngrams'].fillna(0)
-
-        # We will fill the NaN values in IsRare with -1
-        df['IsRare'] = df['IsRare'].fillna(-1)
-    
-    database_freq_verb_df = pd.read_csv(args.file_verb_hoi, header=0)
-    database_freq_obj_df = pd.read_csv(args.file_obj_hoi, header=0)
-    ngrams_freq_verb_df = pd.read_csv(args.file_verb_ngrams, header=0)
-    ngrams_freq_obj_df = pd.read_csv(args.file_obj_ngrams, header=0)
-
-    # I want to normalize the frequencies of the verbs and objects based on the frequency of the word on the Internet
-    # I will convert the dataframes to dictionaries and then add the frequencies to the main dataframe
-    database_freq_verb = database_freq_verb_df.set_index('Verb').to_dict()['Frequency']
-    database_freq_obj = database_freq_obj_df.set_index('Object').to_dict()['Frequency']
-    ngrams_freq_verb = ngrams_freq_verb_df.set_index('Verb').to_dict()['Frequency']
-    ngrams_freq_obj = ngrams_freq_obj_df.set_index('Object').to_dict()['Frequency']
-
-    df['Frequency_verb_hoi'] = df['Verb_hoi'].map(database_freq_verb)
-    df['Frequency_obj_hoi'] = df['Object_hoi'].map(database_freq_obj)
-    df['Frequency_verb_ngrams'] = df['Verb_ngrams'].map(ngrams_freq_verb)
-    df['Frequency_obj_ngrams'] = df['Object_ngrams'].map(ngrams_freq_obj)
-
-    # Now we have a table with the columns: Interaction, Verb_hoi, Object_hoi, Frequency_hoi, IsRare, Verb_ngrams, Object_ngrams, Frequency_ngrams, Frequency_verb_database, Frequency_obj_database, Frequency_verb_ngrams, Frequency_obj_ngrams
-    # I remove Verb_hoi, Object_hoi and rename Verb_ngrams and Object_ngrams
-    df = df.drop(columns=['Verb_hoi', 'Object_hoi'])
-    df = df.rename(columns={'Verb_ngrams': 'Verb', 'Object_ngrams': 'Object'})
-    
-    df = df.rename(columns={'Frequency_hoi': 'Interaction_freq_hoi', 'Frequency_ngrams': 'Interaction_freq_ngrams'})
-    df = df.rename(columns={'Frequency_verb_hoi': 'Verb_freq_hoi', 'Frequency_obj_hoi': 'Object_freq_hoi'})
-    df = df.rename(columns={'Frequency_verb_ngrams': 'Verb_freq_ngrams', 'Frequency_obj_ngrams': 'Object_freq_ngrams'})
-    df = df.rename(columns={'IsRare': 'IsRare_hoi'})
-
-    # Now we have a table with the columns: Interaction, Verb, Object, Interaction_freq_hoi, IsRare_hoi, Interaction_freq_ngrams, Verb_freq_hoi, Object_freq_hoi, Verb_freq_ngrams, Object_freq_ngrams
-    # We cast Interaction_freq_hoi, Interaction_freq_ngrams, Verb_freq_hoi, Object_freq_hoi, Verb_freq_ngrams, Object_freq_ngrams, IsRare_hoi to int
-    df['Interaction_freq_hoi'] = df['Interaction_freq_hoi'].astype(int)
-    df['Interaction_freq_ngrams'] = df['Interaction_freq_ngrams'].astype(int)
-    df['Verb_freq_hoi'] = df['Verb_freq_hoi'].astype(int)
-    df['Object_freq_hoi'] = df['Object_freq_hoi'].astype(int)
-    df['Verb_freq_ngrams'] = df['Verb_freq_ngrams'].astype(int)
-    df['Object_freq_ngrams'] = df['Object_freq_ngrams'].astype(int)
-    df['IsRare_hoi'] = df['IsRare_hoi'].astype(int)
-
-    # Finally, we reorder the columns
-    df.reset_index(inplace=True)
-    df = df[['Interaction', 'Verb', 'Object', 'Interaction_freq_ngrams',  'Verb_freq_ngrams', 'Object_freq_ngrams', 'Interaction_freq_hoi', 'Verb_freq_hoi', 'Object_freq_hoi', 'IsRare_hoi']]
-    
-    # We save the dataframe to a CSV file
-    df.to_csv(args.output, index=False)
+    if args.manifest:
+        # The ngrams tables are only read once, and every dataset is merged in the same pass
+        ngrams_paths, dataset_paths = read_manifest(args.manifest)
+        df = merge_multiple_frequencies(read_tables(ngrams_paths), {name: read_tables(paths) for name, paths in dataset_paths.items()},
+                                        allow_mismatch=args.allow_mismatch, layout=args.layout)
+    elif None in [args.file_hoi, args.file_ngrams, args.file_verb_hoi, args.file_obj_hoi, args.file_verb_ngrams, args.file_obj_ngrams]:
+        print("Please provide either a manifest or every --file-* argument as input.")
+        raise SystemExit
+    else:
+        # Load the data from CSV (or Parquet) files
+        # Files have a header with the columns: Verb, Object, Frequency
+        database_df = hoi_io.read_table(args.file_hoi)
+        ngrams_df = hoi_io.read_table(args.file_ngrams)
+
+        database_freq_verb_df = hoi_io.read_table(args.file_verb_hoi)
+        database_freq_obj_df = hoi_io.read_table(args.file_obj_hoi)
+        ngrams_freq_verb_df = hoi_io.read_table(args.file_verb_ngrams)
+        ngrams_freq_obj_df = hoi_io.read_table(args.file_obj_ngrams)
+
+        df = merge_frequencies(database_df, ngrams_df, database_freq_verb_df, database_freq_obj_df, ngrams_freq_verb_df, ngrams_freq_obj_df,
+                               allow_mismatch=args.allow_mismatch)
+
+    # We save the dataframe to a CSV file (or Parquet, if the output ends with .parquet)
+    hoi_io.write_table(df, args.output)
     print("File saved to {}".format(args.output))
     print(df.head())
     print(df.describe())
\ No newline at end of file
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import argparse
+import pandas as pd
+import hoi_io
+from get_freq_ngrams import names_hash
+
+# Combines the outputs of the shards of get_freq_ngrams.py (--num-shards, --shard-index) into the files a single run
+# would have saved. Every shard writes a manifest with the number and digest of the lines it has to save, so we can
+# check that the shards come from the same plan, that none is missing or incomplete, and that no line is saved twice.
+
+NAME_COLUMNS = {'interaction': ['Verb', 'Object'], 'verb': ['Verb'], 'object': ['Object']}
+
+
+def read_manifests(file_paths):
+    manifests = []
+    for file_path in file_paths:
+        with open(file_path, 'r') as file:
+            manifest = json.load(file)
+        manifest['dir'] = os.path.dirname(os.path.abspath(file_path))
+        manifests.append(manifest)
+
+    num_shards = manifests[0]['num_shards']
+    for manifest in manifests:
+        if (manifest['num_shards'], manifest['plan_hash'], manifest['expand']) != (num_shards, manifests[0]['plan_hash'], manifests[0]['expand']):
+            raise ValueError('Shard {} does not come from the same plan as shard {}'.format(manifest['shard_index'], manifests[0]['shard_index']))
+    indices = sorted(manifest['shard_index'] for manifest in manifests)
+    if indices != list(range(num_shards)):
+        missing = sorted(set(range(num_shards)) - set(indices))
+        raise ValueError('Expected shards 0 to {} once each, missing {} and got {}'.format(num_shards - 1, missing, indices))
+    return sorted(manifests, key=lambda manifest: manifest['shard_index'])
+
+
+def read_shard_table(manifest, kind):
+    file_path = os.path.join(manifest['dir'], os.path.basename(manifest['shard_outputs'][kind]))
+    # Labels are read as strings, as they were written (e.g. a verb called "null" must stay "null")
+    table = pd.read_csv(file_path, header=0, dtype=str, keep_default_na=False)
+    table['Frequency'] = table['Frequency'].astype('int64')
+    return table
+
+
+def merge_shards(manifests):
+    # {kind: DataFrame} of the merged outputs (rows sorted by name), checked against the manifests of the shards
+    tables = {}
+    for kind, columns in NAME_COLUMNS.items():
+        shard_tables = []
+        for manifest in manifests:
+            table = read_shard_table(manifest, kind)
+            names = list(zip(*[table[column] for column in columns]))
+            if len(names) != manifest['lines'][kind] or names_hash(names) != manifest['names_hash'][kind]:
+                raise ValueError('Shard {} has {} {}s instead of the {} of its plan (incomplete or edited output?)'.format(
+                    manifest['shard_index'], len(names), kind, manifest['lines'][kind]))
+            shard_tables.append(table)
+        table = pd.concat(shard_tables, ignore_index=True)
+        # Shards are disjoint by construction, so a duplicate means that the files were mixed up
+        if table.duplicated(columns).any():
+            raise ValueError('Some {}s were saved by more than one shard'.format(kind))
+        tables[kind] = table.sort_values(columns, ignore_index=True)
+
+    if 'variants' in manifests[0]['outputs']:
+        # A resumed run drops the variants of the lines it had not saved yet, but shards resumed by older versions may have them twice
+        table = pd.concat([read_shard_table(manifest, 'variants') for manifest in manifests], ignore_index=True)
+        table = table.drop_duplicates(['Verb', 'Object', 'Variant'])
+        tables['variants'] = table.sort_values(['Verb', 'Object', 'Variant'], ignore_index=True)
+    return tables
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge the outputs of the shards of get_freq_ngrams.py')
+    parser.add_argument('manifests', nargs='+', help='Manifests of every shard (<name>_ngrams_shard<i>of<n>.json), with their outputs next to them')
+    parser.add_argument('--output-dir', default='.', help='Directory of the merged outputs')
+    hoi_io.add_format_argument(parser)
+
+    args = parser.parse_args()
+
+    manifests = read_manifests(args.manifests)
+    tables = merge_shards(manifests)
+    os.makedirs(args.output_dir, exist_ok=True)
+    for kind, table in tables.items():
+        file_name = os.path.splitext(os.path.basename(manifests[0]['outputs'][kind]))[0]
+        file_path = hoi_io.table_path(os.path.join(args.output_dir, file_name), args.format)
+        hoi_io.write_table(table, file_path)
+        print('{} {} rows saved to {}'.format(len(table), kind, file_path))
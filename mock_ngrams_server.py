@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import random
+import hashlib
+import threading
+import argparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+# Local stand-in for the /<corpus>/search endpoint of api.ngrams.dev, so retrieval can be run (and timed) offline.
+# Counts are derived from the query string, so they are deterministic across runs.
+
+
+def fake_frequency(query_text):
+    digest = hashlib.sha256(query_text.encode('utf-8')).hexdigest()
+    return int(digest[:6], 16)
+
+
+# Words the ngrams of a response get for the '*' slots of the query
+MOCK_DETERMINERS = ['the', 'a', 'his', 'her']
+
+
+def concrete_token(token, num_ngram):
+    # Like the real API, ngrams have concrete words: 'word~' alternates between word and words, '*' is a determiner
+    if token == '*':
+        return MOCK_DETERMINERS[num_ngram % len(MOCK_DETERMINERS)]
+    if token.endswith('~'):
+        return token[:-1] + ('s' if num_ngram % 2 else '')
+    return token
+
+
+def fake_response(query_text, response_size=1):
+    # The frequency of the query is split among response_size ngrams, so the total does not depend on the size
+    tokens = [token for token in query_text.split(' ') if token]
+    frequency = fake_frequency(query_text)
+    ngrams = []
+    for num_ngram in range(response_size):
+        ngrams.append({
+            'id': hashlib.sha256('{}#{}'.format(query_text, num_ngram).encode('utf-8')).hexdigest()[:16],
+            'absTotalMatchCount': frequency // response_size + (1 if num_ngram < frequency % response_size else 0),
+            'relTotalMatchCount': 0.0,
+            'tokens': [{'kind': 'TERM', 'text': concrete_token(token, num_ngram)} for token in tokens],
+        })
+    return {'queryTokens': [{'kind': 'TERM', 'text': token} for token in tokens], 'ngrams': ngrams}
+
+
+class MockNgramsHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real API
+    disable_nagle_algorithm = True  # Otherwise headers and body are delayed by the TCP delayed ACK (~40ms)
+    latency = 0.0
+    latency_jitter = 0.0
+    error_rate = 0.0
+    response_size = 1
+    stats = None
+
+    def _count(self, key):
+        with self.stats['lock']:
+            self.stats[key] += 1
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if not url.path.endswith('/search'):
+            self.send_error(404)
+            return
+
+        # parse_qs turns '+' into spaces, as the API does
+        query_text = parse_qs(url.query).get('query', [''])[0]
+        self._count('requests')
+
+        latency = self.latency + random.uniform(0, self.latency_jitter)
+        if latency > 0:
+            time.sleep(latency)
+
+        if random.random() < self.error_rate:
+            # Half of the errors are throttling, the other half are server errors
+            self._count('errors')
+            throttled = random.random() < 0.5
+            self.send_response(429 if throttled else 503)
+            if throttled:
+                self.send_header('Retry-After', '0.1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = json.dumps(fake_response(query_text, self.response_size)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockNgramsServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # The default backlog (5) drops connections when many clients connect at once
+
+
+def make_server(host='127.0.0.1', port=0, latency=0.0, latency_jitter=0.0, error_rate=0.0, response_size=1):
+    # With port=0 the OS picks a free port (see server.server_address)
+    # Request and error counters are available in server.stats
+    stats = {'requests': 0, 'errors': 0, 'lock': threading.Lock()}
+    handler = type('Handler', (MockNgramsHandler,), {'latency': latency, 'latency_jitter': latency_jitter, 'error_rate': error_rate,
+                                                      'response_size': response_size, 'stats': stats})
+    server = MockNgramsServer((host, port), handler)
+    server.stats = stats
+    return server
+
+
+def start_server_thread(**kwargs):
+    # Runs the server in a background thread and returns it (stop it with server.shutdown())
+    server = make_server(**kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mock ngrams API server')
+    parser.add_argument('--host', default='127.0.0.1', help='Host to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before answering each request')
+    parser.add_argument('--latency-jitter', type=float, default=0.0, help='Extra random latency (uniform, in seconds)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with 429/503')
+    parser.add_argument('--response-size', type=int, default=1, help='Number of ngrams in each response')
+
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, args.latency, args.latency_jitter, args.error_rate, args.response_size)
+    print('Mock ngrams API listening on http://{}:{}'.format(*server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
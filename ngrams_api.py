@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import requests
+import ngrams_ratelimit
+import ngrams_telemetry
+
+BASE_URL = "https://api.ngrams.dev"
+CORPUS = "eng"
+ENDPOINT = "search"
+EXTRA_PARAMS = "flags=cr"
+
+DEFAULT_CACHE_DIR = '.ngrams_cache'
+DEFAULT_CACHE_MAX_ENTRIES = 1000000
+
+# Backend answering call_api instead of the remote API (any object with a search(query_text) method
+# returning an API-like response, e.g. ngrams_index.LocalNgramIndex). None means the remote API.
+_backend = None
+
+# Cache used by call_api (None means that every query goes to the API)
+_cache = None
+
+# We reuse the same connection for consecutive queries (keep-alive)
+_session = None
+
+# Rate limiter shared by every request (None means no limit), and how failed requests are retried
+_rate_limiter = None
+_timeout = ngrams_ratelimit.DEFAULT_TIMEOUT
+_max_retries = ngrams_ratelimit.DEFAULT_MAX_RETRIES
+
+# Telemetry recording every call (None means no instrumentation)
+_telemetry = None
+
+# Responses with these status codes are worth retrying (the rest mean the query itself is wrong)
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class NgramsAPIError(Exception):
+    pass
+
+
+class RetryableAPIError(NgramsAPIError):
+    def __init__(self, message, retry_after=None, throttled=False):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.throttled = throttled
+
+
+def normalize_query(query_text):
+    # Queries that only differ on blanks around the tokens are the same query
+    tokens = [token.strip() for token in query_text.strip().split('+')]
+    tokens = [token for token in tokens if token]
+    return '+'.join(tokens)
+
+
+class NgramCache:
+    # Persistent cache of API responses stored in a SQLite file inside cache_dir.
+    # Entries are keyed by the base URL + normalized query + corpus + flags, so changing any of them never returns stale
+    # counts (nor the ones of a mock server, see --api-url).
+    # When there are more than max_entries, the least recently used ones are evicted.
+    # If ttl (seconds) is set, older entries are considered misses and fetched again.
+    # With refresh, every lookup is a miss but the new responses are still stored.
+
+    EVICT_EVERY = 1000  # Number of insertions between eviction passes
+    FLUSH_ACCESSED_EVERY = 1000  # Hits whose access time is kept in memory before it is written (with a single commit)
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_entries=DEFAULT_CACHE_MAX_ENTRIES, ttl=None, refresh=False):
+        self.cache_dir = cache_dir
+        self.db_path = os.path.join(cache_dir, 'ngrams.sqlite')
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.refresh = refresh
+
+        self.hits = 0
+        self.misses = 0
+
+        self._conn = None
+        self._lock = threading.Lock()  # The async engine uses the cache from its own thread (and threads of the executor)
+        self._insertions = 0
+        self._accessed = {}  # {key: time} of the hits not written yet
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, query TEXT, response TEXT, created REAL, accessed REAL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def make_key(query_text, corpus=CORPUS, extra_params=EXTRA_PARAMS, base_url=None):
+        # The base URL is the one set by setup_from_args (read when the key is made, not when the module is loaded)
+        key = '{}|{}|{}|{}'.format(base_url or BASE_URL, corpus, extra_params, normalize_query(query_text))
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def get(self, query_text, corpus=CORPUS, extra_params=EXTRA_PARAMS):
+        if self.refresh:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        key = self.make_key(query_text, corpus, extra_params)
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute('SELECT response, created FROM responses WHERE key = ?', (key,)).fetchone()
+
+            if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+
+            # Hits do not write to the database one by one (a fully cached run would commit once per query)
+            self._accessed[key] = now
+            if len(self._accessed) >= self.FLUSH_ACCESSED_EVERY:
+                self._flush_accessed(conn)
+                conn.commit()
+            self.hits += 1
+
+        return json.loads(row[0])
+
+    def _flush_accessed(self, conn):
+        # Writes the access times of the recent hits (the caller holds the lock and commits)
+        if self._accessed:
+            conn.executemany('UPDATE responses SET accessed = ? WHERE key = ?', [(accessed, key) for key, accessed in self._accessed.items()])
+            self._accessed = {}
+
+    def contains(self, query_text, corpus=CORPUS, extra_params=EXTRA_PARAMS):
+        # Like get, but without counting nor refreshing the entry
+        if self.refresh:
+            return False
+        key = self.make_key(query_text, corpus, extra_params)
+        with self._lock:
+            row = self._connect().execute('SELECT created FROM responses WHERE key = ?', (key,)).fetchone()
+        return row is not None and (self.ttl is None or time.time() - row[0] <= self.ttl)
+
+    def put(self, query_text, response, corpus=CORPUS, extra_params=EXTRA_PARAMS):
+        key = self.make_key(query_text, corpus, extra_params)
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute('INSERT OR REPLACE INTO responses (key, query, response, created, accessed) VALUES (?, ?, ?, ?, ?)',
+                         (key, normalize_query(query_text), json.dumps(response), now, now))
+            self._flush_accessed(conn)
+            conn.commit()
+            self._insertions += 1
+            evict = self._insertions % self.EVICT_EVERY == 0
+
+        if evict:
+            self.evict()
+
+    def evict(self):
+        with self._lock:
+            conn = self._connect()
+            self._flush_accessed(conn)  # The LRU order needs the access times of the recent hits
+            if self.ttl is not None:
+                conn.execute('DELETE FROM responses WHERE created < ?', (time.time() - self.ttl,))
+
+            num_entries = conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+            if num_entries > self.max_entries:
+                # We drop the least recently used entries
+                conn.execute('DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed ASC LIMIT ?)',
+                             (num_entries - self.max_entries,))
+            conn.commit()
+
+    def close(self):
+        if self._conn is not None:
+            self.evict()
+            with self._lock:
+                self._conn.close()
+        self._conn = None
+
+    def summary(self):
+        total = self.hits + self.misses
+        hit_rate = 100.0 * self.hits / total if total > 0 else 0.0
+        return 'Cache: {} hits, {} misses ({:.1f}% hit rate) in {}'.format(self.hits, self.misses, hit_rate, self.db_path)
+
+
+def set_cache(cache):
+    global _cache
+    _cache = cache
+
+
+def get_cache():
+    return _cache
+
+
+def set_telemetry(telemetry):
+    global _telemetry
+    _telemetry = telemetry
+
+
+def get_telemetry():
+    return _telemetry
+
+
+def teardown():
+    # End of a run configured by setup_from_args: prints the reports of the telemetry and the cache, and closes both
+    if _telemetry is not None:
+        print(_telemetry.report())
+        _telemetry.close()
+    if _cache is not None:
+        print(_cache.summary())
+        _cache.close()
+    set_telemetry(None)
+    set_cache(None)
+
+
+def set_backend(backend):
+    global _backend
+    _backend = backend
+
+
+def get_backend():
+    return _backend
+
+
+def add_api_arguments(parser):
+    parser.add_argument('--api-url', default=BASE_URL, help='Base URL of the ngrams API (e.g. a local mock server)')
+    parser.add_argument('--local-index', default=None, help='Directory of a local ngram index (see ngrams_index.py) to use instead of the API')
+    add_cache_arguments(parser)
+    ngrams_ratelimit.add_ratelimit_arguments(parser)
+    ngrams_telemetry.add_telemetry_arguments(parser)
+
+
+def setup_from_args(args):
+    # Configures call_api (and the async engine) from the command line arguments and returns the cache
+    global BASE_URL, _rate_limiter, _timeout, _max_retries
+    BASE_URL = args.api_url.rstrip('/')
+    _rate_limiter = ngrams_ratelimit.rate_limiter_from_args(args)
+    _timeout = args.timeout
+    _max_retries = args.max_retries
+    set_telemetry(ngrams_telemetry.telemetry_from_args(args))
+
+    if args.local_index:
+        # Lookups in the local index are as fast as the cache, so we do not need it
+        import ngrams_index
+        set_backend(ngrams_index.LocalNgramIndex(args.local_index))
+        set_cache(None)
+        return None
+
+    cache = cache_from_args(args)
+    set_cache(cache)
+    return cache
+
+
+def add_cache_arguments(parser):
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help='Directory of the persistent API cache')
+    parser.add_argument('--no-cache', action='store_true', help='Do not read nor write the API cache')
+    parser.add_argument('--refresh', action='store_true', help='Ignore cached responses (but store the new ones)')
+    parser.add_argument('--cache-ttl', type=float, default=None, help='Seconds after which a cached response expires')
+    parser.add_argument('--cache-max-entries', type=int, default=DEFAULT_CACHE_MAX_ENTRIES, help='Maximum number of cached responses')
+
+
+def cache_from_args(args):
+    if args.no_cache:
+        return None
+    return NgramCache(args.cache_dir, max_entries=args.cache_max_entries, ttl=args.cache_ttl, refresh=args.refresh)
+
+
+def get_rate_limiter():
+    return _rate_limiter
+
+
+def get_retry_settings():
+    return _timeout, _max_retries
+
+
+def build_api_url(query_text):
+    return "{}/{}/{}?query={}&{}".format(BASE_URL, CORPUS, ENDPOINT, query_text, EXTRA_PARAMS)
+
+
+def check_response(query_text, status_code, retry_after, body):
+    # Returns the decoded response, or raises RetryableAPIError / NgramsAPIError depending on whether retrying can help
+    if status_code in RETRY_STATUS_CODES:
+        raise RetryableAPIError('HTTP {} for query "{}"'.format(status_code, query_text),
+                                retry_after=ngrams_ratelimit.parse_retry_after(retry_after), throttled=status_code == 429)
+    if status_code != 200:
+        raise NgramsAPIError('HTTP {} for query "{}"'.format(status_code, query_text))
+    try:
+        api_response = json.loads(body)
+    except ValueError:
+        # Truncated bodies happen when the connection drops
+        raise RetryableAPIError('Invalid JSON response for query "{}"'.format(query_text))
+    if 'ngrams' not in api_response:
+        raise NgramsAPIError('Unexpected response for query "{}": {}'.format(query_text, body[:200]))
+    return api_response
+
+
+def decode_response(query_text, status_code, retry_after, body, event):
+    # check_response, timing the decoding in the telemetry event of the call
+    start = time.perf_counter()
+    try:
+        return check_response(query_text, status_code, retry_after, body)
+    finally:
+        event['parse'] += time.perf_counter() - start
+
+
+def _request_once(query_text, event):
+    global _session
+
+    if _session is None:
+        _session = requests.Session()
+    try:
+        response = _session.get(build_api_url(query_text), timeout=_timeout)
+    except (requests.Timeout, requests.ConnectionError) as e:
+        raise RetryableAPIError('{} for query "{}"'.format(type(e).__name__, query_text)) from e
+    event['status'] = response.status_code
+    event['ttfb'] += response.elapsed.total_seconds()  # Until the headers were parsed
+    event['bytes'] += len(response.content)  # Bodies of every attempt
+    return decode_response(query_text, response.status_code, response.headers.get('Retry-After'), response.text, event)
+
+
+def call_api(query_text):
+    with ngrams_telemetry.track(_telemetry, query_text) as event:
+        if _backend is not None:
+            event['source'] = 'backend'
+            return _backend.search(query_text)
+
+        if _cache is not None:
+            api_response = _cache.get(query_text)
+            if api_response is not None:
+                event['source'] = 'cache'
+                return api_response
+
+        for attempt in range(_max_retries + 1):
+            event['attempts'] = attempt + 1
+            if _rate_limiter is not None:
+                wait_start = time.perf_counter()
+                _rate_limiter.acquire()
+                event['wait'] += time.perf_counter() - wait_start
+
+            start = time.monotonic()
+            try:
+                api_response = _request_once(query_text, event)
+            except RetryableAPIError as e:
+                event['retried'].append(event['status'])
+                event['status'] = None
+                event['request'] += time.monotonic() - start
+                if _rate_limiter is not None:
+                    _rate_limiter.on_error(throttled=e.throttled)
+                if attempt == _max_retries:
+                    raise NgramsAPIError('Giving up after {} attempts: {}'.format(attempt + 1, e)) from e
+                delay = ngrams_ratelimit.backoff_delay(attempt, e.retry_after)
+                event['backoff'] += delay
+                time.sleep(delay)
+                continue
+
+            event['request'] += time.monotonic() - start
+            if _rate_limiter is not None:
+                _rate_limiter.on_success(time.monotonic() - start)
+            break
+
+        if _cache is not None:
+            _cache.put(query_text, api_response)
+
+        return api_response
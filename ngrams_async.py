@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+import time
+import queue
+import asyncio
+import threading
+import ngrams_api
+import ngrams_ratelimit
+import ngrams_telemetry
+
+DEFAULT_CONCURRENCY = 16
+
+
+class AsyncFetcher:
+    # Issues API queries on a shared aiohttp session, so connections are pooled and kept alive.
+    # At most `concurrency` requests are in flight, and at most `limit_per_host` connections are open to the API.
+    # aiohttp is only imported when a fetcher is opened (once, not on every request), so the sequential paths do not pay for it.
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, limit_per_host=None):
+        self.concurrency = concurrency
+        self.limit_per_host = limit_per_host if limit_per_host is not None else concurrency
+        self._semaphore = None
+        self._session = None
+        self._aiohttp = None
+        self._yarl = None
+
+    async def __aenter__(self):
+        import aiohttp
+        import yarl
+        self._aiohttp, self._yarl = aiohttp, yarl
+        telemetry = ngrams_api.get_telemetry()
+        if telemetry is not None:
+            telemetry.workers = self.concurrency
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.limit_per_host)
+        self._session = aiohttp.ClientSession(connector=connector)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._session.close()
+
+    async def fetch(self, query_text):
+        # Same as ngrams_api.call_api, but without blocking the event loop on the network
+        with ngrams_telemetry.track(ngrams_api.get_telemetry(), query_text) as event:
+            backend = ngrams_api.get_backend()
+            if backend is not None:
+                event['source'] = 'backend'
+                return backend.search(query_text)
+
+            # SQLite lookups block (and take the lock of the cache), so they run in the default executor, off the loop
+            loop = asyncio.get_running_loop()
+            cache = ngrams_api.get_cache()
+            if cache is not None:
+                api_response = await loop.run_in_executor(None, cache.get, query_text)
+                if api_response is not None:
+                    event['source'] = 'cache'
+                    return api_response
+
+            rate_limiter = ngrams_api.get_rate_limiter()
+            timeout, max_retries = ngrams_api.get_retry_settings()
+
+            for attempt in range(max_retries + 1):
+                event['attempts'] = attempt + 1
+                if rate_limiter is not None:
+                    wait = rate_limiter.reserve()
+                    if wait > 0:
+                        event['wait'] += wait
+                        await asyncio.sleep(wait)
+
+                start = time.monotonic()
+                try:
+                    async with self._semaphore:
+                        request_start = time.monotonic()
+                        event['queue'] += request_start - start
+                        try:
+                            api_response = await self._request_once(query_text, timeout, event)
+                        finally:
+                            event['request'] += time.monotonic() - request_start
+                except ngrams_api.RetryableAPIError as e:
+                    event['retried'].append(event['status'])
+                    event['status'] = None
+                    if rate_limiter is not None:
+                        rate_limiter.on_error(throttled=e.throttled)
+                    if attempt == max_retries:
+                        raise ngrams_api.NgramsAPIError('Giving up after {} attempts: {}'.format(attempt + 1, e)) from e
+                    delay = ngrams_ratelimit.backoff_delay(attempt, e.retry_after)
+                    event['backoff'] += delay
+                    await asyncio.sleep(delay)
+                    continue
+
+                if rate_limiter is not None:
+                    # Latency of the request itself: waiting for a free slot says nothing about the API
+                    rate_limiter.on_success(time.monotonic() - request_start)
+                break
+
+            if cache is not None:
+                await loop.run_in_executor(None, cache.put, query_text, api_response)
+
+            return api_response
+
+    async def _request_once(self, query_text, timeout, event):
+        # We do not let aiohttp re-encode the query, so the URL is exactly the one call_api would request
+        api_url = self._yarl.URL(ngrams_api.build_api_url(query_text), encoded=True)
+        try:
+            start = time.monotonic()
+            async with self._session.get(api_url, timeout=self._aiohttp.ClientTimeout(total=timeout)) as response:
+                event['status'] = response.status
+                event['ttfb'] += time.monotonic() - start  # Until the headers were received
+                body = await response.read()
+                event['bytes'] += len(body)  # Bodies of every attempt
+                body = body.decode(response.get_encoding())
+                return ngrams_api.decode_response(query_text, response.status, response.headers.get('Retry-After'), body, event)
+        except (asyncio.TimeoutError, self._aiohttp.ClientError) as e:
+            raise ngrams_api.RetryableAPIError('{} for query "{}"'.format(type(e).__name__, query_text)) from e
+
+
+_DONE = object()
+
+
+async def _produce(func, items, results, stop, concurrency, limit_per_host):
+    try:
+        async with AsyncFetcher(concurrency, limit_per_host) as fetcher:
+            iterator = iter(items)
+
+            async def worker():
+                # Workers share the iterator, so items are consumed lazily
+                for item in iterator:
+                    if stop.is_set():
+                        return
+                    result = await func(fetcher, item)
+                    results.put((True, result))
+
+            await asyncio.gather(*[worker() for _ in range(concurrency)])
+    except BaseException as e:
+        results.put((False, e))
+    finally:
+        results.put((True, _DONE))
+
+
+def imap_unordered(func, items, concurrency=DEFAULT_CONCURRENCY, limit_per_host=None):
+    # Runs the coroutine func(fetcher, item) for every item and yields the results as they complete.
+    # The event loop lives in a background thread, so this can be consumed as a regular iterator (e.g. with tqdm).
+    results = queue.Queue()
+    stop = threading.Event()
+    thread = threading.Thread(target=asyncio.run, args=(_produce(func, items, results, stop, concurrency, limit_per_host),), daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            ok, result = results.get()
+            if not ok:
+                raise result
+            if result is _DONE:
+                break
+            yield result
+    finally:
+        stop.set()
+        thread.join()
+
+
+def add_async_arguments(parser):
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY, help='Maximum number of API requests in flight (with --parallel)')
+    parser.add_argument('--limit-per-host', type=int, default=None, help='Maximum number of connections to the API host (defaults to --concurrency)')
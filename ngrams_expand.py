@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import itertools
+import argparse
+from functools import lru_cache
+from ngrams_query import querify, querify_verb, querify_object
+
+# Local query expansion. Instead of trusting whatever the API's 'word~' (any inflection) and '*' (any token) match,
+# every query stands for a known set of concrete ngrams: the inflections of its '~' words (from the tables below) and
+# the determiners of its '*' slots. The operators are only used to fetch all those variants in as few requests as
+# possible (one per template, e.g. "ride~ horse~" and "ride~ * horse~" for a pair), and the ngrams of the response are
+# then filtered to the variants, so we know exactly which ones contributed to each count. Everything is deterministic
+# and only depends on the query text, so raw API responses can still be cached.
+
+DETERMINERS = ['a', 'an', 'the', 'his', 'her', 'its', 'their', 'my', 'your', 'our', 'this', 'that', 'these', 'those',
+               'some', 'another', 'each', 'every', 'one', 'two', 'three']
+
+# base: (past, past participle). Only the irregular ones, the rest follow the spelling rules in verb_forms.
+IRREGULAR_VERBS = {
+    'be': ('was', 'been'), 'bend': ('bent', 'bent'), 'bite': ('bit', 'bitten'), 'blow': ('blew', 'blown'), 'break': ('broke', 'broken'),
+    'bring': ('brought', 'brought'), 'build': ('built', 'built'), 'buy': ('bought', 'bought'), 'catch': ('caught', 'caught'),
+    'choose': ('chose', 'chosen'), 'cut': ('cut', 'cut'), 'deal': ('dealt', 'dealt'), 'dig': ('dug', 'dug'), 'do': ('did', 'done'),
+    'draw': ('drew', 'drawn'), 'drink': ('drank', 'drunk'), 'drive': ('drove', 'driven'), 'eat': ('ate', 'eaten'), 'fall': ('fell', 'fallen'),
+    'feed': ('fed', 'fed'), 'feel': ('felt', 'felt'), 'find': ('found', 'found'), 'fly': ('flew', 'flown'), 'get': ('got', 'gotten'),
+    'give': ('gave', 'given'), 'go': ('went', 'gone'), 'grind': ('ground', 'ground'), 'hang': ('hung', 'hung'), 'have': ('had', 'had'),
+    'hear': ('heard', 'heard'), 'hide': ('hid', 'hidden'), 'hit': ('hit', 'hit'), 'hold': ('held', 'held'), 'keep': ('kept', 'kept'),
+    'know': ('knew', 'known'), 'lay': ('laid', 'laid'), 'lead': ('led', 'led'), 'leave': ('left', 'left'), 'let': ('let', 'let'),
+    'lie': ('lay', 'lain'), 'light': ('lit', 'lit'), 'lose': ('lost', 'lost'), 'make': ('made', 'made'), 'meet': ('met', 'met'),
+    'pay': ('paid', 'paid'), 'put': ('put', 'put'), 'read': ('read', 'read'), 'ride': ('rode', 'ridden'), 'ring': ('rang', 'rung'),
+    'rise': ('rose', 'risen'), 'run': ('ran', 'run'), 'say': ('said', 'said'), 'see': ('saw', 'seen'), 'sell': ('sold', 'sold'),
+    'send': ('sent', 'sent'), 'set': ('set', 'set'), 'shake': ('shook', 'shaken'), 'shear': ('sheared', 'shorn'), 'shoot': ('shot', 'shot'),
+    'shut': ('shut', 'shut'), 'sing': ('sang', 'sung'), 'sink': ('sank', 'sunk'), 'sit': ('sat', 'sat'), 'sleep': ('slept', 'slept'),
+    'slide': ('slid', 'slid'), 'speak': ('spoke', 'spoken'), 'spend': ('spent', 'spent'), 'spin': ('spun', 'spun'), 'split': ('split', 'split'),
+    'stand': ('stood', 'stood'), 'steal': ('stole', 'stolen'), 'stick': ('stuck', 'stuck'), 'sting': ('stung', 'stung'),
+    'strike': ('struck', 'struck'), 'sweep': ('swept', 'swept'), 'swim': ('swam', 'swum'), 'swing': ('swung', 'swung'),
+    'take': ('took', 'taken'), 'teach': ('taught', 'taught'), 'tear': ('tore', 'torn'), 'tell': ('told', 'told'), 'think': ('thought', 'thought'),
+    'throw': ('threw', 'thrown'), 'wake': ('woke', 'woken'), 'wear': ('wore', 'worn'), 'win': ('won', 'won'), 'wind': ('wound', 'wound'),
+    'write': ('wrote', 'written'),
+}
+THIRD_PERSON = {'be': 'is', 'have': 'has', 'do': 'does', 'go': 'goes'}
+# Verbs with more than one syllable that still double their last consonant (control -> controlling)
+DOUBLED_VERBS = {'admit', 'commit', 'compel', 'control', 'equip', 'occur', 'omit', 'patrol', 'permit', 'prefer', 'refer', 'regret', 'submit', 'transfer'}
+
+IRREGULAR_NOUNS = {
+    'child': 'children', 'foot': 'feet', 'goose': 'geese', 'knife': 'knives', 'leaf': 'leaves', 'life': 'lives', 'loaf': 'loaves',
+    'man': 'men', 'mouse': 'mice', 'person': 'people', 'potato': 'potatoes', 'shelf': 'shelves', 'tomato': 'tomatoes', 'tooth': 'teeth',
+    'wife': 'wives', 'wolf': 'wolves', 'woman': 'women',
+}
+# Same form in singular and plural
+INVARIANT_NOUNS = {'broccoli', 'deer', 'fish', 'scissors', 'sheep', 'skis', 'glasses', 'jeans', 'pants', 'shorts', 'species'}
+
+VOWELS = 'aeiou'
+
+# Forms loaded from a tables file (see load_tables), which take precedence over the rules
+_custom_tables = {'verbs': {}, 'nouns': {}, 'determiners': None}
+
+
+def _sibilant(word):
+    return word.endswith(('s', 'x', 'z', 'ch', 'sh'))
+
+
+def _consonant_y(word):
+    return len(word) > 1 and word.endswith('y') and word[-2] not in VOWELS
+
+
+def _doubles_consonant(word):
+    # Short verbs ending in consonant-vowel-consonant double it (hit -> hitting, stir -> stirred)
+    if word in DOUBLED_VERBS:
+        return True
+    vowel_groups = sum(1 for num_char, char in enumerate(word) if char in VOWELS and (num_char == 0 or word[num_char - 1] not in VOWELS))
+    return (vowel_groups == 1 and len(word) >= 3 and word[-1] not in VOWELS + 'wxy' and word[-2] in VOWELS and word[-3] not in VOWELS)
+
+
+@lru_cache(maxsize=None)
+def verb_forms(verb):
+    # Base, third person, past, past participle and gerund of a (single word) verb
+    if verb in _custom_tables['verbs']:
+        return tuple(sorted(set(_custom_tables['verbs'][verb])))
+
+    if verb in THIRD_PERSON:
+        third = THIRD_PERSON[verb]
+    elif _sibilant(verb):
+        third = verb + 'es'
+    elif _consonant_y(verb):
+        third = verb[:-1] + 'ies'
+    else:
+        third = verb + 's'
+
+    if verb.endswith('ie'):
+        gerund = verb[:-2] + 'ying'
+    elif verb.endswith('e') and not verb.endswith(('ee', 'ye', 'oe')) and verb != 'be':
+        gerund = verb[:-1] + 'ing'
+    elif _doubles_consonant(verb):
+        gerund = verb + verb[-1] + 'ing'
+    else:
+        gerund = verb + 'ing'
+
+    if verb in IRREGULAR_VERBS:
+        past = IRREGULAR_VERBS[verb]
+    elif verb.endswith('e'):
+        past = (verb + 'd',)
+    elif _consonant_y(verb):
+        past = (verb[:-1] + 'ied',)
+    elif _doubles_consonant(verb):
+        past = (verb + verb[-1] + 'ed',)
+    else:
+        past = (verb + 'ed',)
+
+    forms = {verb, third, gerund}
+    forms.update(past)
+    if verb == 'be':
+        forms.update(['am', 'are', 'were', 'being'])
+    return tuple(sorted(forms))
+
+
+@lru_cache(maxsize=None)
+def noun_forms(noun):
+    # Singular and plural of a (single word) noun. Words that already look plural also get their singular.
+    if noun in _custom_tables['nouns']:
+        return tuple(sorted(set(_custom_tables['nouns'][noun])))
+    if noun in INVARIANT_NOUNS:
+        return (noun,)
+
+    forms = {noun}
+    if noun in IRREGULAR_NOUNS:
+        forms.add(IRREGULAR_NOUNS[noun])
+    elif _sibilant(noun):
+        forms.add(noun + 'es')
+    elif _consonant_y(noun):
+        forms.add(noun[:-1] + 'ies')
+    else:
+        forms.add(noun + 's')
+
+    if noun.endswith('s') and not noun.endswith(('ss', 'us', 'is')):
+        forms.add(noun[:-1])
+    return tuple(sorted(forms))
+
+
+def determiners():
+    return tuple(_custom_tables['determiners'] or DETERMINERS)
+
+
+@lru_cache(maxsize=None)
+def token_forms(token, role=None):
+    # Concrete words a query token stands for: '*' a determiner, 'word~' the inflections of word as a verb (role 'verb'),
+    # as a noun (role 'noun') or as either of them (no role)
+    token = token.strip().lower()
+    if token == '*':
+        return determiners()
+    if token.endswith('~'):
+        word = token[:-1]
+        if role == 'verb':
+            return verb_forms(word)
+        if role == 'noun':
+            return noun_forms(word)
+        return tuple(sorted(set(verb_forms(word)) | set(noun_forms(word))))
+    return (token,)
+
+
+def query_tokens(query_text):
+    return [token for token in query_text.split('+') if token.strip()]
+
+
+def token_roles(tokens):
+    # Queries start with the verb and end with the object (see ngrams_query), a single word may be either
+    if len(tokens) == 1:
+        return [None]
+    return ['verb'] + [None] * (len(tokens) - 2) + ['noun']
+
+
+@lru_cache(maxsize=None)
+def query_slots(query_text):
+    # One frozenset of accepted words per position of the query
+    tokens = query_tokens(query_text)
+    return tuple(frozenset(token_forms(token, role)) for token, role in zip(tokens, token_roles(tokens)))
+
+
+def query_variants(query_text):
+    # Every concrete ngram (as a string) that the query stands for
+    tokens = query_tokens(query_text)
+    return [' '.join(words) for words in itertools.product(*[token_forms(token, role) for token, role in zip(tokens, token_roles(tokens))])]
+
+
+def match_variants(query_text, api_response):
+    # Returns (frequency, {variant: frequency}) counting only the ngrams of the response that are variants of the query
+    slots = query_slots(query_text)
+    variants = {}
+    for ngram in api_response['ngrams']:
+        words = [token['text'].lower() for token in ngram['tokens']]
+        if len(words) == len(slots) and all(word in slot for word, slot in zip(words, slots)):
+            variant = ' '.join(words)
+            variants[variant] = variants.get(variant, 0) + ngram['absTotalMatchCount']
+    return sum(variants.values()), variants
+
+
+# Queries of the expansion: the same templates as the ones of ngrams_query (verbs only inflect their first word, objects
+# their last one), so expanded runs share the cached responses of the plain ones. Verbs and objects on their own get the
+# same fragments instead of inflecting every word, so "sit~ at" does not count "sits ats".
+
+def expand_verb(verb):
+    return querify_verb(verb)
+
+
+def expand_object(obj):
+    return querify_object(obj)
+
+
+def expand_pair(verb, obj):
+    # Verb and object next to each other, or with a determiner in between: one query per template
+    return (querify([verb, obj]), querify([verb, obj], join_with_star=True))
+
+
+def clear_tables_cache():
+    for function in [verb_forms, noun_forms, token_forms, query_slots]:
+        function.cache_clear()
+
+
+def load_tables(file_path):
+    # Tables file: {"verbs": {"ride": ["ride", "rides", ...]}, "nouns": {"horse": ["horse", "horses"]}, "determiners": [...]}
+    # (every key is optional). The forms in it replace the ones of the rules.
+    with open(file_path, 'r') as file:
+        tables = json.load(file)
+    _custom_tables['verbs'] = tables.get('verbs', {})
+    _custom_tables['nouns'] = tables.get('nouns', {})
+    _custom_tables['determiners'] = tables.get('determiners')
+    clear_tables_cache()
+
+
+def build_tables(verbs, objects):
+    # Precomputed tables for a vocabulary, in the format of load_tables (so they can be reviewed and edited)
+    verb_words = sorted(set(verb.split(' ')[0].strip() for verb in verbs))
+    object_words = sorted(set(obj.split(' ')[-1].strip() for obj in objects))
+    return {'verbs': {word: list(verb_forms(word)) for word in verb_words},
+            'nouns': {word: list(noun_forms(word)) for word in object_words},
+            'determiners': list(determiners())}
+
+
+def add_expand_arguments(parser):
+    parser.add_argument('--expand', action='store_true', help='Only count the concrete inflection/determiner variants of every query (see ngrams_expand.py)')
+    parser.add_argument('--inflections', default=None, help='JSON inflection tables for --expand (see ngrams_expand.py --output)')
+
+
+def expand_from_args(args):
+    if args.inflections:
+        load_tables(args.inflections)
+    return args.expand
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inflection tables and query expansion')
+    parser.add_argument('--file', help='Path to an interactions file (Verb,Object,... with a header) to build the tables of its vocabulary')
+    parser.add_argument('--parse-underscore', action='store_true', help='Convert undersdores to spaces')
+    parser.add_argument('--output', help='Path to save the tables (JSON)')
+    parser.add_argument('--text', help='Show the queries and variants of a verb,object pair')
+
+    args = parser.parse_args()
+
+    if args.text:
+        verb, obj = [word.strip() for word in args.text.split(',')]
+        for query in expand_pair(verb, obj):
+            variants = query_variants(query)
+            print('{} ({} variants): {}'.format(query, len(variants), ', '.join(variants)))
+
+    if args.file:
+        import hoi_io
+        df = hoi_io.read_table(args.file)
+        verbs = [str(verb) for verb in df['Verb'].unique()]
+        objects = [str(obj) for obj in df['Object'].unique()]
+        if args.parse_underscore:
+            verbs = [verb.replace('_', ' ') for verb in verbs]
+            objects = [obj.replace('_', ' ') for obj in objects]
+        tables = build_tables(verbs, objects)
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(tables, file, indent=2)
+            print('Tables of {} verbs and {} nouns saved to {}'.format(len(tables['verbs']), len(tables['nouns']), args.output))
+        else:
+            print(json.dumps(tables, indent=2))
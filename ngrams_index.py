@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import gzip
+import json
+import heapq
+import argparse
+import tempfile
+import numpy as np
+
+# Local replacement for api.ngrams.dev built from Google Books n-gram shards.
+# The index directory contains:
+#   vocab.txt            one token per line (the line number is the token id)
+#   stems.npy            stem id of every token (tokens with the same stem are inflections of each other)
+#   stems.txt            one stem per line
+#   ngrams_<n>.npy       token ids of every n-gram, sorted lexicographically (shape [num_ngrams, n])
+#   counts_<n>.npy       total match count of every n-gram
+#   meta.json            build information
+# Arrays are memory-mapped, so opening an index is instantaneous and lookups only touch the pages they need.
+
+MAX_N = 5
+DEFAULT_CHUNK_SIZE = 2000000  # Distinct n-grams counted in memory before they are spilled to disk
+POS_TAG = re.compile(r'_[A-Z]+\.?$')  # Google Books v3 tokens may carry a part-of-speech tag (e.g. ride_VERB)
+
+
+def stem(word):
+    # Crude suffix stripping, enough to group regular inflections (ride, rides, riding; table, tables)
+    word = word.lower()
+    if len(word) <= 3:
+        return word
+    if word.endswith('ies') and len(word) > 4:
+        return word[:-3] + 'y'
+    for suffix in ('ing', 'ed', 'es'):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            word = word[:-len(suffix)]
+            if len(word) > 3 and word[-1] == word[-2] and word[-1] not in 'ls':
+                word = word[:-1]  # running -> run
+            return word.rstrip('e')
+    if word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+        word = word[:-1]
+    return word.rstrip('e') if len(word) > 3 else word
+
+
+def normalize_token(token):
+    token = POS_TAG.sub('', token.strip())
+    return token.lower()
+
+
+def read_shard(file_path):
+    # Yields (tokens, match_count) for every line of a shard, for both Google Books formats:
+    #   v2 (2012): ngram TAB year TAB match_count TAB volume_count
+    #   v3 (2020): ngram TAB year,match_count,volume_count TAB year,match_count,volume_count ...
+    opener = gzip.open if file_path.endswith('.gz') else open
+    with opener(file_path, 'rt', encoding='utf-8') as file:
+        for line in file:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 2:
+                continue
+            if ',' in fields[1]:
+                match_count = sum(int(field.split(',')[1]) for field in fields[1:])
+            else:
+                match_count = int(fields[2])
+
+            tokens = [normalize_token(token) for token in fields[0].split(' ')]
+            if any(not token for token in tokens):
+                continue  # Tokens that only were a tag (e.g. _NOUN_)
+            yield tokens, match_count
+
+
+def spill_run(chunk, run_dir, num_run):
+    # Writes the n-grams of a chunk (sorted, one file per n) and returns their paths by n
+    paths = {}
+    for ngram, count in sorted(chunk.items()):
+        n = len(ngram)
+        if n not in paths:
+            paths[n] = open(os.path.join(run_dir, 'run{}_{}.txt'.format(num_run, n)), 'w', encoding='utf-8')
+        paths[n].write('{}\t{}\n'.format(' '.join(ngram), count))
+    for file in paths.values():
+        file.close()
+    return {n: file.name for n, file in paths.items()}
+
+
+def read_run(file_path):
+    with open(file_path, encoding='utf-8') as file:
+        for line in file:
+            ngram, count = line.rstrip('\n').split('\t')
+            yield tuple(ngram.split(' ')), int(count)
+
+
+def merge_runs(run_paths):
+    # Runs are sorted, so the counts of an n-gram are consecutive in their merge
+    current, total = None, 0
+    for ngram, count in heapq.merge(*[read_run(run_path) for run_path in run_paths]):
+        if ngram != current:
+            if current is not None:
+                yield current, total
+            current, total = ngram, 0
+        total += count
+    if current is not None:
+        yield current, total
+
+
+def blocks(items, size):
+    block = []
+    for item in items:
+        block.append(item)
+        if len(block) == size:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+def build_index(shard_paths, output_dir, min_count=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    # Aggregates the counts of every n-gram over years (and over tags/case, which the index ignores).
+    # Shards do not fit in memory, so n-grams are counted in chunks of chunk_size distinct n-grams, spilled to sorted
+    # runs and merged (an external sort). Only the vocabulary of the n-grams that reach min_count is kept in memory.
+    os.makedirs(output_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=output_dir) as run_dir:
+        runs = {n: [] for n in range(1, MAX_N + 1)}
+        chunk = {}
+        num_runs = 0
+        for shard_path in shard_paths:
+            for tokens, match_count in read_shard(shard_path):
+                if len(tokens) > MAX_N:
+                    continue
+                key = tuple(tokens)
+                chunk[key] = chunk.get(key, 0) + match_count
+                if len(chunk) >= chunk_size:
+                    for n, run_path in spill_run(chunk, run_dir, num_runs).items():
+                        runs[n].append(run_path)
+                    chunk = {}
+                    num_runs += 1
+        for n, run_path in spill_run(chunk, run_dir, num_runs).items():
+            runs[n].append(run_path)
+        del chunk
+
+        # N-grams below min_count are dropped before their tokens reach the vocabulary
+        vocab = set()
+        num_ngrams = {}
+        for n in range(1, MAX_N + 1):
+            with open(os.path.join(run_dir, 'kept_{}.txt'.format(n)), 'w', encoding='utf-8') as file:
+                num_ngrams[n] = 0
+                for ngram, count in merge_runs(runs[n]):
+                    if count >= min_count:
+                        vocab.update(ngram)
+                        file.write('{}\t{}\n'.format(' '.join(ngram), count))
+                        num_ngrams[n] += 1
+
+        vocab = sorted(vocab)
+        token_ids = {token: num_token for num_token, token in enumerate(vocab)}
+        stems = sorted(set(stem(token) for token in vocab))
+        stem_ids = {token_stem: num_stem for num_stem, token_stem in enumerate(stems)}
+
+        with open(os.path.join(output_dir, 'vocab.txt'), 'w', encoding='utf-8') as file:
+            file.write('\n'.join(vocab) + '\n')
+        with open(os.path.join(output_dir, 'stems.txt'), 'w', encoding='utf-8') as file:
+            file.write('\n'.join(stems) + '\n')
+        np.save(os.path.join(output_dir, 'stems.npy'), np.array([stem_ids[stem(token)] for token in vocab], dtype=np.int32))
+
+        for n in range(1, MAX_N + 1):
+            # Token ids follow the order of the tokens, so the merged n-grams are already in lexicographic order of their
+            # ids (the n-grams starting with a token are a contiguous range). Arrays are written through memory maps.
+            ids = np.lib.format.open_memmap(os.path.join(output_dir, 'ngrams_{}.npy'.format(n)), mode='w+', dtype=np.int32, shape=(num_ngrams[n], n))
+            ngram_counts = np.lib.format.open_memmap(os.path.join(output_dir, 'counts_{}.npy'.format(n)), mode='w+', dtype=np.int64, shape=(num_ngrams[n],))
+            start = 0
+            for block in blocks(read_run(os.path.join(run_dir, 'kept_{}.txt'.format(n))), chunk_size):
+                ids[start:start + len(block)] = [[token_ids[token] for token in ngram] for ngram, _ in block]
+                ngram_counts[start:start + len(block)] = [count for _, count in block]
+                start += len(block)
+            ids.flush()
+            ngram_counts.flush()
+            del ids, ngram_counts
+
+    with open(os.path.join(output_dir, 'meta.json'), 'w') as file:
+        json.dump({'shards': [os.path.basename(shard_path) for shard_path in shard_paths], 'min_count': min_count,
+                   'vocab_size': len(vocab), 'num_ngrams': num_ngrams}, file, indent=2)
+
+    return num_ngrams
+
+
+# Small synthetic corpus (in both shard formats) to check the index, with the counts its queries should return
+FIXTURE_SHARDS = {
+    'fixture-v2.txt': ['ride_VERB the_DET horse_NOUN\t2000\t10\t1', 'ride the horse\t2001\t5\t1', 'riding a horse\t2000\t7\t2',
+                       'rides bicycles\t2000\t4\t1', 'feed zebras\t2000\t1\t1', 'horse\t2000\t50\t9'],
+    'fixture-v3.txt': ['ride horse\t2000,6,1\t2001,4,2', 'ride the horse\t2002,5,1', 'feed zebras\t2001,1,1', 'Horse\t2001,30,3'],
+}
+FIXTURE_MIN_COUNT = 3  # feed zebras (2 matches) is dropped, and so are its tokens
+FIXTURE_COUNTS = {'ride+the+horse': 20, 'ride~+*+horse~': 27, 'ride~+horse~': 10, 'rides+bicycles': 4, 'ride~+bicycle~': 4,
+                  '*+horse': 10, 'horse': 80, 'feed+zebras': 0}
+
+
+def check_fixture():
+    # Builds the fixture index (spilling after every 2 n-grams, so runs are merged) and returns what went wrong
+    errors = []
+    with tempfile.TemporaryDirectory() as fixture_dir:
+        shard_paths = []
+        for file_name, lines in FIXTURE_SHARDS.items():
+            shard_paths.append(os.path.join(fixture_dir, file_name))
+            with open(shard_paths[-1], 'w', encoding='utf-8') as file:
+                file.write('\n'.join(lines) + '\n')
+        build_index(shard_paths, os.path.join(fixture_dir, 'index'), min_count=FIXTURE_MIN_COUNT, chunk_size=2)
+
+        index = LocalNgramIndex(os.path.join(fixture_dir, 'index'))
+        for query_text, expected in FIXTURE_COUNTS.items():
+            if index.count(query_text) != expected:
+                errors.append('{}: {} instead of {}'.format(query_text, index.count(query_text), expected))
+        for token in ['feed', 'zebras']:
+            if token in index.token_ids:
+                errors.append('{} is in the vocabulary, but only in n-grams below the minimum count'.format(token))
+        for n in range(1, MAX_N + 1):
+            ngrams = np.asarray(index.ngrams[n])
+            if len(ngrams) > 1 and not (np.lexsort(ngrams.T[::-1]) == np.arange(len(ngrams))).all():
+                errors.append('{}-grams are not sorted'.format(n))
+    return errors
+
+
+class LocalNgramIndex:
+    # Answers the same queries as api.ngrams.dev, with the features querify uses:
+    # tokens joined by '+', 'word~' (any inflection of word) and '*' (any single token).
+    # Responses have the same shape as the API ones, so aggregate_freq works unchanged.
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, 'vocab.txt'), encoding='utf-8') as file:
+            self.vocab = file.read().splitlines()
+        with open(os.path.join(index_dir, 'stems.txt'), encoding='utf-8') as file:
+            stems = file.read().splitlines()
+        self.token_ids = {token: num_token for num_token, token in enumerate(self.vocab)}
+        self.stem_ids = {token_stem: num_stem for num_stem, token_stem in enumerate(stems)}
+
+        # Tokens grouped by stem: the tokens of stem s are stem_members[stem_offsets[s]:stem_offsets[s + 1]]
+        token_stems = np.load(os.path.join(index_dir, 'stems.npy'))
+        self.stem_members = np.argsort(token_stems, kind='stable').astype(np.int32)
+        self.stem_offsets = np.searchsorted(token_stems[self.stem_members], np.arange(len(stems) + 1))
+
+        self.ngrams = {}
+        self.counts = {}
+        for n in range(1, MAX_N + 1):
+            self.ngrams[n] = np.load(os.path.join(index_dir, 'ngrams_{}.npy'.format(n)), mmap_mode='r')
+            self.counts[n] = np.load(os.path.join(index_dir, 'counts_{}.npy'.format(n)), mmap_mode='r')
+
+    def _candidates(self, token):
+        # Token ids a query token can match (None means any token)
+        if token == '*':
+            return None
+        if token.endswith('~'):
+            stem_id = self.stem_ids.get(stem(token[:-1]))
+            if stem_id is None:
+                return np.zeros(0, dtype=np.int32)
+            return self.stem_members[self.stem_offsets[stem_id]:self.stem_offsets[stem_id + 1]]
+        token_id = self.token_ids.get(normalize_token(token))
+        return np.array([token_id] if token_id is not None else [], dtype=np.int32)
+
+    def lookup(self, query_text):
+        # Returns the rows (of ngrams[n] / counts[n]) matching the query
+        tokens = [token for token in query_text.strip().split('+') if token.strip()]
+        n = len(tokens)
+        if n == 0 or n > MAX_N:
+            return n, np.zeros(0, dtype=np.int64)
+
+        ngrams = self.ngrams[n]
+        candidates = [self._candidates(token.strip()) for token in tokens]
+
+        if candidates[0] is not None:
+            # The first column is sorted, so we only look at the ranges of the candidate first tokens
+            first_column = ngrams[:, 0]
+            starts = np.searchsorted(first_column, candidates[0], side='left')
+            ends = np.searchsorted(first_column, candidates[0], side='right')
+            rows = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)] or [np.zeros(0, dtype=np.int64)])
+        else:
+            rows = np.arange(len(ngrams))
+
+        for position in range(1, n):
+            if candidates[position] is None or len(rows) == 0:
+                continue
+            rows = rows[np.isin(ngrams[rows, position], candidates[position])]
+
+        return n, rows
+
+    def search(self, query_text):
+        n, rows = self.lookup(query_text)
+        if len(rows) == 0:
+            return {'ngrams': []}
+        ngrams = self.ngrams[n][rows]
+        counts = self.counts[n][rows]
+        return {'ngrams': [{'absTotalMatchCount': int(count), 'tokens': [{'text': self.vocab[token_id]} for token_id in ngram]}
+                           for ngram, count in zip(ngrams, counts)]}
+
+    def count(self, query_text):
+        # Shortcut for aggregate_freq(search(query_text)) that does not build the response
+        n, rows = self.lookup(query_text)
+        return int(self.counts[n][rows].sum()) if len(rows) > 0 else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds (or queries) a local ngram index from Google Books ngram shards')
+    parser.add_argument('--shards', nargs='+', help='Paths to the shard files (optionally .gz)')
+    parser.add_argument('--output', help='Directory of the index')
+    parser.add_argument('--min-count', type=int, default=1, help='Discard ngrams with fewer matches')
+    parser.add_argument('--query', help='Query the index instead of building it (e.g. "ride~+*+bicycle~")')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Distinct n-grams counted in memory before spilling them to disk')
+    parser.add_argument('--check', action='store_true', help='Build and query a small synthetic index instead (--output is ignored)')
+
+    args = parser.parse_args()
+
+    if args.check:
+        errors = check_fixture()
+        for error in errors:
+            print(error)
+        print('Fixture index: {}'.format('{} errors'.format(len(errors)) if errors else 'OK'))
+        raise SystemExit(1 if errors else 0)
+
+    if not args.output:
+        print("Please provide the directory of the index with --output.")
+        raise SystemExit
+    if args.query:
+        index = LocalNgramIndex(args.output)
+        print(json.dumps(index.search(args.query), indent=2))
+    elif args.shards:
+        num_ngrams = build_index(args.shards, args.output, min_count=args.min_count, chunk_size=args.chunk_size)
+        for n, num in num_ngrams.items():
+            print('{}-grams: {}'.format(n, num))
+        print('Index saved to {}'.format(args.output))
+    else:
+        print("Please provide either shards to build the index or a query.")
+        raise SystemExit
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import argparse
+from functools import lru_cache
+
+# Query strings for the ngrams API. Verbs and objects are compiled to query fragments once (they are memoized),
+# and pair queries are composed from the fragments, since the same verb appears in many pairs.
+
+
+@lru_cache(maxsize=None)
+def querify_verb(verb):
+    # Verb can have a preposition, so we only augment the first word
+    verb_root = verb.split(' ')[0].strip()
+    verb_root = verb_root + '~'  # We augment the verb.  # TODO: We need to do something more elaborate here (like ask GPT)
+
+    verb_preposition = verb.split(' ')[1:]
+    verb_preposition = [p.strip() for p in verb_preposition]
+
+    verb_query = [verb_root]
+    verb_query.extend(verb_preposition)
+    return '+'.join(verb_query)
+
+
+@lru_cache(maxsize=None)
+def querify_object(obj):
+    # For object, we could augment all words. However, it is too many wildcards and the API does not return results.
+    # We, therefore, only augment the last word (i.e. dining table -> dining table~)
+    obj_root = obj.split(' ')[-1].strip()
+    obj_root = obj_root + '~'  # We augment the object.  # TODO: We need to do something more elaborate here (like ask GPT)
+
+    obj_preposition = obj.split(' ')[:-1]
+    obj_preposition = [p.strip() for p in obj_preposition]
+
+    obj_query = list(obj_preposition)
+    obj_query.append(obj_root)
+    return '+'.join(obj_query)
+
+
+@lru_cache(maxsize=None)
+def querify_simple(text):
+    word_list = text.split(' ')
+    word_list = [word.strip() + '~' for word in word_list]
+    query = '+'.join(word_list)
+    return query
+
+
+def join_query(verb_query, obj_query, join_with_star=False):
+    if join_with_star:
+        return "{}+*+{}".format(verb_query, obj_query)  # We add * to account for articles, adjectives, etc.
+    return "{}+{}".format(verb_query, obj_query)
+
+
+def querify(text, join_with_star=False):
+    # Takes a text and converts it to a query string
+    # We take into account variatons of the text (right now with ~, but we need to do something more elaborate)
+    return join_query(querify_verb(text[0]), querify_object(text[1]), join_with_star=join_with_star)
+
+
+def query_cache_info():
+    # Same as lru_cache's cache_info(), for each of the memoized fragment builders
+    return {'verb': querify_verb.cache_info(), 'object': querify_object.cache_info(), 'simple': querify_simple.cache_info()}
+
+
+def clear_query_cache():
+    querify_verb.cache_clear()
+    querify_object.cache_clear()
+    querify_simple.cache_clear()
+
+
+if __name__ == '__main__':
+    # Benchmark of query generation alone (no API calls) for every verb-object combination of a file
+    parser = argparse.ArgumentParser(description='Benchmark query generation')
+    parser.add_argument('--file', help='Path to the input file (Verb,Object,... with a header)', required=True)
+    parser.add_argument('--repeat', type=int, default=5, help='Number of passes over the combinations')
+
+    args = parser.parse_args()
+
+    with open(args.file, 'r') as file:
+        lines = [line.strip().split(',') for line in file.readlines()[1:] if line.strip()]
+    verbs = sorted(set(line[0].replace('_', ' ') for line in lines))
+    objects = sorted(set(line[1].replace('_', ' ') for line in lines))
+
+    clear_query_cache()
+    for num_pass in range(args.repeat):
+        start = time.perf_counter()
+        for verb in verbs:
+            for obj in objects:
+                querify([verb, obj])
+                querify([verb, obj], join_with_star=True)
+        elapsed = time.perf_counter() - start
+        num_queries = 2 * len(verbs) * len(objects)
+        print('Pass {}: {} queries in {:.4f}s ({:.0f} queries/s)'.format(num_pass, num_queries, elapsed, num_queries / elapsed))
+
+    for name, info in query_cache_info().items():
+        print('{}: {}'.format(name, info))
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+
+DEFAULT_TIMEOUT = 30.0
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_BASE = 0.5
+DEFAULT_BACKOFF_CAP = 60.0
+
+DEFAULT_ADAPTIVE_RATE = 10.0
+DEFAULT_TARGET_LATENCY = 2.0
+
+
+class TokenBucket:
+    # Allows `rate` requests per second on average, with bursts of up to `burst` requests.
+    # A single instance is shared by every caller (threads and asyncio tasks), so the limit is global.
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst) if burst is not None else max(1.0, self.rate)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def reserve(self):
+        # Takes a token and returns how many seconds the caller has to wait before using it.
+        # Tokens can go negative, so concurrent callers queue up instead of all retrying at once.
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def on_success(self, latency):
+        pass
+
+    def on_error(self, throttled=False):
+        pass
+
+
+class AdaptiveRateLimiter(TokenBucket):
+    # Token bucket that looks for the highest sustainable rate (AIMD, as TCP does):
+    # the rate grows steadily while requests succeed fast, and is halved when the API throttles us or fails.
+    # Responses slower than target_latency also lower the rate a bit, since they mean the API is saturated.
+
+    def __init__(self, rate=DEFAULT_ADAPTIVE_RATE, min_rate=0.5, max_rate=100.0, target_latency=DEFAULT_TARGET_LATENCY, burst=None):
+        super().__init__(rate, burst)
+        self.fixed_burst = burst is not None  # A configured burst is kept, otherwise it follows the rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.target_latency = target_latency
+        self._last_decrease = 0.0
+
+    def _set_rate(self, rate):
+        now = time.monotonic()
+        self._refill(now)  # Tokens accumulated so far use the old rate
+        self.rate = min(self.max_rate, max(self.min_rate, rate))
+        if not self.fixed_burst:
+            self.burst = max(1.0, self.rate)
+
+    def _decrease(self, factor):
+        # We decrease at most once per second, since all the requests in flight fail at the same time
+        now = time.monotonic()
+        if now - self._last_decrease < 1.0:
+            return
+        self._last_decrease = now
+        self._set_rate(self.rate * factor)
+
+    def on_success(self, latency):
+        with self._lock:
+            if latency > self.target_latency:
+                self._decrease(0.9)
+            else:
+                # +1 request/second for every second worth of successful requests
+                self._set_rate(self.rate + 1.0 / self.rate)
+
+    def on_error(self, throttled=False):
+        with self._lock:
+            self._decrease(0.5 if throttled else 0.75)
+
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, retry_after=None, base=DEFAULT_BACKOFF_BASE, cap=DEFAULT_BACKOFF_CAP):
+    # Exponential backoff with full jitter, but never retrying earlier than the API asked us to
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def add_ratelimit_arguments(parser):
+    parser.add_argument('--rate', type=float, default=None, help='Maximum API requests per second (shared by all workers)')
+    parser.add_argument('--burst', type=float, default=None, help='Maximum burst of API requests (defaults to --rate)')
+    parser.add_argument('--adaptive', action='store_true', help='Adapt the request rate to the errors and latency of the API (starting at --rate)')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, help='Seconds before an API request times out')
+    parser.add_argument('--max-retries', type=int, default=DEFAULT_MAX_RETRIES, help='Retries of a failed API request before giving up')
+
+
+def rate_limiter_from_args(args):
+    if args.adaptive:
+        rate = args.rate if args.rate is not None else DEFAULT_ADAPTIVE_RATE
+        return AdaptiveRateLimiter(rate, burst=args.burst)
+    if args.rate is not None:
+        return TokenBucket(args.rate, burst=args.burst)
+    return None
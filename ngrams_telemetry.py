@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import threading
+import contextlib
+
+# Instrumentation of the API calls (ngrams_api.call_api and the async engine). Every call records one event:
+#   query, source ('api', 'cache' or 'backend'), status (last HTTP status, or None), retried (statuses of the failed
+#   attempts, None for connection errors), attempts, bytes (of the bodies of every attempt),
+#   latency (whole call), request (time in HTTP requests and their decoding, retries included), ttfb (until the response
+#   headers), parse (JSON decoding), wait (rate limiter), queue (waiting for a free connection slot), backoff (between
+#   retries), start (since the first call) and error (if it failed)
+# Events are aggregated into a run summary and, optionally, written to a JSONL trace as they happen. The summary
+# also splits the time of the run, so we can tell whether it is bound by the API, the network or the local CPU.
+
+SOURCES = ['api', 'cache', 'backend']
+
+
+class Telemetry:
+
+    def __init__(self, trace_path=None):
+        self.trace_path = trace_path
+        self.workers = 1  # Requests that can be in flight at once (the async engine sets its concurrency)
+        self.events = []
+        self._trace = open(trace_path, 'w') if trace_path else None
+        self._lock = threading.Lock()  # Events come from the main thread and from the thread of the event loop
+        self._start = None
+        self._start_cpu = None
+        self._end = None
+        self._end_cpu = None
+
+    def begin(self):
+        # Start of a call. The run starts with its first call (and not when the telemetry is created).
+        now = time.perf_counter()
+        if self._start is None:
+            with self._lock:
+                if self._start is None:
+                    self._start = now
+                    self._start_cpu = time.process_time()
+        return now
+
+    def record(self, start, **event):
+        end = time.perf_counter()
+        event['latency'] = end - start
+        event['start'] = start - self._start
+        with self._lock:
+            self._end = end
+            self._end_cpu = time.process_time()
+            self.events.append(event)
+            if self._trace is not None:
+                self._trace.write(json.dumps(event) + '\n')
+
+    def reset(self):
+        # Forgets the calls so far (e.g. the ones that warmed the cache), the trace keeps them
+        with self._lock:
+            self.events = []
+            self._start = self._start_cpu = self._end = self._end_cpu = None
+
+    def summary(self):
+        # Aggregates of the events, as a dict of plain numbers
+        with self._lock:
+            events = list(self.events)
+        if len(events) == 0:
+            return {'calls': 0}
+        import numpy as np  # Only needed for the summary, so the calls do not pay for it
+
+        wall = max(self._end - self._start, 1e-9)
+        cpu = self._end_cpu - self._start_cpu
+
+        def total(key, source=None):
+            return float(sum(event.get(key) or 0 for event in events if source is None or event['source'] == source))
+
+        latencies = np.array([event['latency'] for event in events]) * 1000
+        api_events = [event for event in events if event['source'] == 'api']
+        statuses = {}
+        for event in api_events:
+            for status in event['retried'] + [event['status']]:
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+        request, ttfb, parse = total('request'), total('ttfb'), total('parse')
+        summary = {
+            'calls': len(events),
+            'wall_time': wall,
+            'calls_per_second': len(events) / wall,
+            'latency_mean_ms': float(latencies.mean()),
+            'latency_p50_ms': float(np.percentile(latencies, 50)),
+            'latency_p90_ms': float(np.percentile(latencies, 90)),
+            'latency_p99_ms': float(np.percentile(latencies, 99)),
+            'latency_max_ms': float(latencies.max()),
+            'statuses': statuses,  # Of every attempt
+            'retries': int(sum(event['attempts'] - 1 for event in api_events)),
+            'errors': sum(1 for event in events if event.get('error')),
+            'bytes': int(total('bytes', 'api')),
+            'workers': self.workers,
+            # Time of the calls spent in each phase (summed over the calls, so it can exceed the wall time)
+            'request_time': request,
+            'ttfb_time': ttfb,
+            'transfer_time': max(request - ttfb - parse, 0.0),
+            'parse_time': parse,
+            'wait_time': total('wait'),
+            'queue_time': total('queue'),
+            'backoff_time': total('backoff'),
+            # Mean number of calls in flight, over the number of workers that could be
+            'utilization': total('latency') / (wall * self.workers),
+            'cpu_fraction': cpu / wall,
+        }
+        for source in SOURCES:
+            summary['{}_calls'.format(source)] = sum(1 for event in events if event['source'] == source)
+        summary['bound'] = bound(summary)
+        return summary
+
+    def report(self):
+        summary = self.summary()
+        if summary['calls'] == 0:
+            return 'Telemetry: no calls'
+        lines = [
+            'Telemetry: {calls} calls in {wall_time:.2f}s ({calls_per_second:.1f} calls/s): {api_calls} API, {cache_calls} cache, {backend_calls} local index'.format(**summary),
+            '  Latency: mean {latency_mean_ms:.1f}ms, p50 {latency_p50_ms:.1f}ms, p90 {latency_p90_ms:.1f}ms, p99 {latency_p99_ms:.1f}ms, max {latency_max_ms:.1f}ms'.format(**summary),
+            '  API: statuses {}, {} retries, {} errors, {:.1f}MB received'.format(
+                ', '.join('{}: {}'.format(status, count) for status, count in sorted(summary['statuses'].items())) or 'none',
+                summary['retries'], summary['errors'], summary['bytes'] / 1e6),
+            '  Time in calls: {ttfb_time:.2f}s waiting for the API, {transfer_time:.2f}s receiving, {parse_time:.2f}s parsing, '
+            '{wait_time:.2f}s rate limited, {backoff_time:.2f}s backing off, {queue_time:.2f}s waiting for a connection'.format(**summary),
+            '  Workers: {workers} ({utilization:.0%} busy), CPU {cpu_fraction:.0%} of the wall time. Likely bound by {bound}'.format(**summary),
+        ]
+        return '\n'.join(lines)
+
+    def close(self):
+        if self._trace is not None:
+            self._trace.close()
+            self._trace = None
+
+
+@contextlib.contextmanager
+def track(telemetry, query_text):
+    # Yields the event of a call, to be filled by the caller, and records it when the call is over (even if it failed).
+    # Without telemetry, the event is simply dropped.
+    event = {'query': query_text, 'source': 'api', 'status': None, 'retried': [], 'attempts': 0, 'bytes': 0, 'request': 0.0, 'ttfb': 0.0,
+             'parse': 0.0, 'wait': 0.0, 'queue': 0.0, 'backoff': 0.0}
+    if telemetry is None:
+        yield event
+        return
+
+    start = telemetry.begin()
+    try:
+        yield event
+    except Exception as e:
+        event['error'] = '{}: {}'.format(type(e).__name__, e)
+        raise
+    finally:
+        telemetry.record(start, **event)
+
+
+def bound(summary):
+    # Rough diagnosis of what limits the run, from the split of its time
+    busy = summary['ttfb_time'] + summary['transfer_time']
+    throttled = summary['wait_time'] + summary['backoff_time']
+    if summary['cpu_fraction'] > 0.8:
+        return 'the local CPU'
+    if throttled > busy:
+        return 'the rate limit and retries'
+    if summary['api_calls'] == 0:
+        return 'the local CPU' if summary['cpu_fraction'] > 0.5 else 'the cache or local index'
+    if summary['utilization'] < 0.5:
+        return 'the local processing (workers are mostly idle)'
+    if summary['transfer_time'] > summary['ttfb_time']:
+        return 'the network (transfer of the responses)'
+    return 'the API (latency of the responses)'
+
+
+def add_telemetry_arguments(parser):
+    parser.add_argument('--telemetry', action='store_true', help='Print a summary of the API calls (latency, status, bytes, retries, cache hits...)')
+    parser.add_argument('--trace', default=None, help='Path of a JSONL trace with one event per API call (implies --telemetry)')
+
+
+def telemetry_from_args(args):
+    if not (args.telemetry or args.trace):
+        return None
+    return Telemetry(trace_path=args.trace)
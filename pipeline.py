@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import hashlib
+import argparse
+import pandas as pd
+import hoi_io
+import ngrams_api
+import ngrams_async
+import ngrams_expand
+import get_interactions
+import get_freq_ngrams
+import merge_datasets
+
+# Runs the whole workflow (extraction -> ngram retrieval -> merge -> plot) in a single process. Tables are handed
+# from one stage to the next in memory (and also saved to the output directory, as the scripts would). A stage is
+# skipped when the hash of its inputs (the tables it reads and its options) is the one recorded by the last run;
+# its tables are then only read from disk if a later stage has to run.
+
+MANIFEST_NAME = 'pipeline.json'
+
+
+def hash_text(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def hash_tables(tables):
+    # Content hash of {name: DataFrame}. Values are hashed as strings, so it does not depend on the dtypes
+    # (e.g. categoricals read from Parquet vs strings built in memory)
+    sha256 = hashlib.sha256()
+    for name in sorted(tables):
+        table = tables[name]
+        sha256.update(json.dumps([name, list(table.columns)]).encode('utf-8'))
+        sha256.update(pd.util.hash_pandas_object(table.astype(str), index=False).values.tobytes())
+    return sha256.hexdigest()
+
+
+class StageResult:
+    # Output of a stage: the hash of its tables, and the tables themselves (read from disk on first use if the stage was skipped)
+
+    def __init__(self, output_hash, tables=None, paths=None):
+        self.hash = output_hash
+        self._tables = tables
+        self._paths = paths or {}
+
+    def tables(self):
+        if self._tables is None:
+            self._tables = {name: hoi_io.read_table(path) for name, path in self._paths.items()}
+        return self._tables
+
+
+class Pipeline:
+
+    def __init__(self, output_dir, force=False):
+        self.output_dir = output_dir
+        self.force = force
+        self.manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+        self.timings = []  # (stage, status, seconds)
+
+        os.makedirs(output_dir, exist_ok=True)
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as file:
+                self.manifest = json.load(file)
+
+    def _save_manifest(self):
+        # Saved after every stage, so an interrupted run keeps the stages it finished
+        with open(self.manifest_path, 'w') as file:
+            json.dump(self.manifest, file, indent=2)
+
+    def run_stage(self, stage, input_hashes, options, paths, func, force=False):
+        # func() returns {name: DataFrame}, saved to paths[name]. Other paths (e.g. figures) are written by func itself.
+        key = hash_text(json.dumps({'stage': stage, 'inputs': input_hashes, 'options': options, 'paths': paths}, sort_keys=True))
+        table_paths = {name: path for name, path in paths.items() if os.path.splitext(path)[1][1:] in hoi_io.FORMATS}
+        record = self.manifest.get(stage)
+
+        start = time.perf_counter()
+        if not (self.force or force) and record is not None and record['key'] == key and all(os.path.exists(path) for path in paths.values()):
+            result = StageResult(record['hash'], paths=table_paths)
+            status = 'skipped'
+        else:
+            tables = func()
+            for name, table in tables.items():
+                hoi_io.write_table(table, paths[name])
+            result = StageResult(hash_tables(tables), tables=tables)
+            status = 'ran'
+        elapsed = time.perf_counter() - start
+
+        if status == 'ran':
+            self.manifest[stage] = {'key': key, 'hash': result.hash, 'outputs': paths, 'seconds': elapsed}
+            self._save_manifest()
+        self.timings.append((stage, status, elapsed))
+        return result
+
+    def report(self):
+        lines = ['{:<10} {:<8} {:>9}'.format('Stage', 'Status', 'Time')]
+        for stage, status, elapsed in self.timings:
+            lines.append('{:<10} {:<8} {:>8.2f}s'.format(stage, status, elapsed))
+        lines.append('{:<10} {:<8} {:>8.2f}s'.format('total', '', sum(elapsed for _, _, elapsed in self.timings)))
+        return '\n'.join(lines)
+
+
+def run(args):
+    file_name = os.path.splitext(os.path.basename(args.file))[0]
+    output_dir = args.output_dir or '{}_pipeline'.format(file_name)
+    pipeline = Pipeline(output_dir, force=args.force)
+
+    def output_path(suffix, fmt=args.format):
+        return hoi_io.table_path(os.path.join(output_dir, '{}_{}'.format(file_name, suffix)), fmt)
+
+    # 1. Extraction of the HOI frequencies from the annotation file (same tables as get_interactions.py)
+    def extract():
+        if args.from_annotations:
+            hoi_data_splits = get_interactions.process_annotations(args.file, annotations_key=args.annotations_key, sidecar_dir=args.sidecar_dir,
+                                                                   use_sidecar=not args.no_sidecar, workers=args.workers,
+                                                                   rare_threshold=args.rare_threshold)
+            hoi_data = hoi_data_splits[args.split or list(hoi_data_splits)[0]]
+        else:
+            hoi_data = get_interactions.process_file(args.file, sidecar_dir=args.sidecar_dir, use_sidecar=not args.no_sidecar)
+        return get_interactions.hoi_data_tables(hoi_data)
+
+    extract_options = {'from_annotations': args.from_annotations, 'annotations_key': args.annotations_key, 'split': args.split,
+                       'rare_threshold': args.rare_threshold}
+    extract_paths = {table: output_path(table) for table in ['interactions', 'objects', 'verbs']}
+    extracted = pipeline.run_stage('extract', [get_interactions.file_signature(args.file)], extract_options, extract_paths, extract)
+
+    # 2. Ngram frequencies of the interactions, verbs and objects (same tables as get_freq_ngrams.py --save)
+    def retrieve():
+        interactions = extracted.tables()['interactions']
+        actions = [[str(verb).strip(), str(obj).strip()] for verb, obj in zip(interactions['Verb'], interactions['Object'])]
+        freqs = get_freq_ngrams.retrieve_frequencies(actions, parse=args.parse_underscore, every_combination=args.get_every_combination,
+                                                     parallel=args.parallel, concurrency=args.concurrency, limit_per_host=args.limit_per_host,
+                                                     expand=args.expand)
+        return get_freq_ngrams.frequency_tables(freqs)
+
+    # Edited inflection tables change the counts, so they are part of the options
+    retrieve_options = {'parse_underscore': args.parse_underscore, 'get_every_combination': args.get_every_combination,
+                        'api_url': args.api_url, 'local_index': args.local_index, 'expand': args.expand,
+                        'inflections': get_interactions.file_signature(args.inflections) if args.inflections else None}
+    retrieve_paths = {
+        'interactions': output_path('interactions_ngrams_all' if args.get_every_combination else 'interactions_ngrams'),
+        'verbs': output_path('interactions_ngrams_verbs'),
+        'objects': output_path('interactions_ngrams_objects'),
+    }
+    # Cached responses are ignored with --refresh, so the stage has to run again
+    retrieved = pipeline.run_stage('retrieve', [extracted.hash], retrieve_options, retrieve_paths, retrieve, force=args.refresh)
+
+    # 3. Merge of both sets of frequencies (same table as merge_datasets.py)
+    def merge():
+        hoi_tables, ngrams_tables = extracted.tables(), retrieved.tables()
+        stats = merge_datasets.merge_frequencies(hoi_tables['interactions'], ngrams_tables['interactions'], hoi_tables['verbs'],
+                                                 hoi_tables['objects'], ngrams_tables['verbs'], ngrams_tables['objects'],
+                                                 allow_mismatch=args.allow_mismatch)
+        return {'stats': stats}
+
+    merge_paths = {'stats': output_path('stats')}
+    merged = pipeline.run_stage('merge', [extracted.hash, retrieved.hash], {'allow_mismatch': args.allow_mismatch}, merge_paths, merge)
+
+    # 4. Correlation plot (same figure as plot_correlation.py), saved as an image
+    if not args.no_plot:
+        plot_paths = {'figure': output_path('stats', fmt='png')}
+
+        def plot():
+            # Plotting is only imported if the figure has to be drawn, and without a display
+            import matplotlib
+            matplotlib.use('Agg')
+            import matplotlib.pyplot as plt
+            import plot_correlation
+
+            fig = plot_correlation.plot_frequencies(merged.tables()['stats'], ignore_no_interaction=args.ignore_no_interaction)
+            fig.savefig(plot_paths['figure'], dpi=150)
+            plt.close(fig)
+            return {}
+
+        pipeline.run_stage('plot', [merged.hash], {'ignore_no_interaction': args.ignore_no_interaction}, plot_paths, plot)
+
+    print('Outputs saved to {}'.format(output_dir))
+    print(pipeline.report())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs the HOI frequencies workflow in a single process')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Extraction, ngram retrieval, merge and plot (only the stages whose inputs changed)')
+    run_parser.add_argument('--file', help='Path to the annotation file', required=True)
+    run_parser.add_argument('--output-dir', default=None, help='Directory of the outputs and of the manifest of the last run (defaults to <file>_pipeline)')
+    run_parser.add_argument('--force', action='store_true', help='Run every stage, even if its inputs did not change')
+    run_parser.add_argument('--no-plot', action='store_true', help='Stop after the merge')
+    hoi_io.add_format_argument(run_parser)
+    # Extraction (see get_interactions.py)
+    run_parser.add_argument('--sidecar-dir', default=None, help='Directory of the extracted annotations cache (defaults to the directory of the input file)')
+    run_parser.add_argument('--no-sidecar', action='store_true', help='Always load the full annotation file')
+    run_parser.add_argument('--from-annotations', action='store_true', help='Count the frequencies from the raw per-image annotations')
+    run_parser.add_argument('--annotations-key', default='annotations', help='Key of the per-image annotations in the input file')
+    run_parser.add_argument('--split', default=None, help='Split of the annotations to use (defaults to the first one)')
+    run_parser.add_argument('--workers', type=int, default=1, help='Processes used to count the annotations')
+    run_parser.add_argument('--rare-threshold', type=int, default=10, help='Interactions with fewer annotations are rare (with --from-annotations)')
+    # Retrieval (see get_freq_ngrams.py)
+    run_parser.add_argument('--parse-underscore', action='store_true', help='Convert undersdores to spaces')
+    run_parser.add_argument('--get-every-combination', action='store_true', help='Get every verb-object combination')
+    run_parser.add_argument('--parallel', action='store_true', help='Perform API calls in parallel')
+    ngrams_api.add_api_arguments(run_parser)
+    ngrams_async.add_async_arguments(run_parser)
+    ngrams_expand.add_expand_arguments(run_parser)
+    # Merge and plot (see merge_datasets.py and plot_correlation.py)
+    run_parser.add_argument('--allow-mismatch', action='store_true', help='Allow mismatch between interactions in the two files')
+    run_parser.add_argument('--ignore-no_interaction', action='store_true', help='Removes no_interaction from the interactions')
+
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        ngrams_api.setup_from_args(args)
+        ngrams_expand.expand_from_args(args)
+        run(args)
+        ngrams_api.teardown()
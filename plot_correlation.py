@@ -1,31 +1,56 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
 import argparse
 import seaborn as sns
+import hoi_io
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Plots Database vs Ngrams frequencies')
-    parser.add_argument('--file', help='Path to the input file', required=True)
-    parser.add_argument('--ignore-no_interaction', action='store_true', help='Removes no_interaction from the interactions')
+# Above this number of rows, the interaction scatter plot is drawn as a density (or from a sample of the rows)
+DEFAULT_MAX_POINTS = 50000
+LARGE_MODES = ['density', 'sample']
+# Columns of the merged table that are plotted (the Interaction labels are not needed)
+PLOT_COLUMNS = ['Verb', 'Object', 'Interaction_freq_ngrams',  'Verb_freq_ngrams', 'Object_freq_ngrams', 'Interaction_freq_hoi', 'Verb_freq_hoi', 'Object_freq_hoi', 'IsRare_hoi']
 
-    args = parser.parse_args()
 
-    # Load the data from CSV files
-    # Files have a header with the columns: ['Interaction', 'Verb', 'Object', 'Interaction_freq_ngrams',  'Verb_freq_ngrams', 'Object_freq_ngrams', 'Interaction_freq_hoi', 'Verb_freq_hoi', 'Object_freq_hoi', 'IsRare_hoi']
-    df = pd.read_csv(args.file, header=0)
+def sample_rows(df, max_points, seed=0):
+    # Uniform sample of max_points rows (without replacement), in their original order
+    if len(df) <= max_points:
+        return df
+    rows = np.random.default_rng(seed).choice(len(df), size=max_points, replace=False)
+    return df.iloc[np.sort(rows)]
 
+
+def density_edges(values, bins, log_scale=False):
+    # Bin edges from 0 to the maximum. With log_scale, the first bin holds [0, 1) and the rest are logarithmic.
+    high = max(float(values.max()), 1.0) if len(values) > 0 else 1.0
+    if log_scale:
+        return np.concatenate([[0.0], np.logspace(0, np.log10(high) * (1 + 1e-9), bins)])
+    return np.linspace(0, high * (1 + 1e-9), bins + 1)
+
+
+def density_plot(ax, x, y, bins=100, log_scale=False):
+    # 2D histogram of the points, so drawing time and memory do not depend on their number
+    counts, x_edges, y_edges = np.histogram2d(x, y, bins=[density_edges(x, bins, log_scale), density_edges(y, bins, log_scale)])
+    mesh = ax.pcolormesh(x_edges, y_edges, np.ma.masked_equal(counts.T, 0), norm=LogNorm(), cmap='Greys')
+    ax.figure.colorbar(mesh, ax=ax, label='Interactions per bin')
+
+
+def plot_frequencies(df, ignore_no_interaction=False, max_points=DEFAULT_MAX_POINTS, large_mode='density', log_scale=False, seed=0):
+    # Returns the figure with the HOI vs ngrams frequencies of a merged table (see merge_datasets.py)
     # We will remove the no_interaction from the database
-    if args.ignore_no_interaction:
+    if ignore_no_interaction:
         df = df[df['Verb'] != 'no_interaction']
+    df = df.copy()  # We change the columns below, but not the table of the caller
 
     
     # We will replace the IsRare_hoi column with a text column
     labels = {-1: 'Not in HOI', 0: 'Not rare', 1: 'Rare'}
-    df['IsRare_hoi'] = df['IsRare_hoi'].map(labels)
+    df['IsRare_hoi'] = pd.Categorical.from_codes(df['IsRare_hoi'].to_numpy() + 1, categories=list(labels.values()))
     
     # We will plot the scatter plot and add color based on IsRare, with a legend where -1 = "Not in HOI", 0 = "Not rare", 1 = "Rare"
     colors = {'Not in HOI': 'black', 'Not rare': 'green', 'Rare': 'red'}
@@ -34,21 +59,44 @@ if __name__ == '__main__':
     fig, axs = plt.subplots(2, 2, figsize=(15, 8))
 
     # 1. Interaction_freq_ngrams vs Interaction_freq_hoi
-    sns.scatterplot(ax=axs[0, 0], data=df, x='Interaction_freq_ngrams', y='Interaction_freq_hoi', hue='IsRare_hoi', palette=colors, s=5)
+    # Correlations are always computed on every row, only the drawing changes for large tables
     corr_coef = df['Interaction_freq_ngrams'].corr(df['Interaction_freq_hoi'])
-    axs[0, 0].set_title(f'Interaction Frequencies, HOI v.s ngrams (r={corr_coef:.2f})')
-    axs[0, 0].legend(handles=[plt.Line2D([0], [0], marker='o', color='w', markerfacecolor=color, markersize=10, label=label) for label, color in colors.items()])
+    title = f'Interaction Frequencies, HOI v.s ngrams (r={corr_coef:.2f})'
+    if len(df) <= max_points:
+        sns.scatterplot(ax=axs[0, 0], data=df, x='Interaction_freq_ngrams', y='Interaction_freq_hoi', hue='IsRare_hoi', palette=colors, s=5)
+    elif large_mode == 'sample':
+        sns.scatterplot(ax=axs[0, 0], data=sample_rows(df, max_points, seed), x='Interaction_freq_ngrams', y='Interaction_freq_hoi',
+                        hue='IsRare_hoi', palette=colors, s=5)
+        title += f', {max_points} of {len(df)} points'
+    else:
+        # Density of every interaction, with the ones in HOI (usually few) drawn on top
+        density_plot(axs[0, 0], df['Interaction_freq_ngrams'].to_numpy(), df['Interaction_freq_hoi'].to_numpy(), log_scale=log_scale)
+        in_hoi = sample_rows(df[df['IsRare_hoi'] != 'Not in HOI'], max_points, seed)
+        sns.scatterplot(ax=axs[0, 0], data=in_hoi, x='Interaction_freq_ngrams', y='Interaction_freq_hoi', hue='IsRare_hoi', palette=colors, s=5)
+    axs[0, 0].set_title(title)
+    # The 'best' location is searched over every point drawn, so it is fixed for large tables
+    axs[0, 0].legend(handles=[plt.Line2D([0], [0], marker='o', color='w', markerfacecolor=color, markersize=10, label=label) for label, color in colors.items()],
+                     loc='best' if len(df) <= max_points else 'upper left')
 
     # 2. Verb_freq_ngrams vs Verb_freq_hoi
-    sns.scatterplot(ax=axs[0, 1], data=df, x='Verb_freq_ngrams', y='Verb_freq_hoi', s=5) # Does not make sense to color by IsRare_hoi because all the dots are stacked
+    # Every verb has the same frequencies in all its rows, so we only draw one point per verb
+    sns.scatterplot(ax=axs[0, 1], data=df.drop_duplicates('Verb'), x='Verb_freq_ngrams', y='Verb_freq_hoi', s=5) # Does not make sense to color by IsRare_hoi because all the dots are stacked
     corr_coef = df['Verb_freq_ngrams'].corr(df['Verb_freq_hoi'])
     axs[0, 1].set_title(f'Verb Frequencies, HOI v.s ngrams (r={corr_coef:.2f})')
 
     # 3. Object_freq_ngrams vs Object_freq_hoi
-    sns.scatterplot(ax=axs[1, 0], data=df, x='Object_freq_ngrams', y='Object_freq_hoi', s=5) # Does not make sense to color by IsRare_hoi because all the dots are stacked
+    sns.scatterplot(ax=axs[1, 0], data=df.drop_duplicates('Object'), x='Object_freq_ngrams', y='Object_freq_hoi', s=5) # Does not make sense to color by IsRare_hoi because all the dots are stacked
     corr_coef = df['Object_freq_ngrams'].corr(df['Object_freq_hoi'])
     axs[1, 0].set_title(f'Object Frequencies, HOI v.s ngrams (r={corr_coef:.2f})')
 
+    if log_scale:
+        # Frequencies can be 0, so the axes are linear below 1
+        for ax in [axs[0, 0], axs[0, 1], axs[1, 0]]:
+            ax.set_xscale('symlog', linthresh=1)
+            ax.set_yscale('symlog', linthresh=1)
+            ax.set_xlim(left=0)
+            ax.set_ylim(bottom=0)
+
     # 4. Histogram of Interaction_freq_ngrams (stacked histogram colored by IsRare_hoi)
     # Discard outliers
     q_low = 0
@@ -56,9 +104,39 @@ if __name__ == '__main__':
     df_filtered = df[(df['Interaction_freq_ngrams'] > q_low) & (df['Interaction_freq_ngrams'] < q_high)]
 
     # Plot histogram
-    sns.histplot(ax=axs[1, 1], data=df_filtered, x='Interaction_freq_ngrams', hue='IsRare_hoi', multiple='stack', palette=colors, bins=50)
+    sns.histplot(ax=axs[1, 1], data=df_filtered, x='Interaction_freq_ngrams', hue='IsRare_hoi', multiple='stack', palette=colors, bins=50,
+                 log_scale=log_scale)
     axs[1, 1].set_title('Distribution of ngrams Interaction frequencies (Filtered)')
 
-    plt.tight_layout()
-    plt.show()
-    plt.close()
\ No newline at end of file
+    fig.tight_layout()
+    return fig
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Plots Database vs Ngrams frequencies')
+    parser.add_argument('--file', help='Path to the input file', required=True)
+    parser.add_argument('--ignore-no_interaction', action='store_true', help='Removes no_interaction from the interactions')
+    parser.add_argument('--output', help='Save the figure to this file (.png, .svg, .pdf...) instead of showing it (no display needed)')
+    parser.add_argument('--max-points', type=int, default=DEFAULT_MAX_POINTS, help='Above this number of interactions, they are not drawn one by one')
+    parser.add_argument('--large-mode', choices=LARGE_MODES, default='density', help='How to draw more than --max-points interactions: as a 2D histogram or from a random sample')
+    parser.add_argument('--log', action='store_true', help='Logarithmic frequency axes')
+    parser.add_argument('--dpi', type=int, default=150, help='Resolution of raster outputs')
+
+    args = parser.parse_args()
+
+    if args.output:
+        plt.switch_backend('Agg')
+
+    # Load the data from CSV files
+    # Files have a header with the columns: ['Interaction', 'Verb', 'Object', 'Interaction_freq_ngrams',  'Verb_freq_ngrams', 'Object_freq_ngrams', 'Interaction_freq_hoi', 'Verb_freq_hoi', 'Object_freq_hoi', 'IsRare_hoi']
+    # We only read the columns we plot
+    df = hoi_io.read_table(args.file, columns=PLOT_COLUMNS)
+
+    fig = plot_frequencies(df, ignore_no_interaction=args.ignore_no_interaction, max_points=args.max_points, large_mode=args.large_mode,
+                           log_scale=args.log)
+    if args.output:
+        fig.savefig(args.output, dpi=args.dpi)
+        print('Figure saved to {}'.format(args.output))
+    else:
+        plt.show()
+    plt.close(fig)